@@ -0,0 +1,529 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains benchmarks for the performance-related options of the code.
+Each benchmark is a subcommand, e.g.
+
+    python code/benchmark.py embeddings --embedding_size 300
+
+Run python code/benchmark.py --help to list them."""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+from six.moves import xrange
+
+from vocab import get_glove, quantize_embeddings, EMB_DTYPES
+from evaluate import evaluate
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+MAIN_DIR = os.path.dirname(CODE_DIR)
+DEFAULT_DATA_DIR = os.path.join(MAIN_DIR, "data")
+
+# Runs main.py with the arguments given after "--", and prints the peak RSS (in KB) to stderr on exit
+PEAK_RSS_WRAPPER = """
+import atexit, resource, runpy, sys
+atexit.register(lambda: sys.stderr.write("PEAK_RSS_KB %i\\n" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def run_main(main_args):
+    """
+    Runs main.py in a subprocess with the given arguments.
+
+    Returns:
+      seconds: float. Wall-clock time of the run.
+      peak_rss_mb: float. Peak resident memory of the run.
+    """
+    tic = time.time()
+    proc = subprocess.Popen([sys.executable, "-c", PEAK_RSS_WRAPPER, os.path.join(CODE_DIR, "main.py")] + main_args, stderr=subprocess.PIPE)
+    _, stderr = proc.communicate()
+    toc = time.time()
+    if proc.returncode != 0:
+        sys.stderr.write(stderr)
+        raise Exception("main.py exited with code %i" % proc.returncode)
+    peak_rss_kb = [int(line.split()[1]) for line in stderr.splitlines() if line.startswith("PEAK_RSS_KB")][-1]
+    return toc - tic, peak_rss_kb / 1024.
+
+
+def bench_embeddings(args):
+    """
+    Compares the float32/float16/int8 embedding stores (see --emb_dtype in main.py):
+    size of the embedding table and reconstruction error, and if a checkpoint is given,
+    official_eval F1/EM, time and peak memory.
+    """
+    glove_path = args.glove_path or os.path.join(DEFAULT_DATA_DIR, "glove.6B.{}d.txt".format(args.embedding_size))
+    emb_matrix, _, _ = get_glove(glove_path, args.embedding_size)
+
+    # Measure reconstruction error on a sample of rows
+    sample = np.random.RandomState(0).choice(emb_matrix.shape[0], min(args.num_rows, emb_matrix.shape[0]), replace=False)
+    sample_matrix = np.asarray(emb_matrix[np.sort(sample)], dtype=np.float32)
+
+    print "%-8s %12s %14s %14s %12s" % ("dtype", "table MB", "max abs err", "mean abs err", "min cosine")
+    for emb_dtype in EMB_DTYPES:
+        values, scales = quantize_embeddings(emb_matrix, emb_dtype)
+        table_mb = (values.nbytes + (scales.nbytes if scales is not None else 0)) / 2.**20
+
+        sample_values, sample_scales = quantize_embeddings(sample_matrix, emb_dtype)
+        reconstructed = sample_values.astype(np.float32) * (sample_scales if sample_scales is not None else 1.)
+        err = np.abs(reconstructed - sample_matrix)
+        norms = np.linalg.norm(reconstructed, axis=1) * np.linalg.norm(sample_matrix, axis=1)
+        cosine = (reconstructed * sample_matrix).sum(axis=1) / np.maximum(norms, 1e-12)
+        print "%-8s %12.1f %14.6f %14.6f %12.6f" % (emb_dtype, table_mb, err.max(), err.mean(), cosine.min())
+        del values, scales
+
+    if not (args.ckpt_load_dir and args.json_in_path):
+        print "Pass --ckpt_load_dir and --json_in_path to compare official_eval accuracy"
+        return
+
+    with open(args.json_in_path) as fh:
+        dataset = json.load(fh)['data']
+
+    print "%-8s %8s %8s %10s %14s" % ("dtype", "F1", "EM", "seconds", "peak RSS MB")
+    for emb_dtype in EMB_DTYPES:
+        out_path = os.path.join(tempfile.mkdtemp(), "predictions.json")
+        seconds, peak_rss_mb = run_main(["--mode=official_eval", "--emb_dtype=%s" % emb_dtype,
+            "--json_in_path=%s" % args.json_in_path, "--ckpt_load_dir=%s" % args.ckpt_load_dir,
+            "--json_out_path=%s" % out_path, "--embedding_size=%i" % args.embedding_size,
+            "--glove_path=%s" % glove_path] + args.main_args)
+        with open(out_path) as fh:
+            scores = evaluate(dataset, json.load(fh))
+        print "%-8s %8.3f %8.3f %10.2f %14.1f" % (emb_dtype, scores['f1'], scores['exact_match'], seconds, peak_rss_mb)
+
+
+def load_main(main_args):
+    """
+    Imports main.py with the given flags, and loads the GloVe vectors.
+
+    Returns:
+      main: the main module, with the model classes and main.FLAGS
+      model_classes: dict mapping --model_name to the model class
+      emb_matrix, word2id, id2word: as returned by get_glove
+    """
+    # main.py defines the model flags. They are parsed from sys.argv when main is imported.
+    sys.argv = [sys.argv[0]] + main_args
+    import main
+    FLAGS = main.FLAGS
+    model_classes = {"baseline": main.QABaselineModel, "bidaf": main.QABidafModel, "selfattn": main.QASelfAttnModel,
+                     "stack": main.QAStackModel, "pointer": main.QAPointerModel}
+
+    glove_path = FLAGS.glove_path or os.path.join(DEFAULT_DATA_DIR, "glove.6B.{}d.txt".format(FLAGS.embedding_size))
+    emb_matrix, word2id, id2word = get_glove(glove_path, FLAGS.embedding_size)
+    return main, model_classes, emb_matrix, word2id, id2word
+
+
+def train_speed(qa_model, train_paths, num_batches, warmup_batches):
+    """
+    Runs num_batches + warmup_batches training iterations of a new randomly-initialized qa_model.
+
+    The time is the wall-clock time of the iterations after warmup_batches, including getting each batch
+    from the input pipeline (building it in Python or waiting for the prefetching threads with feed_dict),
+    as the tf.data pipeline runs inside the training step.
+
+    Returns:
+      examples_per_sec: float. Training examples per second, over the batches after warmup_batches.
+      steps_per_sec: float. Training iterations per second, over the same batches.
+      wait_fraction: float. Fraction of that time spent waiting for the next batch (batches.wait_time, 0 for tf.data).
+    """
+    import tensorflow as tf
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer(), qa_model.get_initializer_feed())
+        summary_writer = tf.summary.FileWriter(tempfile.mkdtemp())
+
+        num_examples, num_steps = 0, 0
+        with qa_model.train_batches(sess, *train_paths) as batches:
+            batch_iter = iter(batches)
+            tic, wait_start = time.time(), batches.wait_time
+            for batch_num in xrange(num_batches + warmup_batches):
+                if batch_num == warmup_batches:
+                    tic, wait_start = time.time(), batches.wait_time
+                try:
+                    batch = next(batch_iter)
+                    batch_size = qa_model.run_train_iter(sess, batch, summary_writer)[4]
+                except (StopIteration, tf.errors.OutOfRangeError):
+                    break
+                if batch_num >= warmup_batches:
+                    num_examples += batch_size
+                    num_steps += 1
+            train_time = time.time() - tic
+            wait_time = batches.wait_time - wait_start
+
+    return num_examples / train_time, num_steps / train_time, wait_time / train_time
+
+
+def bench_padding(args):
+    """
+    Compares the training throughput of each model with batches padded to
+    context_len/question_len, and with dynamic padding and length bucketing
+    (see --dynamic_padding and --bucket_width in main.py).
+    The models are randomly initialized: only the speed is meaningful.
+    """
+    main, model_classes, emb_matrix, word2id, id2word = load_main(args.main_args)
+    import tensorflow as tf
+    FLAGS = main.FLAGS
+    train_paths = [os.path.join(FLAGS.data_dir, "train." + ext) for ext in ("context", "question", "span")]
+
+    print "%-10s %-10s %14s %10s" % ("model", "padding", "examples/sec", "speedup")
+    for model_name in args.model_names.split(","):
+        baseline_speed = None
+        for (padding, dynamic_padding, bucket_width) in [("fixed", False, 0), ("dynamic", True, args.bucket_width)]:
+            FLAGS.model_name = model_name
+            FLAGS.dynamic_padding = dynamic_padding
+            FLAGS.bucket_width = bucket_width
+
+            tf.reset_default_graph()
+            qa_model = model_classes[model_name](FLAGS, id2word, word2id, emb_matrix)
+            speed, _, _ = train_speed(qa_model, train_paths, args.num_batches, args.warmup_batches)
+            baseline_speed = baseline_speed or speed
+            print "%-10s %-10s %14.1f %9.2fx" % (model_name, padding, speed, speed / baseline_speed)
+
+
+def bench_input_pipeline(args):
+    """
+    Compares the training steps per second of each model when the batches are built in Python
+    and fed through feed_dict, and when they come from the tf.data pipeline over the TFRecord data
+    (see --input_pipeline in main.py). The TFRecord file is written first if needed.
+    The models are randomly initialized: only the speed is meaningful.
+    """
+    main, model_classes, emb_matrix, word2id, id2word = load_main(args.main_args)
+    import tensorflow as tf
+    FLAGS = main.FLAGS
+    train_paths = [os.path.join(FLAGS.data_dir, "train." + ext) for ext in ("context", "question", "span")]
+
+    print "%-10s %-10s %11s %14s %10s %10s" % ("model", "pipeline", "steps/sec", "examples/sec", "speedup", "waiting")
+    for model_name in args.model_names.split(","):
+        baseline_speed = None
+        for input_pipeline in ("feed_dict", "tfdata"):
+            FLAGS.model_name = model_name
+            FLAGS.input_pipeline = input_pipeline
+
+            tf.reset_default_graph()
+            qa_model = model_classes[model_name](FLAGS, id2word, word2id, emb_matrix)
+            speed, steps_per_sec, wait_fraction = train_speed(qa_model, train_paths, args.num_batches, args.warmup_batches)
+            baseline_speed = baseline_speed or steps_per_sec
+            print "%-10s %-10s %11.2f %14.1f %9.2fx %9.1f%%" % (model_name, input_pipeline, steps_per_sec, speed, steps_per_sec / baseline_speed, 100 * wait_fraction)
+
+
+def bench_alignment(args):
+    """
+    Compares the answer spans (in tokens) given by the old character-to-token mapping of the preprocessing
+    (squad_preprocess.get_char_word_loc_mapping) and by its linear-time replacement (get_char_word_offsets
+    and char_to_token), on all the answers of a SQuAD JSON file, and the time each takes.
+    The contexts are tokenized first, outside of the timings.
+    """
+    from preprocessing.squad_preprocess import data_from_json, tokenize, get_char_word_loc_mapping, get_char_word_offsets, char_to_token
+
+    json_path = args.json_path or os.path.join(DEFAULT_DATA_DIR, "train-v1.1.json")
+    dataset = data_from_json(json_path)
+    paragraphs = []
+    print "Tokenizing the contexts of %s..." % json_path
+    for article in dataset['data']:
+        for para in article['paragraphs']:
+            # The same context normalization as squad_preprocess.preprocess_article
+            context = unicode(para['context']).replace("''", '" ').replace("``", '" ')
+            context_tokens = tokenize(context)
+            answers = [(qn['answers'][0]['answer_start'], len(qn['answers'][0]['text'])) for qn in para['qas']]
+            paragraphs.append((context.lower(), context_tokens, answers))
+
+    def spans_mapping():
+        spans = []
+        for (context, context_tokens, answers) in paragraphs:
+            mapping = get_char_word_loc_mapping(context, context_tokens)
+            for (start, length) in answers:
+                spans.append(None if mapping is None else (mapping.get(start, (None, None))[1], mapping.get(start + length - 1, (None, None))[1]))
+        return spans
+
+    def spans_offsets():
+        def lookup(offsets, char_loc):
+            try:
+                return char_to_token(offsets, char_loc)
+            except KeyError:
+                return None
+        spans = []
+        for (context, context_tokens, answers) in paragraphs:
+            offsets = get_char_word_offsets(context, context_tokens)
+            for (start, length) in answers:
+                spans.append(None if offsets is None else (lookup(offsets, start), lookup(offsets, start + length - 1)))
+        return spans
+
+    print "%-10s %10s" % ("method", "seconds")
+    results = {}
+    for (method, get_spans) in (("mapping", spans_mapping), ("offsets", spans_offsets)):
+        tic = time.time()
+        results[method] = get_spans()
+        seconds = time.time() - tic
+        print "%-10s %10.2f" % (method, seconds)
+
+    num_diff = sum(a != b for (a, b) in zip(results["mapping"], results["offsets"]))
+    print "%i answers, %i different spans" % (len(results["mapping"]), num_diff)
+
+
+def bench_tokenizer(args):
+    """
+    Compares the tokenizers of --tokenizer (squad_preprocess.TOKENIZERS) on the contexts and questions of a SQuAD JSON file:
+    their throughput, the texts which the regex tokenizer tokenizes differently from nltk, and the number of examples
+    each makes squad_preprocess discard because the answer spans don't align with the tokens.
+    """
+    from preprocessing.squad_preprocess import iter_articles, iter_paragraphs, preprocess_article, TOKENIZERS
+
+    json_path = args.json_path or os.path.join(DEFAULT_DATA_DIR, "dev-v1.1.json")
+    articles = list(iter_articles(json_path))
+    texts = []
+    for (article, paragraph, qas) in iter_paragraphs(articles):
+        # The same context normalization as squad_preprocess.preprocess_article
+        texts.append(unicode(paragraph['context']).replace("''", '" ').replace("``", '" '))
+        texts.extend(unicode(qn['question']) for qn in qas)
+    num_examples = sum(len(qas) for (_, _, qas) in iter_paragraphs(articles))
+
+    print "%i texts, %i examples in %s" % (len(texts), num_examples, json_path)
+    print "%-10s %10s %10s %12s %30s" % ("tokenizer", "seconds", "texts/s", "tokens/s", "discarded (mapping/token/span)")
+    tokens = {}
+    for name in ("nltk", "regex"):
+        tokenizer = TOKENIZERS[name]
+        try:
+            tic = time.time()
+            tokens[name] = [tokenizer(text) for text in texts]
+            seconds = time.time() - tic
+        except LookupError: # the nltk data isn't installed
+            print "%-10s skipped: the nltk punkt data isn't installed" % name
+            continue
+        discarded = [sum(counts) for counts in zip(*[preprocess_article(article, tokenizer)[1] for article in articles])]
+        print "%-10s %10.2f %10.0f %12.0f %30s" % (name, seconds, len(texts) / seconds, sum(len(t) for t in tokens[name]) / seconds,
+                                                  "%i (%.2f%%): %i/%i/%i" % (sum(discarded), 100. * sum(discarded) / num_examples, discarded[0], discarded[1], discarded[2]))
+
+    if len(tokens) == 2:
+        mismatches = [(text, expected, actual) for (text, expected, actual) in zip(texts, tokens["nltk"], tokens["regex"]) if expected != actual]
+        print "%i texts (%.2f%%) tokenized differently" % (len(mismatches), 100. * len(mismatches) / len(texts))
+        for (text, expected, actual) in mismatches[:args.num_mismatches]:
+            # Show the tokens around the first difference
+            first = next(i for (i, (a, b)) in enumerate(zip(expected + [None], actual + [None])) if a != b)
+            print "  nltk: %s\n  regex: %s" % (" ".join(expected[max(first-5, 0):first+5]), " ".join(actual[max(first-5, 0):first+5]))
+
+
+def bench_answers(args):
+    """
+    Compares detokenizing the answers of official_eval mode (MosesDetokenizer, as the code used to)
+    and slicing them from the original contexts (official_eval_helper.get_answer), on the first gold answer
+    of each question of a SQuAD JSON file: the time per answer, and how many answers are the same text
+    as the gold answer, exactly and after the normalization of the official evaluation.
+    The contexts are tokenized first, outside of the timings.
+    """
+    from nltk.tokenize.moses import MosesDetokenizer
+    from evaluate import normalize_answer
+    from official_eval_helper import tokenize_context, get_answer
+    from preprocessing.squad_preprocess import iter_articles, iter_paragraphs, TOKENIZERS, get_char_word_offsets, char_to_token
+
+    json_path = args.json_path or os.path.join(DEFAULT_DATA_DIR, "dev-v1.1.json")
+    print "Tokenizing the contexts of %s..." % json_path
+    examples = [] # (context_tokens, context_offsets, start, end, gold answer)
+    for (article, paragraph, qas) in iter_paragraphs(iter_articles(json_path)):
+        context_tokens, context_offsets = tokenize_context(paragraph['context'], TOKENIZERS[args.tokenizer], return_offsets=True)
+        # The answer spans as in squad_preprocess.preprocess_article
+        alignment = get_char_word_offsets(context_offsets[0].replace("''", '" ').replace("``", '" ').lower(), context_tokens)
+        if alignment is None:
+            continue
+        for qn in qas:
+            answer = qn['answers'][0]
+            try:
+                start = char_to_token(alignment, answer['answer_start'])
+                end = char_to_token(alignment, answer['answer_start'] + len(answer['text']) - 1)
+            except KeyError:
+                continue
+            examples.append((context_tokens, context_offsets, start, end, answer['text']))
+
+    detokenizer = MosesDetokenizer()
+    methods = [("detokenize", lambda tokens, offsets, start, end: detokenizer.detokenize(tokens[start : end + 1], return_str=True)),
+               ("slice", get_answer)]
+    print "%i answers" % len(examples)
+    print "%-12s %10s %14s %10s %12s" % ("method", "seconds", "us/answer", "exact", "normalized")
+    for (method, answer_fn) in methods:
+        tic = time.time()
+        answers = [answer_fn(tokens, offsets, start, end) for (tokens, offsets, start, end, _) in examples]
+        seconds = time.time() - tic
+        num_exact = sum(answer == gold for (answer, (_, _, _, _, gold)) in zip(answers, examples))
+        num_normalized = sum(normalize_answer(answer) == normalize_answer(gold) for (answer, (_, _, _, _, gold)) in zip(answers, examples))
+        print "%-12s %10.2f %14.1f %10i %12i" % (method, seconds, seconds * 1e6 / len(examples), num_exact, num_normalized)
+
+
+def bench_eval_pipeline(args):
+    """
+    Compares the official_eval answering throughput (examples per second of official_eval_helper.generate_answers)
+    with the batches built, run and decoded in turn, and pipelined with several numbers of decoding threads
+    (see --prefetch_workers in main.py), on a SQuAD JSON file, and checks that the answers are the same.
+    The model is the checkpoint of --ckpt_load_dir if given (in main_args), otherwise randomly initialized.
+    """
+    main, model_classes, emb_matrix, word2id, id2word = load_main(args.main_args)
+    import tensorflow as tf
+    from official_eval_helper import get_json_data, generate_answers
+    FLAGS = main.FLAGS
+
+    json_path = args.json_path or os.path.join(DEFAULT_DATA_DIR, "dev-v1.1.json")
+    qn_uuid_data, context_token_data, qn_token_data, context_offset_data = get_json_data(json_path, FLAGS.tokenize_cache_dir, main.TOKENIZERS[FLAGS.tokenizer])
+
+    qa_model = model_classes[FLAGS.model_name](FLAGS, id2word, word2id, emb_matrix)
+    with tf.Session() as sess:
+        if FLAGS.ckpt_load_dir:
+            main.initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+        else:
+            sess.run(tf.global_variables_initializer(), qa_model.get_initializer_feed())
+
+        print "%-10s %10s %14s %10s %10s" % ("workers", "seconds", "examples/sec", "speedup", "same")
+        expected, baseline_speed = None, None
+        for num_workers in [0] + [int(n) for n in args.num_workers.split(",")]:
+            for _ in xrange(args.num_runs):
+                tic = time.time()
+                answers = generate_answers(sess, qa_model, word2id, qn_uuid_data, context_token_data, qn_token_data,
+                                           verbose=False, context_offset_data=context_offset_data, num_workers=num_workers)
+                seconds = time.time() - tic
+            expected = expected or answers
+            speed = len(qn_uuid_data) / seconds
+            baseline_speed = baseline_speed or speed
+            print "%-10i %10.2f %14.1f %9.2fx %10s" % (num_workers, seconds, speed, speed / baseline_speed, answers == expected)
+
+
+def bench_batch_build(args):
+    """
+    Measures the time to build the padded ids and masks of a batch (contexts and questions),
+    with Python lists (as the code used to), with new numpy arrays per batch,
+    and with the preallocated buffers of data_batcher.BatchAssembler.
+    Uses random ids with SQuAD-like lengths.
+    """
+    from data_batcher import BatchAssembler
+    from vocab import PAD_ID
+
+    rng = np.random.RandomState(0)
+    num_examples = args.batch_size * args.num_batches
+    sequences = {}
+    for (name, low, high) in (("context", 20, args.context_len), ("qn", 3, args.question_len)):
+        lens = rng.randint(low, high + 1, size=num_examples).astype(np.int32)
+        offsets = np.concatenate([[0], np.cumsum(lens, dtype=np.int64)])
+        sequences[name] = (rng.randint(2, 100000, size=offsets[-1]).astype(np.int32), offsets, lens)
+    batches = [rng.choice(num_examples, args.batch_size, replace=False) for _ in xrange(args.num_batches)]
+
+    def build_lists(idx, name, width, assembler, slot):
+        flat_ids, offsets, lens = sequences[name]
+        rows = []
+        for i in idx:
+            ids = flat_ids[offsets[i]:offsets[i]+lens[i]].tolist()[:width]
+            rows.append(ids + [PAD_ID] * (width - len(ids)))
+        ids = np.array(rows)
+        return ids, (ids != PAD_ID).astype(np.int32)
+
+    def build_arrays(idx, name, width, assembler, slot):
+        flat_ids, offsets, lens = sequences[name]
+        lens = np.minimum(lens[idx], width)
+        ids = np.full((len(idx), width), PAD_ID, dtype=np.int32)
+        rows = np.repeat(np.arange(len(idx)), lens)
+        cols = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+        ids[rows, cols] = flat_ids[np.repeat(offsets[idx], lens) + cols]
+        return ids, (ids != PAD_ID).astype(np.int32)
+
+    def build_assembler(idx, name, width, assembler, slot):
+        flat_ids, offsets, lens = sequences[name]
+        return assembler.pad(slot, name, flat_ids, offsets[idx], lens[idx], width)
+
+    print "%-12s %16s" % ("method", "ms per batch")
+    results = {}
+    for (method, build) in (("lists", build_lists), ("arrays", build_arrays), ("assembler", build_assembler)):
+        assembler = BatchAssembler(num_slots=args.num_slots)
+        tic = time.time()
+        for idx in batches:
+            slot = assembler.next_slot()
+            results[method] = [build(idx, "context", args.context_len, assembler, slot), build(idx, "qn", args.question_len, assembler, slot)]
+        print "%-12s %16.3f" % (method, (time.time() - tic) * 1000. / args.num_batches)
+
+    # All the methods build the same arrays (checked on the last batch)
+    for method in ("arrays", "assembler"):
+        for (expected, result) in zip(results["lists"], results[method]):
+            assert all(np.array_equal(a, b) for (a, b) in zip(expected, result))
+
+
+def setup_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers()
+
+    embeddings = subparsers.add_parser("embeddings", help=bench_embeddings.__doc__)
+    embeddings.set_defaults(func=bench_embeddings)
+    embeddings.add_argument("--embedding_size", type=int, default=100)
+    embeddings.add_argument("--glove_path", default="")
+    embeddings.add_argument("--num_rows", type=int, default=20000, help="Number of rows used to measure the reconstruction error")
+    embeddings.add_argument("--ckpt_load_dir", default="", help="Checkpoint to run official_eval with, e.g. experiments/stack/best_checkpoint")
+    embeddings.add_argument("--json_in_path", default="", help="e.g. data/tiny-dev.json")
+    embeddings.add_argument("main_args", nargs="*", help="Extra flags for main.py, after --, e.g. -- --model_name=stack")
+
+    padding = subparsers.add_parser("padding", help=bench_padding.__doc__)
+    padding.set_defaults(func=bench_padding)
+    padding.add_argument("--model_names", default="baseline,bidaf,selfattn,stack,pointer", help="Comma-separated list of models to compare")
+    padding.add_argument("--bucket_width", type=int, default=20)
+    padding.add_argument("--num_batches", type=int, default=50, help="Number of timed training batches")
+    padding.add_argument("--warmup_batches", type=int, default=5)
+    padding.add_argument("main_args", nargs="*", help="Extra flags for main.py, after --, e.g. -- --batch_size=50")
+
+    input_pipeline = subparsers.add_parser("input_pipeline", help=bench_input_pipeline.__doc__)
+    input_pipeline.set_defaults(func=bench_input_pipeline)
+    input_pipeline.add_argument("--model_names", default="baseline,bidaf,selfattn,stack,pointer", help="Comma-separated list of models to compare")
+    input_pipeline.add_argument("--num_batches", type=int, default=50, help="Number of timed training batches")
+    input_pipeline.add_argument("--warmup_batches", type=int, default=5)
+    input_pipeline.add_argument("main_args", nargs="*", help="Extra flags for main.py, after --, e.g. -- --batch_size=50")
+
+    alignment = subparsers.add_parser("alignment", help=bench_alignment.__doc__)
+    alignment.set_defaults(func=bench_alignment)
+    alignment.add_argument("--json_path", default="", help="SQuAD JSON file. Defaults to data/train-v1.1.json")
+
+    tokenizer = subparsers.add_parser("tokenizer", help=bench_tokenizer.__doc__)
+    tokenizer.set_defaults(func=bench_tokenizer)
+    tokenizer.add_argument("--json_path", default="", help="SQuAD JSON file. Defaults to data/dev-v1.1.json")
+    tokenizer.add_argument("--num_mismatches", type=int, default=20, help="Number of differently tokenized texts to show")
+
+    answers = subparsers.add_parser("answers", help=bench_answers.__doc__)
+    answers.set_defaults(func=bench_answers)
+    answers.add_argument("--json_path", default="", help="SQuAD JSON file. Defaults to data/dev-v1.1.json")
+    answers.add_argument("--tokenizer", default="nltk", help="nltk / regex (see --tokenizer in main.py)")
+
+    eval_pipeline = subparsers.add_parser("eval_pipeline", help=bench_eval_pipeline.__doc__)
+    eval_pipeline.set_defaults(func=bench_eval_pipeline)
+    eval_pipeline.add_argument("--json_path", default="", help="SQuAD JSON file. Defaults to data/dev-v1.1.json")
+    eval_pipeline.add_argument("--num_workers", default="1,2,4", help="Comma-separated numbers of decoding threads to compare with no pipelining")
+    eval_pipeline.add_argument("--num_runs", type=int, default=2, help="Runs of each setting, the last one is timed (the first ones warm up)")
+    eval_pipeline.add_argument("main_args", nargs="*", help="Flags for main.py, after --, e.g. -- --model_name=stack --ckpt_load_dir=experiments/stack/best_checkpoint")
+
+    batch_build = subparsers.add_parser("batch_build", help=bench_batch_build.__doc__)
+    batch_build.set_defaults(func=bench_batch_build)
+    batch_build.add_argument("--batch_size", type=int, default=100)
+    batch_build.add_argument("--context_len", type=int, default=400)
+    batch_build.add_argument("--question_len", type=int, default=30)
+    batch_build.add_argument("--num_batches", type=int, default=200)
+    batch_build.add_argument("--num_slots", type=int, default=10, help="Number of BatchAssembler slots")
+
+    return parser.parse_args()
+
+
+def main():
+    args = setup_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains code to compile the tokenized {train/dev}.{context/question/span}
+data files into flat binary arrays of word ids, so that the batcher can read them
+through np.memmap instead of re-parsing the text every epoch"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import json
+import time
+import shutil
+import tempfile
+from array import array
+
+import numpy as np
+
+from data_shards import first_path, all_paths, open_data
+
+# Bump this whenever the layout of the compiled data changes
+COMPILED_DATA_VERSION = 1
+
+# The arrays making up a compiled split, saved as {name}.npy
+ARRAY_NAMES = ["context_ids", "context_sids", "context_offsets", "context_lens",
+               "qn_ids", "qn_sids", "qn_offsets", "qn_lens",
+               "ans_span", "strings"]
+
+
+def compiled_dir(context_path):
+    """
+    Returns the directory holding the compiled versions of a split, e.g. data/train.compiled for data/train.context.
+    All the shards of a split (see data_shards.py) are compiled together, in the directory of the first one.
+    """
+    return os.path.splitext(first_path(context_path))[0] + ".compiled"
+
+
+def vocab_compiled_dir(context_path, word2id):
+    """
+    Returns the directory holding the version of a split compiled with the vocabulary word2id,
+    e.g. data/train.compiled/<vocab fingerprint>
+    """
+    return os.path.join(compiled_dir(context_path), word2id.fingerprint())
+
+
+def replace_dir(src, dst):
+    """
+    Moves the directory src to dst, replacing dst if it exists.
+
+    The old dst is renamed away before being deleted, so dst is never a mix of both,
+    and processes that memory-mapped its files keep reading them (they are unlinked, not truncated).
+    If another process put a dst in place first, src is deleted instead.
+    """
+    stale_dir = None
+    if os.path.exists(dst):
+        stale_dir = tempfile.mkdtemp(dir=os.path.dirname(dst), prefix=".stale-")
+        os.rename(dst, os.path.join(stale_dir, os.path.basename(dst)))
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        shutil.rmtree(src)
+    if stale_dir is not None:
+        shutil.rmtree(stale_dir)
+
+
+def source_fingerprint(paths):
+    """Returns a fingerprint of the source data files (and of all their shards), from their sizes and modification times"""
+    return [[os.path.basename(path), os.path.getsize(path), int(os.path.getmtime(path))] for path in all_paths(paths)]
+
+
+class CompiledSplit(object):
+    """
+    A compiled {train/dev} split, memory-mapped from disk.
+
+    Contexts and questions are stored as flat int32 arrays with an offsets index:
+    the word ids of context i are context_ids[context_offsets[i]:context_offsets[i+1]],
+    and the token strings (for F1/EM) are strings[context_sids[...]] with the same offsets.
+    """
+
+    def __init__(self, out_dir):
+        self.path = out_dir
+        for name in ARRAY_NAMES:
+            setattr(self, name, np.load(os.path.join(out_dir, name + ".npy"), mmap_mode='r'))
+        self.num_examples = len(self.ans_span)
+
+    def context_tokens(self, idx):
+        """Returns the context tokens (list of strings) of example idx"""
+        return self.strings[self.context_sids[self.context_offsets[idx]:self.context_offsets[idx+1]]].tolist()
+
+    def qn_tokens(self, idx):
+        """Returns the question tokens (list of strings) of example idx"""
+        return self.strings[self.qn_sids[self.qn_offsets[idx]:self.qn_offsets[idx+1]]].tolist()
+
+
+def compile_split(word2id, context_path, qn_path, ans_path, out_dir):
+    """
+    Compiles the tokenized data files of a split into out_dir.
+
+    Inputs:
+      word2id: Vocab mapping word (string) to word id (int)
+      context_path, qn_path, ans_path: paths to {train/dev}.{context/question/span} data files (or lists of the paths of their shards)
+      out_dir: directory to write the compiled arrays to. Any previous content is replaced once the compilation is complete.
+
+    Examples with an ill-formed gold span are dropped, as in data_batcher.refill_batches.
+    """
+    print "Compiling %s, %s, %s into %s..." % (context_path, qn_path, ans_path, out_dir)
+    tic = time.time()
+
+    sid_of_string = {} # maps token string to its index in the strings table
+    context_sids, qn_sids = array('i'), array('i')
+    context_lens, qn_lens, ans_span = array('i'), array('i'), array('i')
+    num_illformed = 0
+
+    with open_data(context_path) as context_file, open_data(qn_path) as qn_file, open_data(ans_path) as ans_file:
+        for context_line, qn_line, ans_line in zip(context_file, qn_file, ans_file):
+            # Same tokenization as data_batcher.split_by_whitespace and intstr_to_intlist
+            span = [int(s) for s in ans_line.split()]
+            assert len(span) == 2
+            if span[1] < span[0]:
+                num_illformed += 1
+                continue
+
+            context_tokens = context_line.split()
+            qn_tokens = qn_line.split()
+            context_sids.extend(sid_of_string.setdefault(w, len(sid_of_string)) for w in context_tokens)
+            qn_sids.extend(sid_of_string.setdefault(w, len(sid_of_string)) for w in qn_tokens)
+            context_lens.append(len(context_tokens))
+            qn_lens.append(len(qn_tokens))
+            ans_span.extend(span)
+
+    strings = [None] * len(sid_of_string)
+    for (w, sid) in sid_of_string.iteritems():
+        strings[sid] = w
+
+    # Convert the string table to word ids once, then map every token through it
+    string_ids = word2id.lookup(strings)
+
+    arrays = {}
+    for (prefix, sids, lens) in (("context", context_sids, context_lens), ("qn", qn_sids, qn_lens)):
+        sids = np.frombuffer(sids, dtype=np.int32) if len(sids) else np.zeros(0, dtype=np.int32)
+        lens = np.array(lens, dtype=np.int32)
+        arrays[prefix + "_sids"] = sids
+        arrays[prefix + "_ids"] = string_ids[sids]
+        arrays[prefix + "_lens"] = lens
+        arrays[prefix + "_offsets"] = np.concatenate([[0], np.cumsum(lens, dtype=np.int64)])
+    arrays["ans_span"] = np.array(ans_span, dtype=np.int32).reshape((-1, 2))
+    arrays["strings"] = np.array(strings, dtype=np.string_)
+
+    # The arrays are written to a temporary directory which then replaces out_dir, so that an interrupted
+    # compilation never looks complete, and the arrays of a previous compilation are never overwritten in place
+    parent_dir = os.path.dirname(os.path.abspath(out_dir))
+    if not os.path.exists(parent_dir):
+        os.makedirs(parent_dir)
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix=".tmp-")
+    try:
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(tmp_dir, name + ".npy"), arrays[name])
+        with open(os.path.join(tmp_dir, "meta.json"), 'w') as fh:
+            json.dump({"version": COMPILED_DATA_VERSION,
+                       "vocab_fingerprint": word2id.fingerprint(),
+                       "sources": source_fingerprint([context_path, qn_path, ans_path]),
+                       "num_examples": len(arrays["ans_span"])}, fh)
+    except BaseException:
+        shutil.rmtree(tmp_dir)
+        raise
+    replace_dir(tmp_dir, out_dir)
+
+    toc = time.time()
+    if num_illformed:
+        print "Dropped %i examples with an ill-formed gold span" % num_illformed
+    print "Compiled %i examples in %.2f seconds" % (len(arrays["ans_span"]), toc-tic)
+
+
+def load_compiled(word2id, context_path, qn_path, ans_path):
+    """
+    Returns the CompiledSplit for the given data files, compiling them first
+    if there is no version compiled with this vocabulary, or if it was compiled from other files.
+    """
+    out_dir = vocab_compiled_dir(context_path, word2id)
+    meta_path = os.path.join(out_dir, "meta.json")
+
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path) as fh:
+            meta = json.load(fh)
+
+    if meta is None or meta.get("version") != COMPILED_DATA_VERSION or \
+            meta.get("vocab_fingerprint") != word2id.fingerprint() or \
+            meta.get("sources") != source_fingerprint([context_path, qn_path, ans_path]):
+        compile_split(word2id, context_path, qn_path, ans_path, out_dir)
+
+    return CompiledSplit(out_dir)
@@ -21,16 +21,24 @@ from __future__ import division
 import random
 import time
 import re
+import logging
+import threading
+from functools import partial
+from array import array
+from random import Random, getrandbits
+from six.moves import queue
 
 import numpy as np
 from six.moves import xrange
-from vocab import PAD_ID, UNK_ID
+from vocab import PAD_ID
+from compiled_data import load_compiled, source_fingerprint
+from data_shards import open_data
 
 
 class Batch(object):
     """A class to hold the information needed for a training batch"""
 
-    def __init__(self, context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens, ans_span, ans_tokens, uuids=None):
+    def __init__(self, context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens, ans_span, ans_tokens, uuids=None, iter_state=None, context_offsets=None):
         """
         Inputs:
           {context/qn}_ids: Numpy arrays.
@@ -41,6 +49,11 @@ class Batch(object):
           ans_span: numpy array, shape (batch_size, 2)
           uuid: a list (length batch_size) of strings.
             Not needed for training. Used by official_eval mode.
+          iter_state: the state of the batch generator once this batch is consumed,
+            from which it can be resumed (see get_batch_jobs). Used to checkpoint training.
+          context_offsets: a list (length batch_size) of (context, offsets) pairs: the original context string
+            and the character span of each token in it (see official_eval_helper.tokenize_context).
+            Not needed for training. Used by official_eval mode to slice the answers from the contexts.
         """
         self.context_ids = context_ids
         self.context_mask = context_mask
@@ -54,6 +67,8 @@ class Batch(object):
         self.ans_tokens = ans_tokens
 
         self.uuids = uuids
+        self.iter_state = iter_state
+        self.context_offsets = context_offsets
 
         self.batch_size = len(self.context_tokens)
 
@@ -70,80 +85,302 @@ def intstr_to_intlist(string):
     return [int(s) for s in string.split()]
 
 
-def sentence_to_token_ids(sentence, word2id):
-    """Turns an already-tokenized sentence string into word indices
-    e.g. "i do n't know" -> [9, 32, 16, 96]
-    Note any token that isn't in the word2id mapping gets mapped to the id for UNK
+def order_examples(context_lens, qn_lens, bucket_width, dorandom, rng=random):
     """
-    tokens = split_by_whitespace(sentence) # list of strings
-    ids = [word2id.get(w, UNK_ID) for w in tokens]
-    return tokens, ids
+    Returns the order (array of indices) in which to put the examples of a refill into batches.
 
+    Inputs:
+      context_lens, qn_lens: int arrays. The lengths of the contexts and questions
+      bucket_width: int. If nonzero, group the examples into buckets of contexts of similar length
+        (lengths within bucket_width of each other), in random order within each bucket,
+        so that the batches need little padding with dynamic padding.
+        If 0, sort by question length instead.
+      dorandom: If False, keep the examples in their original order.
+      rng: random.Random (or the random module) used to break ties within buckets
+    """
+    if not dorandom:
+        return np.arange(len(context_lens))
+
+    if bucket_width > 0:
+        # Note: the random order within buckets avoids batches made of the same context many times
+        # (each context appears several times, with different questions)
+        tiebreak = np.array([rng.random() for _ in xrange(len(context_lens))])
+        return np.lexsort((tiebreak, np.asarray(context_lens) // bucket_width))
+
+    # Sort by question length
+    # Note: if you sort by context length, then you'll have batches which contain the same context many times (because each context appears several times, with different questions)
+    return np.argsort(qn_lens, kind='mergesort')
 
-def padded(token_batch, batch_pad=0):
+
+def split_into_batches(order, padded_lens, batch_size, max_batch_cost=0, cost_exponent=1):
     """
+    Splits the ordered examples of a refill into batches.
+
     Inputs:
-      token_batch: List (length batch size) of lists of ints.
-      batch_pad: Int. Length to pad to. If 0, pad to maximum length sequence in token_batch.
+      order: array of example indices, in the order to batch them
+      padded_lens: int array. The length each context will be padded to
+        (its length with dynamic padding, context_len otherwise)
+      batch_size: int. Number of examples per batch, if max_batch_cost is 0
+      max_batch_cost: int. If nonzero, make each batch as large as possible without its cost going over
+        max_batch_cost (a single example is always a batch), rather than batch_size examples.
+        The cost of a batch is num_examples * max_padded_len ** cost_exponent, i.e. the number of
+        padded context tokens for cost_exponent=1, or the size of a (context_len x context_len) self-attention for 2.
+      cost_exponent: 1 or 2, see max_batch_cost
+
+    Returns:
+      list of arrays of example indices
+    """
+    if max_batch_cost <= 0:
+        return [order[batch_start:batch_start+batch_size] for batch_start in xrange(0, len(order), batch_size)]
+
+    batches = []
+    batch_start, batch_width = 0, 0
+    for (pos, example) in enumerate(order):
+        batch_width = max(batch_width, padded_lens[example])
+        if pos > batch_start and (pos - batch_start + 1) * batch_width ** cost_exponent > max_batch_cost:
+            batches.append(order[batch_start:pos])
+            batch_start, batch_width = pos, padded_lens[example]
+    if batch_start < len(order):
+        batches.append(order[batch_start:])
+    return batches
+
+
+class BatchAssembler(object):
+    """
+    Builds the padded id and mask arrays of batches.
+
+    The arrays are written directly into preallocated int32 buffers, which are reused from batch to batch:
+    the buffers are organized in num_slots slots, and each batch is built in the next slot (see next_slot).
+    The arrays returned are views of the buffers of their slot, so they are overwritten when the slot is reused:
+    there must be more slots than batches in use at once (e.g. the prefetched batches plus the one being run).
+    With num_slots=0, new arrays are allocated for every batch.
+    """
+
+    def __init__(self, num_slots=0):
+        self.num_slots = num_slots
+        self._buffers = [{} for _ in xrange(num_slots)] # for each slot, maps buffer name to a flat array
+        self._next_slot = 0
+
+    def next_slot(self):
+        """Returns the slot to build the next batch in. Call it from one thread, in batch order."""
+        if self.num_slots == 0:
+            return None
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self.num_slots
+        return slot
+
+    def _buffer(self, slot, name, shape, dtype=np.int32):
+        """Returns an array of the given shape, using (and growing if needed) the buffer name of the slot"""
+        if slot is None:
+            return np.empty(shape, dtype=dtype)
+        size = shape[0] * shape[1]
+        buf = self._buffers[slot].get(name)
+        if buf is None or buf.size < size:
+            buf = self._buffers[slot][name] = np.empty(size, dtype=dtype)
+        return buf[:size].reshape(shape)
+
+    def pad(self, slot, name, flat_ids, offsets, lens, width):
+        """
+        Builds the padded ids and the mask of a batch of sequences, in the buffers name of the slot.
+
+        Inputs:
+          slot: from next_slot
+          name: string. Identifies the buffers in the slot, e.g. "context"
+          flat_ids: int32 array holding the sequences one after the other
+          offsets: int array shape (n). Where each sequence starts in flat_ids
+          lens: int array shape (n). The length of each sequence
+          width: int. Length to pad (and truncate) the sequences to
+
+        Returns:
+          ids: int32 array shape (n, width). Padded with PAD_ID
+          mask: int32 array shape (n, width). 1s where there is real data, 0s where there is padding
+        """
+        n = len(lens)
+        ids = self._buffer(slot, name + "_ids", (n, width))
+        mask = self._buffer(slot, name + "_mask", (n, width))
+        if n * width == 0:
+            return ids, mask
+
+        positions = np.arange(width)
+        np.less(positions, np.asarray(lens)[:, None], out=mask) # mask from the lengths
+
+        # Read each row from its offset. Positions past the end of a sequence read
+        # other data (or are clipped to the end of flat_ids), and are zeroed by the mask
+        flat_positions = self._buffer(slot, name + "_positions", (n, width), dtype=np.int64)
+        np.add(np.asarray(offsets)[:, None], positions, out=flat_positions)
+        np.take(flat_ids, flat_positions, out=ids, mode='clip')
+        ids *= mask # PAD_ID is 0
+        return ids, mask
+
+
+class ExamplePool(object):
+    """
+    The examples read by one call to refill_batches.
+    They are stored like a CompiledSplit (flat arrays of word ids with offsets and lengths),
+    so that batches are assembled in the same way from both.
+    """
+
+    def __init__(self, word2id, context_tokens, qn_tokens, ans_span):
+        """
+        Inputs:
+          word2id: Vocab
+          context_tokens, qn_tokens: lists of lists of strings
+          ans_span: list of [start, end] pairs
+        """
+        self._context_tokens = context_tokens
+        self._qn_tokens = qn_tokens
+        self.context_ids, self.context_offsets, self.context_lens = flatten_ids(word2id, context_tokens)
+        self.qn_ids, self.qn_offsets, self.qn_lens = flatten_ids(word2id, qn_tokens)
+        self.ans_span = np.array(ans_span, dtype=np.int32).reshape((-1, 2)) # shape (num_examples, 2)
+        self.num_examples = len(ans_span)
+
+    def context_tokens(self, idx):
+        return self._context_tokens[idx]
+
+    def qn_tokens(self, idx):
+        return self._qn_tokens[idx]
+
+
+def flatten_ids(word2id, token_lists):
+    """
+    Converts lists of tokens to one flat array of word ids.
+    Note any token that isn't in the vocabulary gets mapped to the id for UNK
+
     Returns:
-      List (length batch_size) of padded of lists of ints.
-        All are same length - batch_pad if batch_pad!=0, otherwise the maximum length in token_batch
+      flat_ids: int32 array. The ids of all the lists, one after the other
+      offsets: int64 array shape (len(token_lists) + 1). List i is flat_ids[offsets[i]:offsets[i+1]]
+      lens: int32 array shape (len(token_lists)). The length of each list
+    """
+    lens = np.array([len(tokens) for tokens in token_lists], dtype=np.int32)
+    offsets = np.concatenate([[0], np.cumsum(lens, dtype=np.int64)])
+    flat_ids = word2id.lookup([w for tokens in token_lists for w in tokens])
+    return flat_ids, offsets, lens
+
+
+def context_windows(num_tokens, context_len, window_stride):
+    """
+    Returns the start positions of the windows of context_len tokens that cover a context of num_tokens tokens:
+    one every window_stride tokens, plus one ending at the last token. A context that fits in context_len has one window.
+    """
+    if num_tokens <= context_len:
+        return [0]
+    return range(0, num_tokens - context_len, window_stride) + [num_tokens - context_len]
+
+
+class WindowedSplit(object):
+    """
+    Windows of the examples of a CompiledSplit or ExamplePool, as examples of their own (see window_examples).
+    Window i is context tokens window_starts[i]:window_starts[i]+context_len of example example_idx[i],
+    with the same question and the answer span shifted into the window.
     """
-    maxlen = max(map(lambda x: len(x), token_batch)) if batch_pad == 0 else batch_pad
-    return map(lambda token_list: token_list + [PAD_ID] * (maxlen - len(token_list)), token_batch)
 
+    def __init__(self, split, example_idx, window_starts, context_len):
+        self._split = split
+        self.example_idx = np.asarray(example_idx, dtype=np.int64)
+        self.window_starts = np.asarray(window_starts, dtype=np.int64)
+        self._context_len = context_len
+        self.context_ids = split.context_ids
+        self.context_offsets = split.context_offsets[self.example_idx] + self.window_starts
+        self.context_lens = np.minimum(split.context_lens[self.example_idx] - self.window_starts, context_len).astype(np.int32)
+        self.qn_ids = split.qn_ids
+        self.qn_offsets = split.qn_offsets[self.example_idx]
+        self.qn_lens = split.qn_lens[self.example_idx]
+        self.ans_span = (split.ans_span[self.example_idx] - self.window_starts[:, None]).astype(np.int32)
+        self.num_examples = len(self.example_idx)
+
+    def context_tokens(self, idx):
+        start = self.window_starts[idx]
+        return self._split.context_tokens(self.example_idx[idx])[start : start + self._context_len]
+
+    def qn_tokens(self, idx):
+        return self._split.qn_tokens(self.example_idx[idx])
+
+
+def window_examples(split, idx, context_len, window_stride):
+    """
+    Splits the examples idx of split whose context is longer than context_len into overlapping windows
+    (see context_windows), and keeps the windows which contain the whole answer.
+    The other examples are kept whole. Examples whose answer doesn't fit in any window are dropped.
 
-def refill_batches(batches, word2id, context_file, qn_file, ans_file, batch_size, context_len, question_len, discard_long, dorandom=True):
+    Returns:
+      a WindowedSplit of the kept windows, in the order of idx
+    """
+    example_idx, window_starts = [], []
+    for i in idx:
+        ans_start, ans_end = split.ans_span[i]
+        for start in context_windows(int(split.context_lens[i]), context_len, window_stride):
+            if start <= ans_start and ans_end < start + context_len:
+                example_idx.append(i)
+                window_starts.append(start)
+    return WindowedSplit(split, example_idx, window_starts, context_len)
+
+
+def add_batches(batches, split, idx, batch_size, context_len, question_len, dorandom, dynamic_padding, bucket_width, max_batch_cost, cost_exponent, rng=random):
+    """
+    Orders the examples idx of split (see order_examples), splits them into batches (see split_into_batches),
+    and adds them to the list batches as (split, batch_idx) pairs, to be made into Batches by make_batch.
+    """
+    # Order by the truncated lengths
+    context_lens = np.minimum(split.context_lens[idx], context_len)
+    order = order_examples(context_lens, np.minimum(split.qn_lens[idx], question_len), bucket_width, dorandom, rng)
+
+    padded_lens = context_lens if dynamic_padding else np.full_like(context_lens, context_len)
+    for batch_order in split_into_batches(order, padded_lens, batch_size, max_batch_cost, cost_exponent):
+        batches.append((split, idx[batch_order]))
+
+    # shuffle the batches
+    if dorandom:
+        rng.shuffle(batches)
+
+
+def refill_batches(batches, word2id, context_file, qn_file, ans_file, batch_size, context_len, question_len, discard_long, dorandom=True, dynamic_padding=False, bucket_width=0, max_batch_cost=0, cost_exponent=1, rng=random, window_stride=0):
     """
     Adds more batches into the "batches" list.
 
     Inputs:
       batches: list to add batches to
-      word2id: dictionary mapping word (string) to word id (int)
+      word2id: Vocab mapping word (string) to word id (int)
       context_file, qn_file, ans_file: paths to {train/dev}.{context/question/answer} data files
       batch_size: int. how big to make the batches
       context_len, question_len: max length of context and question respectively
       discard_long: If True, discard any examples that are longer than context_len or question_len.
         If False, truncate those exmaples instead.
+      dorandom: If True, shuffle the batches (and sort or bucket the examples, see order_examples)
+      dynamic_padding: If True, pad each batch to its longest context and question (at most context_len and question_len)
+        rather than to context_len and question_len.
+      bucket_width: see order_examples
+      max_batch_cost, cost_exponent: see split_into_batches
+      rng: random.Random (or the random module) to shuffle with
+      window_stride: If nonzero, the examples with a context longer than context_len aren't discarded or truncated,
+        but split into windows of context_len tokens every window_stride tokens (see window_examples)
     """
     print "Refilling batches..."
     tic = time.time()
-    examples = [] # list of (qn_ids, context_ids, ans_span, ans_tokens) triples
+    examples = [] # list of (context_tokens, qn_tokens, ans_span) tuples
     context_line, qn_line, ans_line = context_file.readline(), qn_file.readline(), ans_file.readline() # read the next line from each
 
     while context_line and qn_line and ans_line: # while you haven't reached the end
 
-        # Convert tokens to word ids
-        context_tokens, context_ids = sentence_to_token_ids(context_line, word2id)
-        qn_tokens, qn_ids = sentence_to_token_ids(qn_line, word2id)
+        # Split into tokens
+        context_tokens = split_by_whitespace(context_line)
+        qn_tokens = split_by_whitespace(qn_line)
         ans_span = intstr_to_intlist(ans_line)
 
         # read the next line from each file
         context_line, qn_line, ans_line = context_file.readline(), qn_file.readline(), ans_file.readline()
 
-        # get ans_tokens from ans_span
         assert len(ans_span) == 2
         if ans_span[1] < ans_span[0]:
             print "Found an ill-formed gold span: start=%i end=%i" % (ans_span[0], ans_span[1])
             continue
-        ans_tokens = context_tokens[ans_span[0] : ans_span[1]+1] # list of strings
 
-        # discard or truncate too-long questions
-        if len(qn_ids) > question_len:
-            if discard_long:
-                continue
-            else: # truncate
-                qn_ids = qn_ids[:question_len]
-
-        # discard or truncate too-long contexts
-        if len(context_ids) > context_len:
-            if discard_long:
-                continue
-            else: # truncate
-                context_ids = context_ids[:context_len]
+        # discard too-long questions and contexts
+        # (if discard_long is False, they are truncated when the batches are padded, unless the contexts are split into windows)
+        if discard_long and (len(qn_tokens) > question_len or (len(context_tokens) > context_len and not window_stride)):
+            continue
 
         # add to examples
-        examples.append((context_ids, context_tokens, qn_ids, qn_tokens, ans_span, ans_tokens))
+        examples.append((context_tokens, qn_tokens, ans_span))
 
         # stop refilling if you have 160 batches
         if len(examples) == batch_size * 160:
@@ -151,73 +388,361 @@ def refill_batches(batches, word2id, context_file, qn_file, ans_file, batch_size
 
     # Once you've either got 160 batches or you've reached end of file:
 
-    # Sort by question length
-    # Note: if you sort by context length, then you'll have batches which contain the same context many times (because each context appears several times, with different questions)
-    if dorandom:
-        examples = sorted(examples, key=lambda e: len(e[2]))
+    # Convert all the tokens to word ids at once
+    context_tokens, qn_tokens, ans_span = [list(x) for x in zip(*examples)] if examples else ([], [], [])
+    pool = ExamplePool(word2id, context_tokens, qn_tokens, ans_span)
+    idx = np.arange(pool.num_examples)
+    if window_stride:
+        pool = window_examples(pool, idx, context_len, window_stride)
+        idx = np.arange(pool.num_examples)
 
     # Make into batches and append to the list batches
-    for batch_start in xrange(0, len(examples), batch_size):
+    add_batches(batches, pool, idx, batch_size, context_len, question_len, dorandom, dynamic_padding, bucket_width, max_batch_cost, cost_exponent, rng)
 
-        # Note: each of these is a list length batch_size of lists of ints (except on last iter when it might be less than batch_size)
-        context_ids_batch, context_tokens_batch, qn_ids_batch, qn_tokens_batch, ans_span_batch, ans_tokens_batch = zip(*examples[batch_start:batch_start+batch_size])
+    toc = time.time()
+    print "Refilling batches took %.2f seconds" % (toc-tic)
+    return
 
-        batches.append((context_ids_batch, context_tokens_batch, qn_ids_batch, qn_tokens_batch, ans_span_batch, ans_tokens_batch))
 
-    # shuffle the batches
-    if dorandom:
-        random.shuffle(batches)
+def refill_batches_compiled(batches, split, position, batch_size, context_len, question_len, discard_long, dorandom=True, dynamic_padding=False, bucket_width=0, max_batch_cost=0, cost_exponent=1, rng=random, order=None, window_stride=0):
+    """
+    Adds more batches into the "batches" list, reading from a compiled split instead of text files.
+    Produces the same batches as refill_batches when reading in file order.
+
+    Inputs:
+      batches: list to add batches to
+      split: CompiledSplit
+      position: index in order of the next example to read from split
+      batch_size, context_len, question_len, discard_long, dorandom,
+        dynamic_padding, bucket_width, max_batch_cost, cost_exponent, rng, window_stride: as in refill_batches
+      order: the order (permutation of the example indices) in which to read the examples.
+        If None, read them in file order.
+
+    Returns:
+      the new position in order
+    """
+    print "Refilling batches..."
+    tic = time.time()
+
+    # Take the next batch_size * 160 examples, skipping the too-long ones if discard_long
+    positions = np.arange(position, split.num_examples)
+    idx = positions if order is None else order[positions]
+    if discard_long:
+        keep = ((split.context_lens[idx] <= context_len) | (window_stride > 0)) & (split.qn_lens[idx] <= question_len)
+        positions, idx = positions[keep], idx[keep]
+    positions, idx = positions[:batch_size * 160], idx[:batch_size * 160]
+    new_position = positions[-1] + 1 if len(idx) == batch_size * 160 else split.num_examples
+    if window_stride:
+        split = window_examples(split, idx, context_len, window_stride)
+        idx = np.arange(split.num_examples)
+
+    add_batches(batches, split, idx, batch_size, context_len, question_len, dorandom, dynamic_padding, bucket_width, max_batch_cost, cost_exponent, rng)
 
     toc = time.time()
     print "Refilling batches took %.2f seconds" % (toc-tic)
+    return new_position
+
+
+def make_batch(split, batch_idx, context_len, question_len, dynamic_padding=False, assembler=None, slot=None, iter_state=None):
+    """
+    Makes a Batch from the examples batch_idx of a CompiledSplit or ExamplePool.
+
+    Inputs:
+      split: CompiledSplit or ExamplePool
+      batch_idx: array of example indices
+      context_len, question_len, dynamic_padding: see refill_batches
+      assembler, slot: BatchAssembler to build the ids and masks in, and its slot for this batch.
+        If None, the arrays are newly allocated.
+      iter_state: the iter_state of the Batch (see get_batch_jobs)
+    """
+    assembler = assembler or BatchAssembler()
+    context_lens = split.context_lens[batch_idx]
+    qn_lens = split.qn_lens[batch_idx]
+    if dynamic_padding:
+        context_len = min(context_len, context_lens.max())
+        question_len = min(question_len, qn_lens.max())
+
+    context_ids, context_mask = assembler.pad(slot, "context", split.context_ids, split.context_offsets[batch_idx], context_lens, context_len)
+    qn_ids, qn_mask = assembler.pad(slot, "qn", split.qn_ids, split.qn_offsets[batch_idx], qn_lens, question_len)
+
+    context_tokens = [split.context_tokens(i) for i in batch_idx]
+    qn_tokens = [split.qn_tokens(i) for i in batch_idx]
+    ans_span = np.array(split.ans_span[batch_idx]) # shape (batch_size, 2)
+    ans_tokens = [tokens[start : end+1] for (tokens, (start, end)) in zip(context_tokens, ans_span)]
+
+    return Batch(context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens, ans_span, ans_tokens, iter_state=iter_state)
+
+
+def index_lines(path):
+    """Returns an int64 array of the byte offsets of the lines of a file (or of the shards of a data file, see data_shards.py)"""
+    offsets = array('l')
+    position = 0
+    with open_data(path) as fh:
+        for line in fh:
+            offsets.append(position)
+            position += len(line)
+    return np.frombuffer(offsets, dtype=np.int_).astype(np.int64) if len(offsets) else np.zeros(0, dtype=np.int64)
+
+
+class ShuffledLines(object):
+    """
+    Reads the lines of a file in a given order, seeking to each line through an index of their byte offsets,
+    so that only the index is held in memory. It has the readline, tell and seek methods used by refill_batches,
+    with positions in the order rather than byte offsets.
+    """
+
+    def __init__(self, path, line_offsets, order):
+        self._file = open_data(path)
+        self._line_offsets = line_offsets
+        self._order = order
+        self._position = 0
+
+    def readline(self):
+        if self._position >= len(self._order):
+            return ""
+        self._file.seek(self._line_offsets[self._order[self._position]])
+        self._position += 1
+        return self._file.readline()
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position):
+        self._position = position
+
+
+def get_batch_jobs(word2id, context_path, qn_path, ans_path, batch_size, context_len, question_len, discard_long, random=True, compiled=False, dynamic_padding=False, bucket_width=0, max_batch_cost=0, cost_exponent=1, assembler=None, resume_state=None, global_shuffle=False, window_stride=0):
+    """
+    This function returns a generator object that yields batch jobs:
+    functions taking no arguments which return the next Batch.
+    Reading and refilling happen in the generator, while the per-batch work
+    (padding, masks) is left to the jobs, so that it can run in other threads (see BatchPrefetcher).
+
+    Each Batch records in iter_state the state of the generator after it: the seed of the epoch's
+    order of the examples (with global_shuffle), the position in the data where its refill started,
+    the state of the random generator before that refill, and the number
+    of batches of the refill up to this one. Passing it as resume_state starts a new generator
+    (with the same data and arguments) right after that batch, by redoing the refill and skipping
+    the batches already done. The state is a dict that can be saved as JSON.
+    It also records the data files (see compiled_data.source_fingerprint) and the batching arguments:
+    a resume_state saved with other data (e.g. after incremental preprocessing replaced a shard)
+    or other arguments is ignored, with a log message, and the generator starts from the beginning.
+
+    The other inputs are as for get_batch_generator.
+    """
+    assembler = assembler or BatchAssembler()
+    rng = Random(getrandbits(64)) # seeded from the global random generator, so that random.seed applies
+    order_seed = rng.getrandbits(32) if random and global_shuffle else None
+    num_skip = 0 # number of batches to skip in the next refill
+    paths = [context_path, qn_path, ans_path]
+    sources = source_fingerprint(paths)
+    batching = {"batch_size": batch_size, "context_len": context_len, "question_len": question_len, "discard_long": discard_long,
+                "random": random, "compiled": compiled, "dynamic_padding": dynamic_padding, "bucket_width": bucket_width,
+                "max_batch_cost": max_batch_cost, "cost_exponent": cost_exponent, "global_shuffle": global_shuffle, "window_stride": window_stride}
+    if resume_state is not None and (resume_state.get("sources") != sources or resume_state.get("batching") != batching):
+        logging.info("The saved position in the data is for other data files or batching arguments: starting from the beginning")
+        resume_state = None
+    if resume_state is not None:
+        order_seed = resume_state.get("order_seed")
+        version, internal_state, gauss = resume_state["rng_state"]
+        rng.setstate((version, tuple(internal_state), gauss))
+        num_skip = resume_state["num_batches"]
+
+    # With global_shuffle, the examples are read in a random order over the whole epoch,
+    # from an index of the examples, and the refills group them by length within each pool
+    if compiled:
+        split = load_compiled(word2id, context_path, qn_path, ans_path)
+        order = None if order_seed is None else np.random.RandomState(order_seed).permutation(split.num_examples)
+        position = 0
+    elif order_seed is None:
+        files = [open_data(path) for path in paths]
+        position = [0, 0, 0]
+    else:
+        line_offsets = [index_lines(path) for path in paths]
+        order = np.random.RandomState(order_seed).permutation(min(len(offsets) for offsets in line_offsets))
+        files = [ShuffledLines(path, offsets, order) for (path, offsets) in zip(paths, line_offsets)]
+        position = [0, 0, 0]
+    if resume_state is not None:
+        position = resume_state["position"]
+    batches = []
+    num_done = 0 # number of batches of the current refill already yielded
+
+    while True:
+        if len(batches) == 0: # add more batches
+            refill_position, refill_rng_state = position, rng.getstate()
+            if compiled:
+                position = refill_batches_compiled(batches, split, position, batch_size, context_len, question_len, discard_long, random, dynamic_padding, bucket_width, max_batch_cost, cost_exponent, rng, order, window_stride)
+            else:
+                for (f, offset) in zip(files, position):
+                    f.seek(offset)
+                refill_batches(batches, word2id, files[0], files[1], files[2], batch_size, context_len, question_len, discard_long, random, dynamic_padding, bucket_width, max_batch_cost, cost_exponent, rng, window_stride)
+                position = [f.tell() for f in files]
+            if len(batches) == 0:
+                break
+
+            # When resuming, skip the batches that were done before the state was saved
+            del batches[:num_skip]
+            num_done, num_skip = num_skip, 0
+            if len(batches) == 0:
+                continue
+
+        (batch_split, batch_idx) = batches.pop(0)
+        num_done += 1
+        iter_state = {"compiled": compiled, "order_seed": order_seed, "position": refill_position, "rng_state": refill_rng_state, "num_batches": num_done,
+                      "sources": sources, "batching": batching}
+        yield partial(make_batch, batch_split, batch_idx, context_len, question_len, dynamic_padding, assembler, assembler.next_slot(), iter_state)
+
     return
 
 
-def get_batch_generator(word2id, context_path, qn_path, ans_path, batch_size, context_len, question_len, discard_long, random=True):
+def get_batch_generator(word2id, context_path, qn_path, ans_path, batch_size, context_len, question_len, discard_long, random=True, compiled=False, dynamic_padding=False, bucket_width=0, max_batch_cost=0, cost_exponent=1, assembler=None, resume_state=None, global_shuffle=False, window_stride=0):
     """
     This function returns a generator object that yields batches.
     The last batch in the dataset will be a partial batch.
     Read this to understand generators and the yield keyword in Python: https://stackoverflow.com/questions/231767/what-does-the-yield-keyword-do
 
     Inputs:
-      word2id: dictionary mapping word (string) to word id (int)
-      context_file, qn_file, ans_file: paths to {train/dev}.{context/question/answer} data files
+      word2id: Vocab mapping word (string) to word id (int)
+      context_file, qn_file, ans_file: paths to {train/dev}.{context/question/answer} data files,
+        or lists of the paths of the same file in each shard of the split (see data_shards.py)
       batch_size: int. how big to make the batches
       context_len, question_len: max length of context and question respectively
       discard_long: If True, discard any examples that are longer than context_len or question_len.
         If False, truncate those exmaples instead.
       random: is the dataset shuffled ?
+      compiled: If True, read the examples from the compiled binary version of the data files
+        (see compiled_data.py), compiling it first if needed, instead of parsing the text.
+      dynamic_padding: If True, pad each batch only to its longest context and question.
+        Otherwise pad all the batches to context_len and question_len.
+      bucket_width: If nonzero (and random), batch together contexts of similar length. See order_examples.
+      max_batch_cost, cost_exponent: If max_batch_cost is nonzero, fill the batches up to a cost
+        (e.g. number of padded context tokens) rather than to batch_size examples. See split_into_batches.
+      assembler: BatchAssembler to build the batch arrays in. By default, each batch gets new arrays.
+      resume_state: If not None, the iter_state of a Batch from an earlier generator with the same arguments:
+        start right after that batch. See get_batch_jobs.
+      global_shuffle: If True (and random), read the examples in a random order over the whole epoch,
+        rather than shuffling only within each refill of batch_size * 160 examples read in file order.
+        Uses an index of the line offsets of the text files (or the index of the compiled data).
+      window_stride: If nonzero, split the contexts longer than context_len into overlapping windows,
+        keeping those that contain the answer, rather than discarding or truncating them. See window_examples.
     """
-    context_file, qn_file, ans_file = open(context_path), open(qn_path), open(ans_path)
-    batches = []
+    for job in get_batch_jobs(word2id, context_path, qn_path, ans_path, batch_size, context_len, question_len, discard_long, random, compiled, dynamic_padding, bucket_width, max_batch_cost, cost_exponent, assembler, resume_state, global_shuffle, window_stride):
+        yield job()
 
-    while True:
-        if len(batches) == 0: # add more batches
-            refill_batches(batches, word2id, context_file, qn_file, ans_file, batch_size, context_len, question_len, discard_long, random)
-        if len(batches) == 0:
-            break
-
-        # Get next batch. These are all lists length batch_size
-        (context_ids, context_tokens, qn_ids, qn_tokens, ans_span, ans_tokens) = batches.pop(0)
-
-        # Pad context_ids and qn_ids
-        qn_ids = padded(qn_ids, question_len) # pad questions to length question_len
-        context_ids = padded(context_ids, context_len) # pad contexts to length context_len
-
-        # Make qn_ids into a np array and create qn_mask
-        qn_ids = np.array(qn_ids) # shape (question_len, batch_size)
-        qn_mask = (qn_ids != PAD_ID).astype(np.int32) # shape (question_len, batch_size)
+    return
 
-        # Make context_ids into a np array and create context_mask
-        context_ids = np.array(context_ids) # shape (context_len, batch_size)
-        context_mask = (context_ids != PAD_ID).astype(np.int32) # shape (context_len, batch_size)
 
-        # Make ans_span into a np array
-        ans_span = np.array(ans_span) # shape (batch_size, 2)
+class BatchPrefetcher(object):
+    """
+    Iterates over the Batches of a get_batch_jobs generator, building them ahead of time.
 
-        # Make into a Batch object
-        batch = Batch(context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens, ans_span, ans_tokens)
+    A reader thread runs the generator (reading the files and refilling batches),
+    and num_workers threads run the batch jobs, so that batches are prepared while
+    the caller runs the TensorFlow step. At most max_batches batches are in flight
+    (queued or built but not yet consumed), and they are returned in their original order.
+    With num_workers=0 there are no threads: the batches are built when they are requested.
 
-        yield batch
+    Use as a context manager, or call close(), to stop the threads if you stop iterating early.
+    wait_time is the total time (seconds) the consumer spent waiting for the next batch.
+    """
 
-    return
+    def __init__(self, batch_jobs, num_workers=1, max_batches=8):
+        self.wait_time = 0.
+        self.num_batches = 0
+
+        self._batch_jobs = batch_jobs
+        self._slots = threading.Semaphore(max_batches) # limits the batches in flight
+        self._job_queue = queue.Queue()
+        self._done = {} # maps job number to its (batch, exception)
+        self._done_cond = threading.Condition()
+        self._num_jobs = None # set by the reader when the generator is exhausted
+        self._stopped = threading.Event()
+
+        self._threads = []
+        if num_workers > 0:
+            self._threads.append(threading.Thread(target=self._read))
+            self._threads += [threading.Thread(target=self._work) for _ in xrange(num_workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _read(self):
+        """Reader thread: numbers the jobs from the generator and queues them"""
+        job_num = 0
+        try:
+            for job in self._batch_jobs:
+                while not self._slots.acquire(False): # wait for a free slot, unless stopped
+                    if self._stopped.wait(0.01):
+                        return
+                self._job_queue.put((job_num, job))
+                job_num += 1
+        except Exception as e:
+            self._finish(job_num, None, e)
+            job_num += 1
+        finally:
+            with self._done_cond:
+                self._num_jobs = job_num
+                self._done_cond.notify_all()
+            for _ in self._threads[1:]:
+                self._job_queue.put(None) # tell the workers to exit
+
+    def _work(self):
+        """Worker thread: builds Batches from the queued jobs"""
+        while True:
+            item = self._job_queue.get()
+            if item is None or self._stopped.is_set():
+                return
+            job_num, job = item
+            try:
+                self._finish(job_num, job(), None)
+            except Exception as e:
+                self._finish(job_num, None, e)
+
+    def _finish(self, job_num, batch, exception):
+        with self._done_cond:
+            self._done[job_num] = (batch, exception)
+            self._done_cond.notify_all()
+
+    def __iter__(self):
+        if not self._threads: # no prefetching
+            tic = time.time()
+            for job in self._batch_jobs:
+                batch = job()
+                self.wait_time += time.time() - tic
+                self.num_batches += 1
+                yield batch
+                tic = time.time()
+            return
+
+        try:
+            while True:
+                tic = time.time()
+                with self._done_cond:
+                    while self.num_batches not in self._done and self._num_jobs != self.num_batches:
+                        self._done_cond.wait()
+                    if self.num_batches not in self._done: # all the jobs have been consumed
+                        return
+                    batch, exception = self._done.pop(self.num_batches)
+                self.wait_time += time.time() - tic
+                self._slots.release()
+                self.num_batches += 1
+                if exception is not None:
+                    raise exception
+                yield batch
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops the reader and worker threads"""
+        self._stopped.set()
+        for _ in self._threads[1:]:
+            self._job_queue.put(None)
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
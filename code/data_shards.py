@@ -0,0 +1,108 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains code to read a split of the preprocessed data that is stored in several shards:
+the {train/dev}.{context/question/answer/span} files, plus the {train/dev}.shard<N>.* files
+that incremental preprocessing adds for new or changed articles (see preprocessing/squad_preprocess.py).
+
+Wherever the data code takes the path of a data file, it also takes a list of paths:
+the same file of each shard, read one after the other as if they were a single file."""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import json
+from bisect import bisect_right
+
+# The manifest of a split, written by squad_preprocess.preprocess_incremental. Its "shards" entry lists
+# the file name prefixes of the shards, e.g. ["train", "train.shard1"]
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+def shard_paths(data_dir, tier, name):
+    """
+    Returns the path(s) of a data file of a split, e.g. data/train.context for tier "train" and name "context".
+    If the manifest of the split lists several shards, returns the list of the paths of that file in each shard.
+    """
+    prefixes = [tier]
+    manifest_path = os.path.join(data_dir, tier + MANIFEST_SUFFIX)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as fh:
+            prefixes = json.load(fh)["shards"] or prefixes
+    paths = [os.path.join(data_dir, prefix + "." + name) for prefix in prefixes]
+    return paths[0] if len(paths) == 1 else paths
+
+
+def first_path(path):
+    """Returns the path of the first shard of a data path (see the module docstring)"""
+    return path if isinstance(path, basestring) else path[0]
+
+
+def all_paths(paths):
+    """Returns the list of the files of a list of data paths, with the shards of each"""
+    return [p for path in paths for p in ([path] if isinstance(path, basestring) else path)]
+
+
+class ConcatenatedFile(object):
+    """
+    Reads a list of files as one, with the readline, tell and seek methods and the iteration of a file.
+    Positions are byte offsets in the concatenation of the files.
+    """
+
+    def __init__(self, paths):
+        self._paths = paths
+        self._starts = [0]
+        for path in paths:
+            self._starts.append(self._starts[-1] + os.path.getsize(path))
+        self._index = 0
+        self._file = open(paths[0])
+
+    def _open(self, index):
+        self._file.close()
+        self._index = index
+        self._file = open(self._paths[index])
+
+    def readline(self):
+        while True:
+            line = self._file.readline()
+            if line or self._index == len(self._paths) - 1:
+                return line
+            self._open(self._index + 1)
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def tell(self):
+        return self._starts[self._index] + self._file.tell()
+
+    def seek(self, position):
+        index = min(bisect_right(self._starts, position) - 1, len(self._paths) - 1)
+        if index != self._index:
+            self._open(index)
+        self._file.seek(position - self._starts[index])
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_data(path):
+    """Opens a data path (see the module docstring) for reading"""
+    return open(path) if isinstance(path, basestring) else ConcatenatedFile(path)
@@ -0,0 +1,161 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This code is required for "export" mode in main.py, and for answering with its output in official_eval and serve modes.
+
+export_bundle writes a model as a single file: a GraphDef of the inference-only graph of the model
+(see inference_only in QAModel), with the weights of the checkpoint and the embedding matrix folded in as constants.
+Only the ops needed to compute the start and end distributions are kept: there are no dropout ops, shape assertions,
+loss, gradients, optimizer slots, global_step or summaries. The vocabulary and a description of the bundle
+(the names of the input and output tensors, and the flags of the model) are stored in it as string constants,
+so FrozenQAModel loads it without reading the GloVe file or building the model in Python."""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import json
+
+import tensorflow as tf
+
+from qa_model import QAModel
+from vocab import Vocab
+
+# Bump this whenever the layout of the bundle changes
+BUNDLE_VERSION = 1
+
+# The string constants holding the description of the bundle (JSON) and the vocabulary (in id order)
+INFO_NODE = "bundle_info"
+VOCAB_NODE = "bundle_vocab"
+
+# The graph of the bundle is imported under this name scope
+IMPORT_SCOPE = "frozen"
+
+INPUT_NAMES = ["context_ids", "context_mask", "qn_ids", "qn_mask"]
+OUTPUT_NAMES = ["probdist_start", "probdist_end"]
+
+# The flags describing the model, recorded in the bundle
+MODEL_FLAGS = ["model_name", "context_len", "question_len", "embedding_size", "emb_dtype", "hidden_size", "num_layers", "rnn_cell", "selfattn_size"]
+
+
+def export_bundle(session, model, bundle_path):
+    """
+    Writes the model to bundle_path (see the module docstring).
+
+    Inputs:
+      session: TensorFlow session, with the model's checkpoint restored and its embeddings initialized
+      model: QAModel, preferably built with inference_only=True (otherwise the dropout ops stay in the bundle)
+      bundle_path: path of the file to write
+
+    Returns:
+      the size of the bundle in bytes
+    """
+    output_ops = [getattr(model, name).op.name for name in OUTPUT_NAMES]
+    graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), output_ops)
+    graph_def = strip_asserts(graph_def, output_ops)
+
+    info = {
+        "version": BUNDLE_VERSION,
+        "inputs": {name: getattr(model, name).name for name in INPUT_NAMES},
+        "outputs": {name: getattr(model, name).name for name in OUTPUT_NAMES},
+        "flags": {name: getattr(model.FLAGS, name) for name in MODEL_FLAGS if hasattr(model.FLAGS, name)},
+    }
+    with tf.Graph().as_default() as graph:
+        tf.constant(json.dumps(info), name=INFO_NODE)
+        tf.constant(model.id2word, dtype=tf.string, name=VOCAB_NODE)
+    graph_def.node.extend(graph.as_graph_def().node)
+
+    # Written to a temporary file then renamed, so that an interrupted export is never read
+    data = graph_def.SerializeToString()
+    with open(bundle_path + ".tmp", 'wb') as fh:
+        fh.write(data)
+    os.rename(bundle_path + ".tmp", bundle_path)
+    return len(data)
+
+
+def strip_asserts(graph_def, output_ops):
+    """
+    Returns graph_def without its Assert ops, and without the ops that only computed their conditions.
+    The tf.assert_equal ops of modules.py are already left out by convert_variables_to_constants since nothing depends
+    on them, but tf.nn.dynamic_rnn adds an assertion on the shape of sequence_length as a control dependency.
+    """
+    asserts = set(node.name for node in graph_def.node if node.op == "Assert")
+    stripped = tf.GraphDef()
+    stripped.versions.CopyFrom(graph_def.versions)
+    for node in graph_def.node:
+        if node.name in asserts:
+            continue
+        new_node = stripped.node.add()
+        new_node.CopyFrom(node)
+        del new_node.input[:]
+        new_node.input.extend(inp for inp in node.input if inp.lstrip("^") not in asserts)
+    return tf.graph_util.extract_sub_graph(stripped, output_ops)
+
+
+def read_bundle(bundle_path):
+    """
+    Reads a file written by export_bundle.
+
+    Returns:
+      graph_def: GraphDef of the model, without the description and vocabulary constants
+      info: dict. The description of the bundle
+      words: list of strings. The vocabulary, in id order
+    """
+    bundle_def = tf.GraphDef()
+    with open(bundle_path, 'rb') as fh:
+        bundle_def.ParseFromString(fh.read())
+
+    constants = {node.name: tf.make_ndarray(node.attr["value"].tensor) for node in bundle_def.node if node.name in (INFO_NODE, VOCAB_NODE)}
+    if INFO_NODE not in constants:
+        raise Exception("%s is not a bundle written by export mode" % bundle_path)
+    info = json.loads(constants[INFO_NODE].item())
+    if info["version"] != BUNDLE_VERSION:
+        raise Exception("%s was exported with bundle version %i, but this code reads version %i: export it again" % (bundle_path, info["version"], BUNDLE_VERSION))
+
+    graph_def = tf.GraphDef()
+    graph_def.versions.CopyFrom(bundle_def.versions)
+    graph_def.node.extend(node for node in bundle_def.node if node.name not in constants)
+    return graph_def, info, constants[VOCAB_NODE].tolist()
+
+
+class FrozenQAModel(QAModel):
+    """
+    A model loaded from a bundle written by export_bundle, into the default graph.
+    It has the inference methods of QAModel (get_prob_dists, get_start_end_pos), so it can be used
+    by official_eval_helper and serving.py, but it can't be trained. Its weights are constants:
+    there's no checkpoint to restore or embedding matrix to initialize.
+    """
+
+    def __init__(self, FLAGS, bundle_path):
+        """
+        Inputs:
+          FLAGS: the flags passed in from main.py. The batching and answer selection flags apply
+            (batch_size, context_len, question_len, select_mode, window_stride...); the model flags come from the bundle.
+          bundle_path: path of the bundle
+        """
+        print "Loading the model from %s..." % bundle_path
+        graph_def, self.info, words = read_bundle(bundle_path)
+        self.FLAGS = FLAGS
+        self.word2id = Vocab(words)
+        self.id2word = self.word2id.id2word
+        self.inference_only = True
+
+        tf.import_graph_def(graph_def, name=IMPORT_SCOPE)
+        graph = tf.get_default_graph()
+        for (name, tensor_name) in self.info["inputs"].items() + self.info["outputs"].items():
+            setattr(self, name, graph.get_tensor_by_name(IMPORT_SCOPE + "/" + tensor_name))
+        print "Loaded a %s model with a vocabulary of %i words" % (self.info["flags"].get("model_name", "?"), len(words))
+
+    def initialize_embeddings(self, session):
+        pass # the embeddings are constants of the graph
@@ -32,8 +32,12 @@ from qa_baseline_model import QABaselineModel
 from qa_selfattn_model import QASelfAttnModel
 from qa_stack_model import QAStackModel
 from qa_pointer_model import QAPointerModel
-from vocab import get_glove
+from vocab import get_glove, prune_vocab, select_vocab, read_vocab, write_vocab, vocab_fingerprint, VOCAB_FILENAME
 from official_eval_helper import get_json_data, generate_answers, generate_distributions, generate_answers_from_dist
+from serving import serve
+from frozen_model import FrozenQAModel, export_bundle
+from preprocessing.squad_preprocess import TOKENIZERS
+from data_shards import shard_paths, all_paths
 
 
 logging.basicConfig(level=logging.INFO)
@@ -44,7 +48,7 @@ EXPERIMENTS_DIR = os.path.join(MAIN_DIR, "experiments") # relative path of exper
 
 # High-level options
 tf.app.flags.DEFINE_integer("gpu", 0, "Which GPU to use, if you have multiple.")
-tf.app.flags.DEFINE_string("mode", "train", "Available modes: train / show_examples / official_eval / getinfo")
+tf.app.flags.DEFINE_string("mode", "train", "Available modes: train / show_examples / official_eval / serve / export / getinfo")
 tf.app.flags.DEFINE_string("experiment_name", "", "Unique name for your experiment. This will create a directory by this name in the experiments/ directory, which will hold all data related to this experiment")
 tf.app.flags.DEFINE_integer("num_epochs", 0, "Number of epochs to train. 0 means train indefinitely")
 
@@ -63,7 +67,12 @@ tf.app.flags.DEFINE_integer("batch_size", 100, "Batch size to use")
 tf.app.flags.DEFINE_integer("hidden_size", 200, "Size of the hidden states")
 tf.app.flags.DEFINE_integer("context_len", 400, "The maximum context length of your model")
 tf.app.flags.DEFINE_integer("question_len", 30, "The maximum question length of your model")
+tf.app.flags.DEFINE_integer("window_stride", 0, "If nonzero, contexts longer than context_len are split into overlapping windows of context_len tokens starting every window_stride tokens, instead of being discarded in training and truncated in official_eval mode. Training uses the windows which contain the answer; official_eval picks the best span across the windows (see --max_answer_len).")
+tf.app.flags.DEFINE_integer("max_answer_len", 30, "With --window_stride, the maximum length in tokens of a predicted answer in official_eval mode")
 tf.app.flags.DEFINE_integer("embedding_size", 100, "Size of the pretrained word vectors. This needs to be one of the available GloVe dimensions: 50/100/200/300")
+tf.app.flags.DEFINE_string("emb_dtype", "float32", "How to store the embedding matrix in the graph: float32/float16/int8 (int8 uses a float32 scale per row)")
+tf.app.flags.DEFINE_boolean("prune_vocab", False, "Restrict the vocabulary to the words of the train/dev sets plus the prune_keep_top most frequent GloVe words. The vocabulary is recorded next to the checkpoints.")
+tf.app.flags.DEFINE_integer("prune_keep_top", 20000, "With --prune_vocab, how many of the most frequent GloVe words to keep regardless of the train/dev sets")
 
 # How often to print, save, eval
 tf.app.flags.DEFINE_integer("print_every", 1, "How many iterations to do per print.")
@@ -74,10 +83,28 @@ tf.app.flags.DEFINE_integer("keep", 1, "How many checkpoints to keep. 0 indicate
 # Reading and saving data
 tf.app.flags.DEFINE_string("train_dir", "", "Training directory to save the model parameters and other info. Defaults to experiments/{experiment_name}")
 tf.app.flags.DEFINE_string("glove_path", "", "Path to glove .txt file. Defaults to data/glove.6B.{embedding_size}d.txt")
+tf.app.flags.DEFINE_boolean("glove_cache", True, "Whether to read the GloVe vectors from (and write them to) a binary cache next to glove_path")
 tf.app.flags.DEFINE_string("data_dir", DEFAULT_DATA_DIR, "Where to find preprocessed SQuAD data for training. Defaults to data/")
+tf.app.flags.DEFINE_boolean("dynamic_padding", True, "Pad each batch only to its longest context and question, rather than to context_len and question_len")
+tf.app.flags.DEFINE_integer("bucket_width", 20, "Batch together contexts whose lengths are within bucket_width tokens of each other, to reduce padding. 0 batches by question length instead.")
+tf.app.flags.DEFINE_boolean("global_shuffle", True, "Shuffle the training examples over the whole epoch, through an index of the examples, before grouping them by length in pools of 160 batches. If False, the pools are read in file order and only shuffled within themselves.")
+tf.app.flags.DEFINE_integer("max_batch_tokens", 0, "If nonzero, fill each batch up to this number of padded context tokens instead of batch_size examples. batch_size is then the reference size for weighting the loss of a batch.")
+tf.app.flags.DEFINE_integer("max_batch_attn", 0, "For the models with self-attention (selfattn/stack/pointer): if nonzero, fill each batch up to num_examples * padded_context_len^2 <= max_batch_attn instead (overrides max_batch_tokens)")
+tf.app.flags.DEFINE_integer("prefetch_workers", 2, "Number of threads building batches ahead of the training/eval steps, and in official_eval mode, number of threads decoding the answers while the next batches run (see official_eval_helper.run_pipelined). 0 builds them on demand, with no prefetching or pipelining.")
+tf.app.flags.DEFINE_integer("prefetch_batches", 8, "Maximum number of batches being built or waiting to be used when prefetching")
+tf.app.flags.DEFINE_string("input_pipeline", "feed_dict", "How training batches get into the model: feed_dict (built in Python, see --prefetch_workers) / tfdata (built in the graph by a tf.data pipeline over a TFRecord version of the compiled data; batches by batch_size, without --max_batch_tokens/--max_batch_attn)")
+tf.app.flags.DEFINE_boolean("compiled_data", True, "Whether to read the train/dev data from a binary compiled version (data_dir/{train/dev}.compiled), which is rebuilt when the data or vocabulary change")
 tf.app.flags.DEFINE_string("ckpt_load_dir", "", "For official_eval mode, which directory to load the checkpoint fron. You need to specify this for official_eval mode.")
 tf.app.flags.DEFINE_string("json_in_path", "", "For official_eval mode, path to JSON input file. You need to specify this for official_eval_mode.")
+tf.app.flags.DEFINE_string("tokenize_cache_dir", os.path.join(DEFAULT_DATA_DIR, "tokenize_cache"), "Where to cache the tokenized contexts and questions of the --json_in_path files, keyed by their contents and the tokenizer version. Empty to turn the cache off.")
+tf.app.flags.DEFINE_string("tokenizer", "nltk", "How the --json_in_path contexts and questions are tokenized: nltk (nltk.word_tokenize) / regex (faster approximation of it, see preprocessing/regex_tokenizer.py). Use the tokenizer the training data was preprocessed with.")
 tf.app.flags.DEFINE_string("json_out_path", "predictions.json", "Output path for official_eval mode. Defaults to predictions.json")
+tf.app.flags.DEFINE_string("bundle_path", "", "For export mode, where to write the model of --ckpt_load_dir as a single inference-only file. For official_eval and serve modes, if set, answer with that file instead of --ckpt_load_dir (the GloVe vectors and model flags aren't needed).")
+tf.app.flags.DEFINE_string("serve_host", "127.0.0.1", "For serve mode, the address to listen on")
+tf.app.flags.DEFINE_integer("serve_port", 8000, "For serve mode, the port to listen on")
+tf.app.flags.DEFINE_string("serve_socket", "", "For serve mode, if set, listen on this Unix socket path instead of serve_host:serve_port")
+tf.app.flags.DEFINE_integer("serve_max_batch", 0, "For serve mode, the maximum number of questions answered in one batch. 0 means batch_size.")
+tf.app.flags.DEFINE_float("serve_max_wait_ms", 5.0, "For serve mode, the maximum time a question waits for others to batch with")
 tf.app.flags.DEFINE_string("ensemble_dir", "", "Directory to put the ensemble outputs.")
 tf.app.flags.DEFINE_string("ensemble_name", "", "Name of the output file containing the probability outputs.")
 
@@ -102,15 +129,50 @@ def initialize_model(session, model, train_dir, expect_exists):
     if ckpt and (tf.gfile.Exists(ckpt.model_checkpoint_path) or tf.gfile.Exists(v2_path)):
         print "Reading model parameters from %s" % ckpt.model_checkpoint_path
         model.saver.restore(session, ckpt.model_checkpoint_path)
+        model.initialize_embeddings(session)
     else:
         if expect_exists:
             raise Exception("There is no saved checkpoint at %s" % train_dir)
         else:
             print "There is no saved checkpoint at %s. Creating model with fresh parameters." % train_dir
-            session.run(tf.global_variables_initializer())
+            session.run(tf.global_variables_initializer(), model.get_initializer_feed())
             print 'Num params: %d' % sum(v.get_shape().num_elements() for v in tf.trainable_variables())
 
 
+def get_vocab_dir(bestmodel_dir):
+    """Returns the checkpoint directory whose recorded vocabulary should be used in this mode (or "" if there is none)"""
+    if FLAGS.mode in ("train", "test"):
+        return FLAGS.train_dir
+    elif FLAGS.mode in ("show_examples", "visualize"):
+        return bestmodel_dir
+    else:
+        return FLAGS.ckpt_load_dir
+
+
+def load_vocab(emb_matrix, word2id, id2word, vocab_dir, corpus_paths):
+    """
+    If a vocabulary is recorded in vocab_dir, restricts emb_matrix, word2id and id2word to it.
+    Otherwise, if --prune_vocab is set, prunes them to the words of corpus_paths.
+
+    Returns:
+      emb_matrix, word2id, id2word
+      vocab_recorded: bool. True if the vocabulary differs from the full GloVe vocabulary,
+        i.e. it needs to be recorded next to the checkpoints.
+    """
+    vocab_path = os.path.join(vocab_dir, VOCAB_FILENAME) if vocab_dir else ""
+    if vocab_path and os.path.exists(vocab_path):
+        print "Using the vocabulary recorded in %s" % vocab_path
+        emb_matrix, word2id, id2word = select_vocab(emb_matrix, word2id, read_vocab(vocab_path))
+        return emb_matrix, word2id, id2word, True
+    elif FLAGS.prune_vocab:
+        if FLAGS.mode not in ("train", "test"):
+            raise Exception("--prune_vocab is set but there is no vocabulary recorded in %s" % vocab_dir)
+        emb_matrix, word2id, id2word = prune_vocab(emb_matrix, word2id, id2word, corpus_paths, FLAGS.prune_keep_top)
+        return emb_matrix, word2id, id2word, True
+    else:
+        return emb_matrix, word2id, id2word, False
+
+
 def main(unused_argv):
     # Print an error message if you've entered flags incorrectly
     if len(unused_argv) != 1:
@@ -125,45 +187,75 @@ def main(unused_argv):
 
     # Define train_dir
     if not FLAGS.experiment_name and not FLAGS.train_dir and \
-            FLAGS.mode != "official_eval" and FLAGS.mode!= "ensemble_write" and FLAGS.mode!= "ensemble_predict":
+            FLAGS.mode not in ("official_eval", "serve", "export", "ensemble_write", "ensemble_predict"):
         raise Exception("You need to specify either --experiment_name or --train_dir")
     FLAGS.train_dir = FLAGS.train_dir or os.path.join(EXPERIMENTS_DIR, FLAGS.experiment_name)
 
+    if FLAGS.input_pipeline not in ("feed_dict", "tfdata"):
+        raise Exception("Unknown --input_pipeline %s: use feed_dict or tfdata" % FLAGS.input_pipeline)
+    if FLAGS.input_pipeline == "tfdata" and (FLAGS.max_batch_tokens or FLAGS.max_batch_attn):
+        raise Exception("--input_pipeline=tfdata makes batches of batch_size examples: it can't be used with --max_batch_tokens or --max_batch_attn")
+    if FLAGS.bundle_path and FLAGS.mode not in ("official_eval", "serve", "export"):
+        raise Exception("--bundle_path is only used by the export, official_eval and serve modes")
+    if FLAGS.window_stride < 0 or FLAGS.window_stride > FLAGS.context_len:
+        raise Exception("--window_stride must be between 0 and --context_len, so that the windows cover the contexts")
+    if FLAGS.window_stride and FLAGS.input_pipeline == "tfdata":
+        raise Exception("--window_stride isn't supported with --input_pipeline=tfdata, which discards the long contexts")
+    if FLAGS.window_stride and FLAGS.mode in ("ensemble_write", "ensemble_predict"):
+        raise Exception("--window_stride isn't supported in the ensemble modes, whose distributions are over the truncated contexts")
+    if FLAGS.tokenizer not in TOKENIZERS:
+        raise Exception("Unknown --tokenizer %s: use %s" % (FLAGS.tokenizer, " or ".join(sorted(TOKENIZERS))))
+
     # Initialize bestmodel directory
     bestmodel_dir = os.path.join(FLAGS.train_dir, "best_checkpoint")
 
     # Define path for glove vecs
     FLAGS.glove_path = FLAGS.glove_path or os.path.join(DEFAULT_DATA_DIR, "glove.6B.{}d.txt".format(FLAGS.embedding_size))
 
-    # Load embedding matrix and vocab mappings
-    emb_matrix, word2id, id2word = get_glove(FLAGS.glove_path, FLAGS.embedding_size)
-
     # Get filepaths to train/dev datafiles for tokenized queries, contexts and answers
-    train_context_path = os.path.join(FLAGS.data_dir, "train.context")
-    train_qn_path = os.path.join(FLAGS.data_dir, "train.question")
-    train_ans_path = os.path.join(FLAGS.data_dir, "train.span")
-    dev_context_path = os.path.join(FLAGS.data_dir, "dev.context")
-    dev_qn_path = os.path.join(FLAGS.data_dir, "dev.question")
-    dev_ans_path = os.path.join(FLAGS.data_dir, "dev.span")
+    # (lists of paths when incremental preprocessing added shards, see data_shards.py)
+    train_context_path = shard_paths(FLAGS.data_dir, "train", "context")
+    train_qn_path = shard_paths(FLAGS.data_dir, "train", "question")
+    train_ans_path = shard_paths(FLAGS.data_dir, "train", "span")
+    dev_context_path = shard_paths(FLAGS.data_dir, "dev", "context")
+    dev_qn_path = shard_paths(FLAGS.data_dir, "dev", "question")
+    dev_ans_path = shard_paths(FLAGS.data_dir, "dev", "span")
     small_context_path = os.path.join(FLAGS.data_dir, "small.context")
     small_qn_path = os.path.join(FLAGS.data_dir, "small.question")
     small_ans_path = os.path.join(FLAGS.data_dir, "small.span")
-    qa_model=None
-    # Initialize model
-    if FLAGS.model_name == "baseline":
-        print("Using baseline model")
-        qa_model = QABaselineModel(FLAGS, id2word, word2id, emb_matrix)
-    elif FLAGS.model_name == "bidaf":
-        qa_model = QABidafModel(FLAGS, id2word, word2id, emb_matrix)
-    elif FLAGS.model_name == "selfattn":
-        print("Using Self Attention")
-        qa_model = QASelfAttnModel(FLAGS, id2word, word2id, emb_matrix)
-    elif FLAGS.model_name == "stack":
-        print("Using stack BIDAF/SA")
-        qa_model = QAStackModel(FLAGS, id2word, word2id, emb_matrix)
-    elif FLAGS.model_name == "pointer":
-        print ("Using pointer model")
-        qa_model= QAPointerModel(FLAGS, id2word, word2id, emb_matrix)
+
+    if FLAGS.bundle_path and FLAGS.mode != "export":
+        # Load the model exported by export mode, with its vocabulary: there are no GloVe vectors to read or model to build
+        qa_model = FrozenQAModel(FLAGS, FLAGS.bundle_path)
+        word2id = qa_model.word2id
+    else:
+        # export mode builds the inference-only graph of the model
+        inference_only = FLAGS.mode == "export"
+
+        # Load embedding matrix and vocab mappings
+        emb_matrix, word2id, id2word = get_glove(FLAGS.glove_path, FLAGS.embedding_size, use_cache=FLAGS.glove_cache)
+
+        # Use the vocabulary recorded with the checkpoint, or prune the vocabulary for a new model
+        corpus_paths = all_paths([train_context_path, train_qn_path, dev_context_path, dev_qn_path])
+        emb_matrix, word2id, id2word, vocab_recorded = load_vocab(emb_matrix, word2id, id2word, get_vocab_dir(bestmodel_dir), corpus_paths)
+        print "Vocabulary size: %i (fingerprint %s)" % (len(id2word), vocab_fingerprint(id2word))
+
+        qa_model=None
+        # Initialize model
+        if FLAGS.model_name == "baseline":
+            print("Using baseline model")
+            qa_model = QABaselineModel(FLAGS, id2word, word2id, emb_matrix, inference_only)
+        elif FLAGS.model_name == "bidaf":
+            qa_model = QABidafModel(FLAGS, id2word, word2id, emb_matrix, inference_only)
+        elif FLAGS.model_name == "selfattn":
+            print("Using Self Attention")
+            qa_model = QASelfAttnModel(FLAGS, id2word, word2id, emb_matrix, inference_only)
+        elif FLAGS.model_name == "stack":
+            print("Using stack BIDAF/SA")
+            qa_model = QAStackModel(FLAGS, id2word, word2id, emb_matrix, inference_only)
+        elif FLAGS.model_name == "pointer":
+            print ("Using pointer model")
+            qa_model= QAPointerModel(FLAGS, id2word, word2id, emb_matrix, inference_only)
 
     # Some GPU settings
     config=tf.ConfigProto()
@@ -185,6 +277,11 @@ def main(unused_argv):
         if not os.path.exists(bestmodel_dir):
             os.makedirs(bestmodel_dir)
 
+        # Record the vocabulary next to the checkpoints
+        if vocab_recorded:
+            for vocab_dir in (FLAGS.train_dir, bestmodel_dir):
+                write_vocab(os.path.join(vocab_dir, VOCAB_FILENAME), id2word)
+
         with tf.Session(config=config) as sess:
 
             # Load most recent model
@@ -208,6 +305,11 @@ def main(unused_argv):
         if not os.path.exists(bestmodel_dir):
             os.makedirs(bestmodel_dir)
 
+        # Record the vocabulary next to the checkpoints
+        if vocab_recorded:
+            for vocab_dir in (FLAGS.train_dir, bestmodel_dir):
+                write_vocab(os.path.join(vocab_dir, VOCAB_FILENAME), id2word)
+
         with tf.Session(config=config) as sess:
 
             # Load most recent model
@@ -259,7 +361,7 @@ def main(unused_argv):
         if FLAGS.ensemble_name == "":
             raise Exception("For ensembling mode, you need to specify --ensemble_name")
         # Read the JSON data from file
-        qn_uuid_data, context_token_data, qn_token_data = get_json_data(FLAGS.json_in_path)
+        qn_uuid_data, context_token_data, qn_token_data, context_offset_data = get_json_data(FLAGS.json_in_path, FLAGS.tokenize_cache_dir, TOKENIZERS[FLAGS.tokenizer])
 
         with tf.Session(config=config) as sess:
             # Load model
@@ -294,8 +396,8 @@ def main(unused_argv):
             total_dict[key][0]/=len(models)
             total_dict[key][1] /=len(models)
         # Read the JSON data from file
-        qn_uuid_data, context_token_data, qn_token_data = get_json_data(FLAGS.json_in_path)
-        answers_dict = generate_answers_from_dist(None, qa_model, total_dict, word2id, qn_uuid_data, context_token_data, qn_token_data)
+        qn_uuid_data, context_token_data, qn_token_data, context_offset_data = get_json_data(FLAGS.json_in_path, FLAGS.tokenize_cache_dir, TOKENIZERS[FLAGS.tokenizer])
+        answers_dict = generate_answers_from_dist(None, qa_model, total_dict, word2id, qn_uuid_data, context_token_data, qn_token_data, context_offset_data)
 
         # Write the uuid->answer mapping a to json file in root dir
         print "Writing predictions to %s..." % FLAGS.json_out_path
@@ -306,20 +408,21 @@ def main(unused_argv):
     elif FLAGS.mode == "official_eval":
         if FLAGS.json_in_path == "":
             raise Exception("For official_eval mode, you need to specify --json_in_path")
-        if FLAGS.ckpt_load_dir == "":
-            raise Exception("For official_eval mode, you need to specify --ckpt_load_dir")
+        if FLAGS.ckpt_load_dir == "" and FLAGS.bundle_path == "":
+            raise Exception("For official_eval mode, you need to specify --ckpt_load_dir (or --bundle_path)")
 
         # Read the JSON data from file
-        qn_uuid_data, context_token_data, qn_token_data = get_json_data(FLAGS.json_in_path)
+        qn_uuid_data, context_token_data, qn_token_data, context_offset_data = get_json_data(FLAGS.json_in_path, FLAGS.tokenize_cache_dir, TOKENIZERS[FLAGS.tokenizer])
 
         with tf.Session(config=config) as sess:
 
-            # Load model from ckpt_load_dir
-            initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+            # Load model from ckpt_load_dir (an exported bundle is already loaded)
+            if not FLAGS.bundle_path:
+                initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
 
             # Get a predicted answer for each example in the data
             # Return a mapping answers_dict from uuid to answer
-            answers_dict = generate_answers(sess, qa_model, word2id, qn_uuid_data, context_token_data, qn_token_data)
+            answers_dict = generate_answers(sess, qa_model, word2id, qn_uuid_data, context_token_data, qn_token_data, context_offset_data=context_offset_data)
 
             # Write the uuid->answer mapping a to json file in root dir
             print "Writing predictions to %s..." % FLAGS.json_out_path
@@ -328,6 +431,29 @@ def main(unused_argv):
                 print "Wrote predictions to %s" % FLAGS.json_out_path
 
 
+    elif FLAGS.mode == "serve":
+        if FLAGS.ckpt_load_dir == "" and FLAGS.bundle_path == "":
+            raise Exception("For serve mode, you need to specify --ckpt_load_dir (or --bundle_path)")
+
+        with tf.Session(config=config) as sess:
+
+            # Load the model once, then answer the requests until interrupted
+            if not FLAGS.bundle_path:
+                initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+            serve(sess, qa_model, word2id, TOKENIZERS[FLAGS.tokenizer], FLAGS.serve_host, FLAGS.serve_port, FLAGS.serve_socket,
+                  max_batch_size=FLAGS.serve_max_batch or FLAGS.batch_size, max_wait=FLAGS.serve_max_wait_ms / 1000)
+
+    elif FLAGS.mode == "export":
+        if FLAGS.ckpt_load_dir == "":
+            raise Exception("For export mode, you need to specify --ckpt_load_dir")
+        if FLAGS.bundle_path == "":
+            raise Exception("For export mode, you need to specify --bundle_path")
+
+        with tf.Session(config=config) as sess:
+            initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+            num_bytes = export_bundle(sess, qa_model, FLAGS.bundle_path)
+            print "Wrote the %s model to %s (%.1f MB)" % (FLAGS.model_name, FLAGS.bundle_path, num_bytes / 2.**20)
+
     else:
         raise Exception("Unexpected value of FLAGS.mode: %s" % FLAGS.mode)
 
@@ -20,128 +20,171 @@ from __future__ import absolute_import
 from __future__ import division
 
 import os
+import json
+import hashlib
+import tempfile
+import threading
+from itertools import islice, izip, repeat
 from tqdm import tqdm
 import numpy as np
-from six.moves import xrange
-from nltk.tokenize.moses import MosesDetokenizer
+import nltk
+from six.moves import xrange, queue
 
-from preprocessing.squad_preprocess import data_from_json, tokenize
-from vocab import UNK_ID, PAD_ID
-from data_batcher import padded, Batch
+from preprocessing.squad_preprocess import tokenize, TOKENIZER_VERSION, iter_articles, iter_paragraphs
+from data_batcher import Batch, BatchAssembler, BatchPrefetcher, flatten_ids, context_windows
 
+# Created when the first answer is detokenized (see get_answer), which can happen in several threads at once
+_detokenizer = None
+_detokenizer_lock = threading.Lock()
 
 
-def readnext(x):
-    """x is a list"""
-    if len(x) == 0:
-        return False
-    else:
-        return x.pop(0)
+def get_answer(context_tokens, context_offsets, pred_start, pred_end):
+    """
+    Returns the answer (string) of the predicted span [pred_start, pred_end] (inclusive token positions).
+
+    Inputs:
+      context_tokens: list of strings. The tokens of the context
+      context_offsets: (context, offsets) pair from tokenize_context: the original context, and the character span
+        of each token in it. The answer is sliced from the context, with its case and spacing.
+        If it's None, or the offsets of the first or last token of the answer are unknown,
+        the answer tokens are detokenized instead (lowercase, and the spacing may differ from the context).
+    """
+    if context_offsets is not None:
+        context, offsets = context_offsets
+        if offsets[pred_start] is not None and offsets[pred_end] is not None:
+            return context[offsets[pred_start][0] : offsets[pred_end][1]]
 
+    global _detokenizer
+    with _detokenizer_lock:
+        if _detokenizer is None:
+            # Imported here, as importing it needs the nltk perluniprops data
+            from nltk.tokenize.moses import MosesDetokenizer
+            _detokenizer = MosesDetokenizer()
+        return _detokenizer.detokenize(context_tokens[pred_start : pred_end + 1], return_str=True)
 
 
-def refill_batches(batches, word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len):
+
+def refill_batches(batches, examples, batch_size, bucket=False):
     """
     This is similar to refill_batches in data_batcher.py, but:
-      (1) instead of reading from (preprocessed) datafiles, it reads from the provided lists
+      (1) instead of reading from (preprocessed) datafiles, it reads from the provided iterator
       (2) it only puts the context and question information in the batches (not the answer information)
       (3) it also gets UUID information and puts it in the batches
 
     Inputs:
       batches: list to be refilled
-      qn_uuid_data: list of strings that are unique ids
-      context_token_data, qn_token_data: list of lists of strings (no UNKs, no padding)
+      examples: iterator over (qn_uuid, context_tokens, qn_tokens, context_offsets) tuples: a unique id,
+        the tokenized context and question (lists of strings, no UNKs, no padding), and the context offsets
+        (see tokenize_context, or None). The examples of the new batches are taken from it.
       batch_size: int. size of batches to make
-      context_len, question_len: ints. max sizes of context and question. Anything longer is truncated.
+      bucket: If True, read 160 batches at a time, and batch together contexts of similar length.
+        The batches are then not in the order of the data, but each example keeps its uuid.
 
     Makes batches that contain:
-      uuids_batch, context_tokens_batch, context_ids_batch, qn_ids_batch: all lists length batch_size
+      uuids_batch, context_tokens_batch, qn_tokens_batch, context_offsets_batch: lists length batch_size
+    The batches hold the tokens only: get_batch_generator converts them to ids, truncated and padded.
     """
-    examples = []
-
-    # Get next example
-    qn_uuid, context_tokens, qn_tokens = readnext(qn_uuid_data), readnext(context_token_data), readnext(qn_token_data)
-
-    while qn_uuid and context_tokens and qn_tokens:
-
-        # Convert context_tokens and qn_tokens to context_ids and qn_ids
-        context_ids = [word2id.get(w, UNK_ID) for w in context_tokens]
-        qn_ids = [word2id.get(w, UNK_ID) for w in qn_tokens]
+    # Get the next batch (or 160 batches) of examples
+    num_examples = batch_size * 160 if bucket else batch_size
+    examples = list(islice(examples, num_examples))
 
-        # Truncate context_ids and qn_ids
-        # Note: truncating context_ids may truncate the correct answer, meaning that it's impossible for your model to get the correct answer on this example!
-        if len(qn_ids) > question_len:
-            qn_ids = qn_ids[:question_len]
-        if len(context_ids) > context_len:
-            context_ids = context_ids[:context_len]
-
-        # Add to list of examples
-        examples.append((qn_uuid, context_tokens, context_ids, qn_ids))
-
-        # Stop if you've got a batch
-        if len(examples) == batch_size:
-            break
-
-        # Get next example
-        qn_uuid, context_tokens, qn_tokens = readnext(qn_uuid_data), readnext(context_token_data), readnext(qn_token_data)
+    # Sort by context length
+    if bucket:
+        examples.sort(key=lambda example: len(example[1]))
 
     # Make into batches
     for batch_start in xrange(0, len(examples), batch_size):
-        uuids_batch, context_tokens_batch, context_ids_batch, qn_ids_batch = zip(*examples[batch_start:batch_start + batch_size])
-
-        batches.append((uuids_batch, context_tokens_batch, context_ids_batch, qn_ids_batch))
+        uuids_batch, context_tokens_batch, qn_tokens_batch, context_offsets_batch = zip(*examples[batch_start:batch_start + batch_size])
+        batches.append((uuids_batch, context_tokens_batch, qn_tokens_batch, context_offsets_batch))
 
     return
 
 
 
-def get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len):
+def get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len, dynamic_padding=False, bucket=False, context_offset_data=None, num_slots=2):
     """
     This is similar to get_batch_generator in data_batcher.py, but with some
     differences (see explanation in refill_batches).
 
     Inputs:
-      word2id: dictionary mapping word (string) to word id (int)
-      qn_uuid_data: list of strings that are unique ids
-      context_token_data, qn_token_data: list of lists of strings (no UNKs, no padding)
+      word2id: Vocab mapping word (string) to word id (int)
+      qn_uuid_data: list (or iterable) of strings that are unique ids
+      context_token_data, qn_token_data: lists (or iterables) of lists of strings (no UNKs, no padding)
       batch_size: int. size of batches to make
       context_len, question_len: ints. max sizes of context and question. Anything longer is truncated.
+      dynamic_padding: If True, pad each batch to its longest context and question (at most context_len/question_len)
+      bucket: see refill_batches
+      context_offset_data: list (or iterable) of the offsets of the contexts (see tokenize_context), or None
+      num_slots: number of BatchAssembler slots: the id and mask arrays of a batch are overwritten
+        num_slots batches later, so it must be more than the number of batches in use at once
+
+    The data is read through one iterator over the examples, so the lists are left as they are
+    (another generator can go over them again), and iterables such as generators are read as the batches are made.
 
     Yields:
       Batch objects, but they only contain context and question information (no answer information)
     """
     batches = []
+    assembler = BatchAssembler(num_slots=num_slots)
+    examples = izip(qn_uuid_data, context_token_data, qn_token_data, repeat(None) if context_offset_data is None else context_offset_data)
 
     while True:
         if len(batches) == 0:
-            refill_batches(batches, word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len)
+            refill_batches(batches, examples, batch_size, bucket)
         if len(batches) == 0:
             break
 
-        # Get next batch. These are all lists length batch_size
-        (uuids, context_tokens, context_ids, qn_ids) = batches.pop(0)
-
-        # Pad context_ids and qn_ids
-        qn_ids = padded(qn_ids, question_len) # pad questions to length question_len
-        context_ids = padded(context_ids, context_len) # pad contexts to length context_len
+        # Get next batch
+        (uuids, context_tokens, qn_tokens, context_char_offsets) = batches.pop(0)
 
-        # Make qn_ids into a np array and create qn_mask
-        qn_ids = np.array(qn_ids)
-        qn_mask = (qn_ids != PAD_ID).astype(np.int32)
-
-        # Make context_ids into a np array and create context_mask
-        context_ids = np.array(context_ids)
-        context_mask = (context_ids != PAD_ID).astype(np.int32)
+        # Convert context_tokens and qn_tokens to context_ids and qn_ids, padded and truncated to context_len and question_len,
+        # and make the masks
+        # Note: truncating context_ids may truncate the correct answer, meaning that it's impossible for your model to get the correct answer on this example!
+        # (with --window_stride, generate_answers splits the long contexts into windows instead, see split_windows)
+        context_flat, context_offsets, context_lens = flatten_ids(word2id, context_tokens)
+        qn_flat, qn_offsets, qn_lens = flatten_ids(word2id, qn_tokens)
+        context_width, qn_width = context_len, question_len
+        if dynamic_padding:
+            context_width = min(context_len, context_lens.max())
+            qn_width = min(question_len, qn_lens.max())
+        slot = assembler.next_slot()
+        context_ids, context_mask = assembler.pad(slot, "context", context_flat, context_offsets[:-1], context_lens, context_width)
+        qn_ids, qn_mask = assembler.pad(slot, "qn", qn_flat, qn_offsets[:-1], qn_lens, qn_width)
 
         # Make into a Batch object
-        batch = Batch(context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens=None, ans_span=None, ans_tokens=None, uuids=uuids)
+        batch = Batch(context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens=None, ans_span=None, ans_tokens=None, uuids=uuids,
+                      context_offsets=None if context_offset_data is None else context_char_offsets)
 
         yield batch
 
     return
 
 
-def preprocess_dataset(dataset):
+def tokenize_context(context, tokenizer=tokenize, return_offsets=False):
+    """
+    Tokenizes a context (string) as in the preprocessing. Returns a list of strings (lowercase),
+    and if return_offsets is True, the offsets of the context: a (context, offsets) pair of the context (unicode)
+    and the character span of each token in it, or None where it's unknown (see squad_preprocess.token_offsets).
+    """
+    original = context = unicode(context)
+
+    # The following replacements are suggested in the paper
+    # BidAF (Seo et al., 2016)
+    # They keep the length of the context, so the offsets in the replaced context are the offsets in the original one
+    context = context.replace("''", '" ')
+    context = context.replace("``", '" ')
+
+    if return_offsets:
+        tokens, offsets = tokenizer(context, return_offsets=True)
+        # A '"' token from a replaced quote covers both of its characters
+        for (i, span) in enumerate(offsets):
+            if span is not None and span[1] - span[0] == 1 and original[span[0] : span[0] + 2] in ("''", "``"):
+                offsets[i] = (span[0], span[0] + 2)
+        return tokens, (original, offsets)
+    return tokenizer(context)
+
+
+def preprocess_dataset(paragraphs, tokenizer=tokenize):
     """
     Note: this is similar to squad_preprocess.preprocess_and_write, but:
       (1) We only extract the context and question information from the JSON file.
@@ -151,106 +194,349 @@ def preprocess_dataset(dataset):
         discard any examples due to tokenization problems.
 
     Input:
-      dataset: data read from SQuAD JSON file
+      paragraphs: iterable of (article, paragraph, qas) records of a SQuAD JSON file (see squad_preprocess.iter_paragraphs),
+        consumed one at a time
+      tokenizer: function tokenizing the contexts and questions, one of squad_preprocess.TOKENIZERS
 
     Returns:
-      qn_uuid_data, context_token_data, qn_token_data: lists of uuids, tokenized context and tokenized questions
+      qn_uuid_data, context_token_data, qn_token_data, context_offset_data: lists of uuids, tokenized context,
+        tokenized questions and context offsets (see tokenize_context)
     """
     qn_uuid_data = []
     context_token_data = []
     qn_token_data = []
+    context_offset_data = []
 
-    for articles_id in tqdm(range(len(dataset['data'])), desc="Preprocessing data"):
-        article_paragraphs = dataset['data'][articles_id]['paragraphs']
-        for pid in range(len(article_paragraphs)):
+    for (article, paragraph, qas) in tqdm(paragraphs, unit="paragraphs", desc="Preprocessing data"):
 
-            context = unicode(article_paragraphs[pid]['context']) # string
+        context_tokens, context_offsets = tokenize_context(paragraph['context'], tokenizer, return_offsets=True) # list of strings (lowercase)
 
-            # The following replacements are suggested in the paper
-            # BidAF (Seo et al., 2016)
-            context = context.replace("''", '" ')
-            context = context.replace("``", '" ')
+        # for each question
+        for qn in qas:
 
-            context_tokens = tokenize(context) # list of strings (lowercase)
-            context = context.lower()
+            # read the question text and tokenize
+            question = unicode(qn['question']) # string
+            question_tokens = tokenizer(question) # list of strings
 
-            qas = article_paragraphs[pid]['qas'] # list of questions
+            # also get the question_uuid
+            question_uuid = qn['id']
 
-            # for each question
-            for qn in qas:
+            # Append to data lists
+            qn_uuid_data.append(question_uuid)
+            context_token_data.append(context_tokens)
+            qn_token_data.append(question_tokens)
+            context_offset_data.append(context_offsets)
 
-                # read the question text and tokenize
-                question = unicode(qn['question']) # string
-                question_tokens = tokenize(question) # list of strings
+    return qn_uuid_data, context_token_data, qn_token_data, context_offset_data
 
-                # also get the question_uuid
-                question_uuid = qn['id']
 
-                # Append to data lists
-                qn_uuid_data.append(question_uuid)
-                context_token_data.append(context_tokens)
-                qn_token_data.append(question_tokens)
+# Bump this whenever the layout of the files written by write_tokenize_cache changes
+TOKENIZE_CACHE_VERSION = 2
 
-    return qn_uuid_data, context_token_data, qn_token_data
 
+def tokenize_cache_path(cache_dir, data_filename, chunk_size=1 << 20, tokenizer=tokenize):
+    """
+    Returns the path of the cached tokenization of a JSON input file in cache_dir.
+    The file name is a hash of the contents of the JSON file (read in chunks of chunk_size bytes)
+    and of the tokenizer (its name, TOKENIZER_VERSION and the nltk version), so that the cache is shared
+    by all the modes and models reading the same file, and a new tokenizer doesn't reuse old tokenizations.
+    """
+    key = hashlib.sha1("tokenizer %s %i nltk %s cache %i\n" % (tokenizer.__name__, TOKENIZER_VERSION, nltk.__version__, TOKENIZE_CACHE_VERSION))
+    with open(data_filename) as data_file:
+        for chunk in iter(lambda: data_file.read(chunk_size), ""):
+            key.update(chunk)
+    return os.path.join(cache_dir, key.hexdigest() + ".json")
 
-def get_json_data(data_filename):
+
+def write_tokenize_cache(cache_path, qn_uuid_data, context_token_data, qn_token_data, context_offset_data):
+    """
+    Writes the output of preprocess_dataset to cache_path.
+    Each context is stored once, with its offsets, with the index of its context for each question.
+    """
+    contexts, offsets, context_idx, context_ids = [], [], [], {}
+    for (context_tokens, context_offsets) in zip(context_token_data, context_offset_data):
+        # preprocess_dataset gives the same list to all the questions of a context
+        if id(context_tokens) not in context_ids:
+            context_ids[id(context_tokens)] = len(contexts)
+            contexts.append(context_tokens)
+            offsets.append(context_offsets)
+        context_idx.append(context_ids[id(context_tokens)])
+
+    # Written to a temporary file of its own then renamed, so that an interrupted write is never read,
+    # and concurrent runs on the same file don't write into each other's output
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_path)), prefix=os.path.basename(cache_path) + ".tmp-")
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            json.dump({"uuids": qn_uuid_data, "contexts": contexts, "offsets": offsets, "context_idx": context_idx, "questions": qn_token_data}, fh)
+        os.rename(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def read_tokenize_cache(cache_path):
+    """Reads a file written by write_tokenize_cache. Returns qn_uuid_data, context_token_data, qn_token_data, context_offset_data"""
+    with open(cache_path) as fh:
+        cache = json.load(fh)
+    context_token_data = [cache["contexts"][i] for i in cache["context_idx"]]
+    offsets = [(context, [tuple(span) if span is not None else None for span in spans]) for (context, spans) in cache["offsets"]]
+    context_offset_data = [offsets[i] for i in cache["context_idx"]]
+    return cache["uuids"], context_token_data, cache["questions"], context_offset_data
+
+
+def get_json_data(data_filename, cache_dir="", tokenizer=tokenize):
     """
     Read the contexts and questions from a .json file (like dev-v1.1.json)
 
+    Inputs:
+      data_filename: path to the .json file
+      cache_dir: If not empty, the directory where the tokenized contexts and questions are cached
+        (see tokenize_cache_path), to skip the tokenization the next time the same file is read.
+      tokenizer: function tokenizing the contexts and questions, one of squad_preprocess.TOKENIZERS
+
     Returns:
       qn_uuid_data: list (length equal to dev set size) of unicode strings like '56be4db0acb8001400a502ec'
       context_token_data, qn_token_data: lists (length equal to dev set size) of lists of strings (no UNKs, unpadded)
+      context_offset_data: list (length equal to dev set size) of the offsets of the contexts (see tokenize_context),
+        from which the answers are sliced
     """
     # Check the data file exists
     if not os.path.exists(data_filename):
         raise Exception("JSON input file does not exist: %s" % data_filename)
 
-    # Read the json file
-    print "Reading data from %s..." % data_filename
-    data = data_from_json(data_filename)
-
-    # Get the tokenized contexts and questions, and unique question identifiers
-    print "Preprocessing data from %s..." % data_filename
-    qn_uuid_data, context_token_data, qn_token_data = preprocess_dataset(data)
+    cache_path = tokenize_cache_path(cache_dir, data_filename, tokenizer=tokenizer) if cache_dir else None
+    cached = None
+    if cache_path and os.path.exists(cache_path):
+        print "Reading the tokenized data from %s..." % cache_path
+        try:
+            cached = read_tokenize_cache(cache_path)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            # e.g. a truncated file: tokenize again, which rewrites the cache
+            print "Could not read the cached tokenized data in %s: %s" % (cache_path, e)
+
+    if cached is not None:
+        qn_uuid_data, context_token_data, qn_token_data, context_offset_data = cached
+    else:
+        # Get the tokenized contexts and questions, and unique question identifiers,
+        # reading the json file one article at a time
+        print "Preprocessing data from %s..." % data_filename
+        qn_uuid_data, context_token_data, qn_token_data, context_offset_data = preprocess_dataset(iter_paragraphs(iter_articles(data_filename)), tokenizer)
+
+        if cache_path:
+            try:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                write_tokenize_cache(cache_path, qn_uuid_data, context_token_data, qn_token_data, context_offset_data)
+                print "Cached the tokenized data in %s" % cache_path
+            except (IOError, OSError) as e:
+                print "Could not cache the tokenized data in %s: %s" % (cache_dir, e)
 
     data_size = len(qn_uuid_data)
     assert len(context_token_data) == data_size
     assert len(qn_token_data) == data_size
+    assert len(context_offset_data) == data_size
     print "Finished preprocessing. Got %i examples from %s" % (data_size, data_filename)
 
-    return qn_uuid_data, context_token_data, qn_token_data
+    return qn_uuid_data, context_token_data, qn_token_data, context_offset_data
 
 
-def generate_answers(session, model, word2id, qn_uuid_data, context_token_data, qn_token_data):
+def split_windows(qn_uuid_data, context_token_data, qn_token_data, context_len, window_stride):
+    """
+    Splits the contexts longer than context_len into overlapping windows of context_len tokens,
+    one every window_stride tokens (see data_batcher.context_windows), each with the question of its context.
+
+    Returns:
+      window_keys: list of (uuid, start) pairs: the uuid of the example of each window, and the position of
+        the window's first token in the example's context
+      window_token_data, window_qn_token_data: lists of the context tokens and question tokens of the windows
+    """
+    window_keys, window_token_data, window_qn_token_data = [], [], []
+    for (uuid, context_tokens, qn_tokens) in zip(qn_uuid_data, context_token_data, qn_token_data):
+        for start in context_windows(len(context_tokens), context_len, window_stride):
+            window_keys.append((uuid, start))
+            window_token_data.append(context_tokens[start : start + context_len])
+            window_qn_token_data.append(qn_tokens)
+    return window_keys, window_token_data, window_qn_token_data
+
+
+def best_span(start_dist, end_dist, max_answer_len):
+    """
+    Returns the span (start, end) maximizing start_dist[start] * end_dist[end],
+    with start <= end < start + max_answer_len, and that joint probability.
+    """
+    span_probs = np.triu(np.outer(start_dist, end_dist))
+    span_probs = np.tril(span_probs, max_answer_len - 1)
+    start, end = np.unravel_index(np.argmax(span_probs), span_probs.shape)
+    return int(start), int(end), span_probs[start, end]
+
+
+def run_pipelined(batches, run_batch, decode_batch, num_workers=0, max_batches=8, progress=None):
+    """
+    Runs run_batch on each batch in the calling thread, then decode_batch on its outputs.
+
+    With num_workers > 0, the stages overlap. The batches are built in a thread (see data_batcher.BatchPrefetcher),
+    at most max_batches ahead. The outputs of at most max_batches batches wait for num_workers decoding threads.
+    So session.run doesn't wait for the Python code building the batches and making the answers.
+    The decoding threads interleave with each other (they run Python code), but they run in parallel with
+    session.run, which releases the GIL. With num_workers=0, the stages alternate in the calling thread.
+
+    Inputs:
+      batches: iterable of Batches, e.g. from get_batch_generator. With num_workers > 0 it's read from another thread,
+        and it must build the batches in at least max_batches + 2 slots (the batches queued, built and being run).
+      run_batch: function taking a Batch and returning the model's outputs for it, e.g. model.get_start_end_pos
+      decode_batch: function taking a Batch and its outputs. With num_workers > 0, it's called from several threads
+        at once, after the next batches are run: it must be thread-safe, and not use the id and mask arrays of the batch.
+      num_workers: number of decoding threads
+      max_batches: the bound of the queues of batches to run and to decode
+      progress: If not None, function called with the number of batches run so far after each batch
+    """
+    if num_workers == 0:
+        for (batch_num, batch) in enumerate(batches):
+            decode_batch(batch, run_batch(batch))
+            if progress is not None:
+                progress(batch_num + 1)
+        return
+
+    decode_queue = queue.Queue(max_batches)
+    errors = []
+
+    def decode():
+        while True:
+            item = decode_queue.get()
+            if item is None:
+                return
+            if errors: # skip the rest once a batch has failed
+                continue
+            try:
+                decode_batch(*item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=decode) for _ in xrange(num_workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # The generator builds each batch in the reader thread of the prefetcher: its jobs just return them
+    prefetcher = BatchPrefetcher(((lambda batch=batch: batch) for batch in batches), num_workers=1, max_batches=max_batches)
+    try:
+        for (batch_num, batch) in enumerate(prefetcher):
+            if errors:
+                break
+            decode_queue.put((batch, run_batch(batch)))
+            if progress is not None:
+                progress(batch_num + 1)
+    finally:
+        prefetcher.close()
+        for _ in threads:
+            decode_queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def print_progress(num_batches):
+    """Returns a progress function for run_pipelined, printing the progress every 10 batches"""
+    def progress(batch_num):
+        if batch_num % 10 == 0:
+            print "Generated answers for %i/%i batches = %.2f%%" % (batch_num, num_batches, batch_num*100.0/num_batches)
+    return progress
+
+
+def generate_windowed_answers(session, model, word2id, qn_uuid_data, context_token_data, qn_token_data, verbose=True, context_offset_data=None, num_workers=None):
+    """
+    Same as generate_answers, but the contexts longer than model.FLAGS.context_len are split into overlapping windows
+    (see split_windows) instead of being truncated. The answer of each example is the span of at most
+    model.FLAGS.max_answer_len tokens with the highest joint start/end probability over all its windows (see best_span),
+    the first one in the context if several have that probability.
+
+    Outputs:
+      uuid2ans: dictionary mapping uuid (string) to predicted answer (string; see get_answer)
+    """
+    context_len = model.FLAGS.context_len
+    window_keys, window_token_data, window_qn_token_data = split_windows(qn_uuid_data, context_token_data, qn_token_data, context_len, model.FLAGS.window_stride)
+    num_batches = ((len(window_keys)-1) / model.FLAGS.batch_size) + 1
+    num_workers = model.FLAGS.prefetch_workers if num_workers is None else num_workers
+    max_batches = model.FLAGS.prefetch_batches
+    best = {} # maps uuid to (probability, -start, end) of its best span, as positions in the whole context
+    best_lock = threading.Lock()
+
+    if verbose:
+        print "Generating answers for %i windows of %i examples..." % (len(window_keys), len(qn_uuid_data))
+
+    def decode_batch(batch, prob_dists):
+        start_dists, end_dists = prob_dists
+        # For each window in the batch, keep its best span if it's the best of its example so far
+        # (comparing the starts too, so that the result doesn't depend on the order of the windows)
+        spans = []
+        for ex_idx, (uuid, window_start) in enumerate(batch.uuids):
+            window_len = len(batch.context_tokens[ex_idx])
+            start, end, prob = best_span(start_dists[ex_idx, :window_len], end_dists[ex_idx, :window_len], model.FLAGS.max_answer_len)
+            spans.append((uuid, (prob, -(window_start + start), window_start + end)))
+        with best_lock:
+            for (uuid, span) in spans:
+                if uuid not in best or span > best[uuid]:
+                    best[uuid] = span
+
+    batches = get_batch_generator(word2id, window_keys, window_token_data, window_qn_token_data, model.FLAGS.batch_size, context_len, model.FLAGS.question_len,
+                                  dynamic_padding=model.FLAGS.dynamic_padding, bucket=model.FLAGS.bucket_width > 0, num_slots=max_batches + 2)
+    run_pipelined(batches, lambda batch: model.get_prob_dists(session, batch), decode_batch, num_workers, max_batches,
+                  print_progress(num_batches) if verbose else None)
+
+    # Read the best spans in the original contexts
+    uuid2ans = {}
+    if context_offset_data is None:
+        context_offset_data = [None] * len(qn_uuid_data)
+    for (uuid, context_tokens, context_offsets) in zip(qn_uuid_data, context_token_data, context_offset_data):
+        _, neg_start, pred_end = best[uuid]
+        uuid2ans[uuid] = get_answer(context_tokens, context_offsets, -neg_start, pred_end)
+
+    if verbose:
+        print "Finished generating answers for dataset."
+
+    return uuid2ans
+
+
+def generate_answers(session, model, word2id, qn_uuid_data, context_token_data, qn_token_data, verbose=True, context_offset_data=None, num_workers=None):
     """
     Given a model, and a set of (context, question) pairs, each with a unique ID,
     use the model to generate an answer for each pair, and return a dictionary mapping
     each unique ID to the generated answer.
 
+    The batches are built, run and decoded into answers in a pipeline (see run_pipelined),
+    with model.FLAGS.prefetch_batches batches in each queue.
+
     Inputs:
       session: TensorFlow session
       model: QAModel
-      word2id: dictionary mapping word (string) to word id (int)
+      word2id: Vocab mapping word (string) to word id (int)
       qn_uuid_data, context_token_data, qn_token_data: lists
+      verbose: If False, don't print the progress (e.g. when answering a few questions at a time, see serving.py)
+      context_offset_data: list of the offsets of the contexts (see tokenize_context), to slice the answers from
+        the original contexts. If None, the answers are detokenized.
+      num_workers: number of threads decoding the answers. Defaults to model.FLAGS.prefetch_workers.
+        0 runs the whole pipeline in the calling thread.
 
     Outputs:
-      uuid2ans: dictionary mapping uuid (string) to predicted answer (string; detokenized)
+      uuid2ans: dictionary mapping uuid (string) to predicted answer (string; see get_answer)
     """
+    if model.FLAGS.window_stride:
+        return generate_windowed_answers(session, model, word2id, qn_uuid_data, context_token_data, qn_token_data, verbose, context_offset_data, num_workers)
+
     uuid2ans = {} # maps uuid to string containing predicted answer
     data_size = len(qn_uuid_data)
     num_batches = ((data_size-1) / model.FLAGS.batch_size) + 1
-    batch_num = 0
-    detokenizer = MosesDetokenizer()
+    num_workers = model.FLAGS.prefetch_workers if num_workers is None else num_workers
+    max_batches = model.FLAGS.prefetch_batches
 
-    print "Generating answers..."
-
-    for batch in get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, model.FLAGS.batch_size, model.FLAGS.context_len, model.FLAGS.question_len):
-
-        # Get the predicted spans
-        pred_start_batch, pred_end_batch = model.get_start_end_pos(session, batch)
+    if verbose:
+        print "Generating answers..."
 
+    def decode_batch(batch, pred_spans):
         # Convert pred_start_batch and pred_end_batch to lists length batch_size
+        pred_start_batch, pred_end_batch = pred_spans
         pred_start_batch = pred_start_batch.tolist()
         pred_end_batch = pred_end_batch.tolist()
 
@@ -261,22 +547,22 @@ def generate_answers(session, model, word2id, qn_uuid_data, context_token_data,
             context_tokens = batch.context_tokens[ex_idx] # list of strings
 
             # Check the predicted span is in range
-            assert pred_start in range(len(context_tokens))
-            assert pred_end in range(len(context_tokens))
-
-            # Predicted answer tokens
-            pred_ans_tokens = context_tokens[pred_start : pred_end +1] # list of strings
+            assert 0 <= pred_start < len(context_tokens)
+            assert 0 <= pred_end < len(context_tokens)
 
-            # Detokenize and add to dict
+            # Slice the predicted answer from the original context (or detokenize it) and add to dict
+            context_offsets = batch.context_offsets[ex_idx] if batch.context_offsets is not None else None
             uuid = batch.uuids[ex_idx]
-            uuid2ans[uuid] = detokenizer.detokenize(pred_ans_tokens, return_str=True)
+            uuid2ans[uuid] = get_answer(context_tokens, context_offsets, pred_start, pred_end)
 
-        batch_num += 1
+    batches = get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, model.FLAGS.batch_size, model.FLAGS.context_len, model.FLAGS.question_len,
+                                  dynamic_padding=model.FLAGS.dynamic_padding, bucket=model.FLAGS.bucket_width > 0, context_offset_data=context_offset_data,
+                                  num_slots=max_batches + 2)
+    run_pipelined(batches, lambda batch: model.get_start_end_pos(session, batch), decode_batch, num_workers, max_batches,
+                  print_progress(num_batches) if verbose else None)
 
-        if batch_num % 10 == 0:
-            print "Generated answers for %i/%i batches = %.2f%%" % (batch_num, num_batches, batch_num*100.0/num_batches)
-
-    print "Finished generating answers for dataset."
+    if verbose:
+        print "Finished generating answers for dataset."
 
     return uuid2ans
 
@@ -290,7 +576,7 @@ def generate_distributions(session, model, word2id, qn_uuid_data, context_token_
     Inputs:
       session: TensorFlow session
       model: QAModel
-      word2id: dictionary mapping word (string) to word id (int)
+      word2id: Vocab mapping word (string) to word id (int)
       qn_uuid_data, context_token_data, qn_token_data: lists
 
     Outputs:
@@ -303,7 +589,8 @@ def generate_distributions(session, model, word2id, qn_uuid_data, context_token_
 
     print "Generating predictions..."
 
-    for batch in get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, model.FLAGS.batch_size, model.FLAGS.context_len, model.FLAGS.question_len):
+    for batch in get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, model.FLAGS.batch_size, model.FLAGS.context_len, model.FLAGS.question_len,
+                                     dynamic_padding=model.FLAGS.dynamic_padding, bucket=model.FLAGS.bucket_width > 0):
 
         # Get the predicted spans
         pred_start_dists, pred_end_dists = model.get_prob_dists(session, batch)
@@ -315,9 +602,13 @@ def generate_distributions(session, model, word2id, qn_uuid_data, context_token_
         # For each example in the batch:
         for ex_idx, (pred_start, pred_end) in enumerate(zip(pred_start_batch, pred_end_batch)):
 
+            # Keep the distributions over the real (truncated) context only,
+            # so that they don't depend on how the batch was padded, and can be averaged across models
+            context_len = min(len(batch.context_tokens[ex_idx]), model.FLAGS.context_len)
+
             # Detokenize and add to dict
             uuid = batch.uuids[ex_idx]
-            distributions[uuid] = [pred_start, pred_end]
+            distributions[uuid] = [pred_start[:context_len], pred_end[:context_len]]
         batch_num += 1
 
         if batch_num % 10 == 0:
@@ -326,7 +617,7 @@ def generate_distributions(session, model, word2id, qn_uuid_data, context_token_
     print "Finished generating predictions for dataset."
     return distributions
 
-def generate_answers_from_dist(sess, model, total_dict, word2id, qn_uuid_data, context_token_data, qn_token_data):
+def generate_answers_from_dist(sess, model, total_dict, word2id, qn_uuid_data, context_token_data, qn_token_data, context_offset_data=None):
     """
     Given a model, and a set of (context, question) pairs, each with a unique ID,
     use the model to generate an answer for each pair, and return a dictionary mapping
@@ -335,21 +626,22 @@ def generate_answers_from_dist(sess, model, total_dict, word2id, qn_uuid_data, c
     Inputs:
       session: TensorFlow session
       total_dict: dict uuid -> distributions
-      word2id: dictionary mapping word (string) to word id (int)
+      word2id: Vocab mapping word (string) to word id (int)
       qn_uuid_data, context_token_data, qn_token_data: lists
+      context_offset_data: list of the offsets of the contexts, or None (see generate_answers)
 
     Outputs:
-      uuid2ans: dictionary mapping uuid (string) to predicted answer (string; detokenized)
+      uuid2ans: dictionary mapping uuid (string) to predicted answer (string; see get_answer)
     """
     uuid2ans = {} # maps uuid to string containing predicted answer
     data_size = len(qn_uuid_data)
     num_batches = ((data_size-1) / model.FLAGS.batch_size) + 1
     batch_num = 0
-    detokenizer = MosesDetokenizer()
 
     print "Generating answers..."
 
-    for batch in get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, model.FLAGS.batch_size, model.FLAGS.context_len, model.FLAGS.question_len):
+    for batch in get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, model.FLAGS.batch_size, model.FLAGS.context_len, model.FLAGS.question_len,
+                                     context_offset_data=context_offset_data):
         # For each example in the batch:
         for (ex_idx, uuid) in enumerate(batch.uuids):
             pred_start = np.argmax(total_dict[uuid][0])
@@ -362,9 +654,9 @@ def generate_answers_from_dist(sess, model, total_dict, word2id, qn_uuid_data, c
             assert pred_start in range(len(context_tokens))
             assert pred_end in range(len(context_tokens))
 
-            # Predicted answer tokens
-            pred_ans_tokens = context_tokens[pred_start : pred_end +1] # list of strings
-            uuid2ans[uuid] = detokenizer.detokenize(pred_ans_tokens, return_str=True)
+            # Slice the predicted answer from the original context (or detokenize it)
+            context_offsets = batch.context_offsets[ex_idx] if batch.context_offsets is not None else None
+            uuid2ans[uuid] = get_answer(context_tokens, context_offsets, pred_start, pred_end)
 
         batch_num += 1
 
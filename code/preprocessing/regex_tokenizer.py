@@ -0,0 +1,136 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains a faster replacement for nltk.word_tokenize (see --tokenizer in squad_preprocess.py and main.py).
+
+nltk.word_tokenize splits the text into sentences with the Punkt sentence tokenizer, then tokenizes each sentence
+with the Treebank tokenizer. Sentence boundaries only matter to the Treebank tokenizer in that it splits the period
+off the last word of each sentence ("York." is one token inside a sentence, "York" and "." at the end of one).
+Punkt and the ~35 regex substitutions the Treebank tokenizer makes per sentence are most of the cost, so here
+the sentence ends are found by a compiled regex and a few rules approximating Punkt's decisions, the final periods
+are split off, and the Treebank rules run once on the whole text, skipping those which can't match it.
+
+The tokens differ from nltk.word_tokenize only where these rules disagree with the trained Punkt model:
+  - A period after a word that Punkt knows as an abbreviation but which isn't in ABBREVIATIONS is split off
+    ("Gov." -> "Gov" "."), and the other way round.
+  - After an abbreviation or an initial, Punkt ends the sentence when the next word is capitalized and usually
+    lowercase elsewhere in its training data. Here the next word must be in SENTENCE_STARTERS.
+  - Punkt's collocations (word pairs around a period that never end a sentence) aren't modeled.
+  - Punkt also ends sentences at a period directly followed by a quote or bracket and then a word, without a space.
+"""
+
+import re
+
+from nltk.tokenize.treebank import TreebankWordTokenizer
+
+# Abbreviations (lowercase, without their final period) after which a period doesn't end the sentence,
+# the most frequent ones of the Punkt English model
+ABBREVIATIONS = set("""
+    a.m p.m mr mrs ms dr prof rev st mt ft jr sr sen rep gov gen col lt capt sgt cmdr adm maj pres vs etc e.g i.e cf
+    inc corp co ltd bros dept univ assn est approx ca vol no nos fig pp ed eds al
+    u.s u.k u.n u.s.a e.u d.c n.y l.a b.c a.d
+    jan feb mar apr jun jul aug sep sept oct nov dec mon tue wed thu fri sat sun
+    ala ariz ark calif colo conn del fla ga ill ind kan ky la md mass mich minn miss mo mont neb nev okla ore pa tenn tex va vt wash wis
+""".split())
+
+# Capitalized words which start a sentence after an abbreviation or an initial (lowercase)
+SENTENCE_STARTERS = set("""
+    the a an in on at after as by for from to with it its this that these those there they their he his she her we our
+    but and however although while when during since if some many most all one two both each such other
+""".split())
+
+# A candidate sentence end: a word ending in ".", "?" or "!", possibly followed by closing quotes and brackets,
+# then whitespace and the next word
+_SENTENCE_END_RE = re.compile(r"(?<!\S)(\S*)([.?!])([\"')\]}]*)(\s+)(?=(\S+))", re.UNICODE)
+
+# As in Punkt: numbers, initials, and the characters which can't start a word
+_NUMERIC_RE = re.compile(r"^-?[\.,]?\d[\d,\.-]*$", re.UNICODE)
+_INITIAL_RE = re.compile(r"^[^\W\d]$", re.UNICODE)
+_NON_WORD_START = u"(\"`{[:;&#*@)}]-,"
+
+# The starting and ending quote rules of the Treebank tokenizer only match texts containing one of these.
+# Importing nltk.tokenize adds rules for the curly and angle quotes to the class-level lists of TreebankWordTokenizer
+# (u"\xab\u201c\u2018" and u"\xbb\u201d\u2019" in nltk 3.2.5, plus u"\u201e" and single backticks in later versions)
+_STARTING_QUOTE_RE = re.compile(u"[\"`\xab\u201c\u2018\u201e]", re.UNICODE)
+_ENDING_QUOTE_RE = re.compile(u"[\"'\xbb\u201d\u2019]", re.UNICODE)
+
+# The contraction rules of the Treebank tokenizer only match texts containing one of these
+_CONTRACTION_RE = re.compile(r"(?i)cannot|d'ye|gimme|gonna|gotta|lemme|mor'n|wanna|'t(?:is|was)", re.UNICODE)
+
+
+def is_sentence_end(word, punct, next_word):
+    """
+    Returns True if word + punct (e.g. u"York" + u".") ends a sentence when followed by next_word,
+    following the rules of the Punkt sentence tokenizer (see the module docstring).
+    """
+    if punct != u".":
+        return True
+    if word.endswith(u"."): # an ellipsis
+        return False
+    typ = word.lstrip(_NON_WORD_START).lower()
+    if _NUMERIC_RE.match(typ):
+        return not next_word[:1].islower()
+    if typ in ABBREVIATIONS or typ.rsplit(u"-", 1)[-1] in ABBREVIATIONS or _INITIAL_RE.match(typ):
+        return next_word[:1].isupper() and next_word.rstrip(u".,;:!?").lower() in SENTENCE_STARTERS
+    return True
+
+
+def _mark_sentence_end(match):
+    """Splits the final period off a sentence end, and replaces the whitespace after it with one space, as between two sentences"""
+    word, punct, closers, _, next_word = match.groups()
+    if not is_sentence_end(word, punct, next_word):
+        return match.group(0)
+    if punct == u"." and not word.endswith(u"."):
+        punct = u" ."
+    return word + punct + closers + u" "
+
+
+def split_sentences(text):
+    """Splits text into sentences at the ends found by is_sentence_end, like nltk.sent_tokenize"""
+    sentences, start = [], 0
+    for match in _SENTENCE_END_RE.finditer(text):
+        if is_sentence_end(match.group(1), match.group(2), match.group(5)):
+            sentences.append(text[start:match.end(3)])
+            start = match.end(4)
+    sentences.append(text[start:])
+    return sentences
+
+
+def treebank_tokenize(text):
+    """Same as TreebankWordTokenizer().tokenize(text), but skips the quote and contraction rules when the text has no quotes or contractions"""
+    tb = TreebankWordTokenizer
+    if _STARTING_QUOTE_RE.search(text):
+        for (regexp, substitution) in tb.STARTING_QUOTES:
+            text = regexp.sub(substitution, text)
+    for (regexp, substitution) in tb.PUNCTUATION:
+        text = regexp.sub(substitution, text)
+    for (regexp, substitution) in (tb.PARENS_BRACKETS, tb.DOUBLE_DASHES):
+        text = regexp.sub(substitution, text)
+
+    text = u" " + text + u" "
+    if _ENDING_QUOTE_RE.search(text):
+        for (regexp, substitution) in tb.ENDING_QUOTES:
+            text = regexp.sub(substitution, text)
+    if _CONTRACTION_RE.search(text):
+        for regexp in tb.CONTRACTIONS2 + tb.CONTRACTIONS3:
+            text = regexp.sub(r" \1 \2 ", text)
+    return text.split()
+
+
+def word_tokenize(text):
+    """
+    Tokenizes text like nltk.word_tokenize, i.e. like the Treebank tokenizer run on each sentence of split_sentences(text),
+    but with a single pass of the Treebank rules over the text.
+    """
+    return treebank_tokenize(_SENTENCE_END_RE.sub(_mark_sentence_end, text))
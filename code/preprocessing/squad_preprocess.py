@@ -16,14 +16,24 @@
 
 import os
 import sys
+import shutil
 import random
 import argparse
 import json
+import itertools
+import collections
+import hashlib
+import functools
+import multiprocessing
+from array import array
+from bisect import bisect_right
 import nltk
 import numpy as np
 from tqdm import tqdm
 from six.moves.urllib.request import urlretrieve
 
+from regex_tokenizer import word_tokenize as regex_word_tokenize
+
 reload(sys)
 sys.setdefaultencoding('utf8')
 random.seed(42)
@@ -35,13 +45,13 @@ SQUAD_BASE_URL = "https://rajpurkar.github.io/SQuAD-explorer/dataset/"
 def setup_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--data_dir", required=True)
+    parser.add_argument("--num_workers", type=int, default=0, help="Number of processes preprocessing the articles. Defaults to the number of CPUs.")
+    parser.add_argument("--tokenizer", choices=["nltk", "regex"], default="nltk", help="nltk: nltk.word_tokenize. regex: the faster approximation of it in regex_tokenizer.py.")
+    parser.add_argument("--train_file", default="", help="SQuAD-format training JSON to use instead of downloading train-v1.1.json")
+    parser.add_argument("--full", action="store_true", help="Preprocess all the articles again, rather than only the new or changed ones since the last run")
     return parser.parse_args()
 
 
-def write_to_file(out_file, line):
-    out_file.write(line.encode('utf8') + '\n')
-
-
 def data_from_json(filename):
     """Loads JSON data from filename and returns"""
     with open(filename) as data_file:
@@ -49,11 +59,165 @@ def data_from_json(filename):
     return data
 
 
-def tokenize(sequence):
+class _JSONStream(object):
+    """Decodes the JSON values of a file one at a time, reading it in chunks (see iter_articles)"""
+
+    def __init__(self, data_file, chunk_size):
+        self._file = data_file
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _read(self):
+        """Reads the next chunk into the buffer, dropping what has been decoded already. Returns False at the end of the file"""
+        if self._eof:
+            return False
+        chunk = self._file.read(self._chunk_size)
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        self._eof = not chunk
+        return not self._eof
+
+    def peek(self):
+        """Returns the next non-whitespace character, without consuming it ("" at the end of the file)"""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in " \t\n\r":
+                self._pos += 1
+            if self._pos < len(self._buffer) or not self._read():
+                return self._buffer[self._pos:self._pos+1]
+
+    def expect(self, chars):
+        """Consumes the next non-whitespace character, which must be one of chars, and returns it"""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of %r at offset %i of the JSON file, found %r" % (chars, self._file.tell() - len(self._buffer) + self._pos, char))
+        self._pos += 1
+        return char
+
+    def decode(self):
+        """Decodes and returns the next JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # A number at the end of the buffer may be cut, e.g. "12." for "12.5"
+                if self._eof or (end < len(self._buffer) and self._buffer[end] not in "0123456789.eE+-"):
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            self._read()
+
+
+def iter_articles(filename, chunk_size=1 << 20):
+    """
+    Yields the articles of a SQuAD-format JSON file (the elements of its "data" list) one at a time.
+    The file is decoded incrementally, so only the current article and a chunk of the file are held in memory,
+    rather than the whole dataset as with data_from_json.
+    """
+    with open(filename) as data_file:
+        stream = _JSONStream(data_file, chunk_size)
+        stream.expect("{")
+        if stream.peek() == "}":
+            return
+        while True:
+            key = stream.decode()
+            stream.expect(":")
+            if key == "data":
+                stream.expect("[")
+                if stream.peek() == "]":
+                    stream.expect("]")
+                else:
+                    while True:
+                        yield stream.decode()
+                        if stream.expect(",]") == "]":
+                            break
+            else:
+                stream.decode() # e.g. "version"
+            if stream.expect(",}") == "}":
+                return
+
+
+def iter_paragraphs(articles):
+    """Yields (article, paragraph, qas) for each paragraph of the given articles (e.g. from iter_articles)"""
+    for article in articles:
+        for paragraph in article['paragraphs']:
+            yield article, paragraph, paragraph['qas']
+
+
+# Bump this whenever tokenize or regex_tokenize change, to invalidate the cached tokenizations (see official_eval_helper.get_json_data)
+TOKENIZER_VERSION = 1
+
+
+def tokenize(sequence, return_offsets=False):
+    """
+    Tokenizes sequence (unicode) with nltk.word_tokenize. Returns a list of strings (lowercase, quotes as '"'),
+    and if return_offsets is True, the character offsets of the tokens in sequence (see token_offsets).
+    """
     tokens = [token.replace("``", '"').replace("''", '"').lower() for token in nltk.word_tokenize(sequence)]
+    if return_offsets:
+        return tokens, token_offsets(sequence, tokens)
+    return tokens
+
+
+def regex_tokenize(sequence, return_offsets=False):
+    """Like tokenize, with regex_tokenizer.word_tokenize instead of nltk.word_tokenize (much faster, but see the mismatches it documents)"""
+    tokens = [token.replace("``", '"').replace("''", '"').lower() for token in regex_word_tokenize(sequence)]
+    if return_offsets:
+        return tokens, token_offsets(sequence, tokens)
     return tokens
 
 
+# The texts a '"' token can come from: the tokenizers turn '"' into `` or '', which tokenize turns back into '"'
+QUOTE_FORMS = {u'"': (u'"', u"''", u"``")}
+
+# How many characters token_offsets looks ahead for a token that isn't where it's expected
+MAX_OFFSET_SKIP = 8
+
+
+def token_offsets(sequence, tokens):
+    """
+    Finds the tokens of tokenize or regex_tokenize in the text they come from, in a single pass.
+
+    Inputs:
+      sequence: string (unicode), the text that was tokenized
+      tokens: list of strings (lowercase)
+
+    Returns:
+      list (same length as tokens) of (start, end) pairs, such that sequence[start:end] is the text of each token
+        (up to case and quotes), or None for a token that the tokenizer changed and isn't found in the text
+        within MAX_OFFSET_SKIP characters (the offsets of the next tokens are still found)
+    """
+    text = sequence.lower()
+    num_chars = len(text)
+    offsets, pos = [], 0
+    for token in tokens:
+        while pos < num_chars and text[pos].isspace():
+            pos += 1
+        span = None
+        for form in QUOTE_FORMS.get(token, (token,)):
+            if text.startswith(form, pos):
+                span = (pos, pos + len(form))
+                break
+        if span is None:
+            # the tokenizer changed this token or the ones before: look for it a little further
+            for form in QUOTE_FORMS.get(token, (token,)):
+                start = text.find(form, pos, pos + len(form) + MAX_OFFSET_SKIP)
+                if start >= 0 and (span is None or start < span[0]):
+                    span = (start, start + len(form))
+        if span is not None:
+            pos = span[1]
+        offsets.append(span)
+    return offsets
+
+
+# The tokenizers selected by --tokenizer
+TOKENIZERS = {"nltk": tokenize, "regex": regex_tokenize}
+
+
 def total_exs(dataset):
     """
     Returns the total number of (context, question, answer) triples,
@@ -117,6 +281,9 @@ def get_char_word_loc_mapping(context, context_tokens):
     Return a mapping that maps from character locations to the corresponding token locations.
     If we're unable to complete the mapping e.g. because of special characters, we return None.
 
+    Note: preprocessing uses get_char_word_offsets and char_to_token instead, which give the same token locations
+    in linear time. This version is kept as their reference (see the alignment benchmark in benchmark.py).
+
     Inputs:
       context: string (unicode)
       context_tokens: list of strings (unicode)
@@ -148,110 +315,395 @@ def get_char_word_loc_mapping(context, context_tokens):
         return mapping
 
 
-def preprocess_and_write(dataset, tier, out_dir):
-    """Reads the dataset, extracts context, question, answer, tokenizes them,
-    and calculates answer span in terms of token indices.
-    Note: due to tokenization issues, and the fact that the original answer
-    spans are given in terms of characters, some examples are discarded because
-    we cannot get a clean span in terms of tokens.
-
-    This function produces the {train/dev}.{context/question/answer/span} files.
+def get_char_word_offsets(context, context_tokens):
+    """
+    Aligns the tokens to the characters of the context, in a single pass.
+    Gives the same token locations as get_char_word_loc_mapping: the characters of a token are matched
+    skipping spaces and newlines, and the token covers the len(token) character locations ending at its last character.
 
     Inputs:
-      dataset: read from JSON
-      tier: string ("train" or "dev")
-      out_dir: directory to write the preprocessed files
+      context: string (unicode)
+      context_tokens: list of strings (unicode)
+
     Returns:
-      the number of (context, question, answer) triples written to file by the dataset.
+      (token_starts, token_ends): lists of ints, the first and last (inclusive) character locations of each token.
+        e.g. if context = "hello world" and context_tokens = ["hello", "world"] then ([0, 6], [4, 10])
+      None if we're unable to align the tokens, e.g. because of special characters
+        (or if there are characters left after the last token, where get_char_word_loc_mapping raises an IndexError)
+    """
+    token_starts, token_ends = [], []
+    pos, num_chars = 0, len(context)
+
+    for token in context_tokens:
+        token = unicode(token)
+        if not token:
+            return None
+
+        # skip the spaces before the token
+        while pos < num_chars and (context[pos] == u' ' or context[pos] == u'\n'):
+            pos += 1
+
+        if context.startswith(token, pos) and u' ' not in token and u'\n' not in token:
+            pos += len(token)
+        else:
+            # the token doesn't appear as is: match its characters skipping spaces, as get_char_word_loc_mapping does
+            acc = []
+            while pos < num_chars and len(acc) < len(token):
+                if context[pos] != u' ' and context[pos] != u'\n':
+                    acc.append(context[pos])
+                pos += 1
+            if u''.join(acc) != token:
+                return None
+
+        token_starts.append(pos - len(token))
+        token_ends.append(pos - 1)
+
+    # there must be only spaces left
+    if context[pos:].strip(u' \n'):
+        return None
+
+    return token_starts, token_ends
+
+
+def char_to_token(offsets, char_loc):
     """
+    Returns the location of the token covering character location char_loc.
 
-    num_exs = 0 # number of examples written to file
+    Inputs:
+      offsets: (token_starts, token_ends) from get_char_word_offsets
+      char_loc: int
+
+    Raises:
+      KeyError if no token covers char_loc (e.g. it's a space), like the mapping of get_char_word_loc_mapping
+    """
+    token_starts, token_ends = offsets
+    token_idx = bisect_right(token_starts, char_loc) - 1
+    if token_idx < 0 or token_ends[token_idx] < char_loc:
+        raise KeyError(char_loc)
+    return token_idx
+
+
+def preprocess_article(article, tokenizer=tokenize):
+    """
+    Tokenizes the paragraphs and questions of one article, and calculates the answer spans in terms of token indices.
+    This runs in a worker process (see preprocess_and_write), so it must be a top-level function.
+
+    Inputs:
+      article: one element of dataset['data'], read from JSON
+      tokenizer: one of TOKENIZERS
+
+    Returns:
+      examples: list of (context, question, answer, answer_span) tuples of lines (utf8-encoded strings)
+      discarded: (num_mappingprob, num_tokenprob, num_spanalignprob), the numbers of examples discarded
+        for each kind of problem (see preprocess_and_write)
+    """
     num_mappingprob, num_tokenprob, num_spanalignprob = 0, 0, 0
     examples = []
 
-    for articles_id in tqdm(range(len(dataset['data'])), desc="Preprocessing {}".format(tier)):
+    article_paragraphs = article['paragraphs']
+    for pid in range(len(article_paragraphs)):
 
-        article_paragraphs = dataset['data'][articles_id]['paragraphs']
-        for pid in range(len(article_paragraphs)):
+        context = unicode(article_paragraphs[pid]['context']) # string
 
-            context = unicode(article_paragraphs[pid]['context']) # string
+        # The following replacements are suggested in the paper
+        # BidAF (Seo et al., 2016)
+        context = context.replace("''", '" ')
+        context = context.replace("``", '" ')
 
-            # The following replacements are suggested in the paper
-            # BidAF (Seo et al., 2016)
-            context = context.replace("''", '" ')
-            context = context.replace("``", '" ')
+        context_tokens = tokenizer(context) # list of strings (lowercase)
+        context = context.lower()
 
-            context_tokens = tokenize(context) # list of strings (lowercase)
-            context = context.lower()
+        qas = article_paragraphs[pid]['qas'] # list of questions
 
-            qas = article_paragraphs[pid]['qas'] # list of questions
+        token_offsets = get_char_word_offsets(context, context_tokens) # the first and last character locations of each context token
 
-            charloc2wordloc = get_char_word_loc_mapping(context, context_tokens) # charloc2wordloc maps the character location (int) of a context token to a pair giving (word (string), word loc (int)) of that token
+        if token_offsets is None: # there was a problem
+            num_mappingprob += len(qas)
+            continue # skip this context example
 
-            if charloc2wordloc is None: # there was a problem
-                num_mappingprob += len(qas)
-                continue # skip this context example
+        # for each question, process the question and answer and write to file
+        for qn in qas:
 
-            # for each question, process the question and answer and write to file
-            for qn in qas:
+            # read the question text and tokenize
+            question = unicode(qn['question']) # string
+            question_tokens = tokenizer(question) # list of strings
 
-                # read the question text and tokenize
-                question = unicode(qn['question']) # string
-                question_tokens = tokenize(question) # list of strings
+            # of the three answers, just take the first
+            ans_text = unicode(qn['answers'][0]['text']).lower() # get the answer text
+            ans_start_charloc = qn['answers'][0]['answer_start'] # answer start loc (character count)
+            ans_end_charloc = ans_start_charloc + len(ans_text) # answer end loc (character count) (exclusive)
 
-                # of the three answers, just take the first
-                ans_text = unicode(qn['answers'][0]['text']).lower() # get the answer text
-                ans_start_charloc = qn['answers'][0]['answer_start'] # answer start loc (character count)
-                ans_end_charloc = ans_start_charloc + len(ans_text) # answer end loc (character count) (exclusive)
+            # Check that the provided character spans match the provided answer text
+            if context[ans_start_charloc:ans_end_charloc] != ans_text:
+              # Sometimes this is misaligned, mostly because "narrow builds" of Python 2 interpret certain Unicode characters to have length 2 https://stackoverflow.com/questions/29109944/python-returns-length-of-2-for-single-unicode-character-string
+              # We should upgrade to Python 3 next year!
+              num_spanalignprob += 1
+              continue
 
-                # Check that the provided character spans match the provided answer text
-                if context[ans_start_charloc:ans_end_charloc] != ans_text:
-                  # Sometimes this is misaligned, mostly because "narrow builds" of Python 2 interpret certain Unicode characters to have length 2 https://stackoverflow.com/questions/29109944/python-returns-length-of-2-for-single-unicode-character-string
-                  # We should upgrade to Python 3 next year!
-                  num_spanalignprob += 1
-                  continue
+            # get word locs for answer start and end (inclusive)
+            ans_start_wordloc = char_to_token(token_offsets, ans_start_charloc) # answer start word loc
+            ans_end_wordloc = char_to_token(token_offsets, ans_end_charloc-1) # answer end word loc
+            assert ans_start_wordloc <= ans_end_wordloc
 
-                # get word locs for answer start and end (inclusive)
-                ans_start_wordloc = charloc2wordloc[ans_start_charloc][1] # answer start word loc
-                ans_end_wordloc = charloc2wordloc[ans_end_charloc-1][1] # answer end word loc
-                assert ans_start_wordloc <= ans_end_wordloc
+            # Check retrieved answer tokens match the provided answer text.
+            # Sometimes they won't match, e.g. if the context contains the phrase "fifth-generation"
+            # and the answer character span is around "generation",
+            # but the tokenizer regards "fifth-generation" as a single token.
+            # Then ans_tokens has "fifth-generation" but the ans_text is "generation", which doesn't match.
+            ans_tokens = context_tokens[ans_start_wordloc:ans_end_wordloc+1]
+            if "".join(ans_tokens) != "".join(ans_text.split()):
+                num_tokenprob += 1
+                continue # skip this question/answer pair
 
-                # Check retrieved answer tokens match the provided answer text.
-                # Sometimes they won't match, e.g. if the context contains the phrase "fifth-generation"
-                # and the answer character span is around "generation",
-                # but the tokenizer regards "fifth-generation" as a single token.
-                # Then ans_tokens has "fifth-generation" but the ans_text is "generation", which doesn't match.
-                ans_tokens = context_tokens[ans_start_wordloc:ans_end_wordloc+1]
-                if "".join(ans_tokens) != "".join(ans_text.split()):
-                    num_tokenprob += 1
-                    continue # skip this question/answer pair
+            example = (' '.join(context_tokens), ' '.join(question_tokens), ' '.join(ans_tokens), ' '.join([str(ans_start_wordloc), str(ans_end_wordloc)]))
+            examples.append(tuple(line.encode('utf8') for line in example))
 
-                examples.append((' '.join(context_tokens), ' '.join(question_tokens), ' '.join(ans_tokens), ' '.join([str(ans_start_wordloc), str(ans_end_wordloc)])))
+    return examples, (num_mappingprob, num_tokenprob, num_spanalignprob)
 
-                num_exs += 1
 
-    print "Number of (context, question, answer) triples discarded due to char -> token mapping problems: ", num_mappingprob
-    print "Number of (context, question, answer) triples discarded because character-based answer span is unaligned with tokenization: ", num_tokenprob
-    print "Number of (context, question, answer) triples discarded due character span alignment problems (usually Unicode problems): ", num_spanalignprob
-    print "Processed %i examples of total %i\n" % (num_exs, num_exs + num_mappingprob + num_tokenprob + num_spanalignprob)
+def imap_bounded(pool, func, iterable, window):
+    """
+    Like pool.imap(func, iterable), but takes at most window items from iterable ahead of the results.
+    (pool.imap reads the whole iterable as fast as it can, which would load a streamed dataset in memory.)
+    The window slides: a new item is sent to the pool as each result is taken, so the workers don't wait
+    for the slowest item of a batch of items before starting on the next ones.
+    """
+    iterable = iter(iterable)
+    pending = collections.deque()
+    while True:
+        for item in itertools.islice(iterable, window - len(pending)):
+            pending.append(pool.apply_async(func, (item,)))
+        if not pending:
+            return
+        yield pending.popleft().get()
 
-    # shuffle examples
-    indices = range(len(examples))
-    np.random.shuffle(indices)
 
-    with open(os.path.join(out_dir, tier +'.context'), 'w') as context_file,  \
-         open(os.path.join(out_dir, tier +'.question'), 'w') as question_file,\
-         open(os.path.join(out_dir, tier +'.answer'), 'w') as ans_text_file, \
-         open(os.path.join(out_dir, tier +'.span'), 'w') as span_file:
+def preprocess_and_write(articles, tier, out_dir, num_workers=None, tokenizer=tokenize, write_article_ids=False):
+    """Reads the dataset, extracts context, question, answer, tokenizes them,
+    and calculates answer span in terms of token indices.
+    Note: due to tokenization issues, and the fact that the original answer
+    spans are given in terms of characters, some examples are discarded because
+    we cannot get a clean span in terms of tokens.
 
-        for i in indices:
-            (context, question, answer, answer_span) = examples[i]
+    This function produces the {train/dev}.{context/question/answer/span} files.
+    The articles are preprocessed in parallel by num_workers processes (see preprocess_article).
+    The output doesn't depend on num_workers.
 
-            # write tokenized data to file
-            write_to_file(context_file, context)
-            write_to_file(question_file, question)
-            write_to_file(ans_text_file, answer)
-            write_to_file(span_file, answer_span)
+    Inputs:
+      articles: iterable of the articles of the dataset, e.g. dataset['data'] or iter_articles(filename)
+      tier: string ("train" or "dev")
+      out_dir: directory to write the preprocessed files
+      num_workers: number of processes. Defaults to the number of CPUs. 1 preprocesses in this process.
+      tokenizer: function tokenizing the contexts and questions, one of TOKENIZERS
+      write_article_ids: If True, articles yields (article_id, article) pairs,
+        and the id of the article of each example is written to {tier}.articles, line by line
+    Returns:
+      the number of (context, question, answer) triples written to file by the dataset.
+    """
+    num_workers = num_workers or multiprocessing.cpu_count()
+    if write_article_ids:
+        # The ids are queued in the order the articles are read, which is the order of their results
+        article_ids = collections.deque()
+        def record_ids(keyed_articles):
+            for (article_id, article) in keyed_articles:
+                article_ids.append(article_id)
+                yield article
+        articles = record_ids(articles)
+    pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+    # imap keeps the articles in order, so the examples are in the same order as when preprocessing serially
+    preprocess = functools.partial(preprocess_article, tokenizer=tokenizer)
+    results = imap_bounded(pool, preprocess, articles, 16 * num_workers) if pool else (preprocess(article) for article in articles)
+
+    num_exs = 0 # number of examples written to file
+    num_mappingprob, num_tokenprob, num_spanalignprob = 0, 0, 0
+
+    # The examples are streamed to temporary files in article order, recording the offset of each line,
+    # then copied to the output files in shuffled order. So only the line offsets are kept in memory.
+    names = ['context', 'question', 'answer', 'span'] + (['articles'] if write_article_ids else [])
+    out_paths = [os.path.join(out_dir, tier + '.' + name) for name in names]
+    tmp_paths = [path + '.tmp' for path in out_paths]
+    line_offsets = [array('l') for _ in names]
+    positions = [0 for _ in names]
+    try:
+        tmp_files = [open(path, 'w') for path in tmp_paths]
+        try:
+            for (examples, discarded) in tqdm(results, total=len(articles) if isinstance(articles, list) else None, unit="articles", desc="Preprocessing {}".format(tier)):
+                num_mappingprob += discarded[0]
+                num_tokenprob += discarded[1]
+                num_spanalignprob += discarded[2]
+                if write_article_ids:
+                    article_id = article_ids.popleft().encode('utf8')
+                    examples = [example + (article_id,) for example in examples]
+                for example in examples:
+                    for (i, line) in enumerate(example):
+                        line_offsets[i].append(positions[i])
+                        tmp_files[i].write(line + '\n')
+                        positions[i] += len(line) + 1
+                    num_exs += 1
+        except BaseException: # including KeyboardInterrupt
+            # Stop the workers now, rather than after they've tokenized all the queued articles
+            if pool:
+                pool.terminate()
+                pool.join()
+            raise
+        finally:
+            for tmp_file in tmp_files:
+                tmp_file.close()
+        if pool:
+            pool.close()
+            pool.join()
+
+        print "Number of (context, question, answer) triples discarded due to char -> token mapping problems: ", num_mappingprob
+        print "Number of (context, question, answer) triples discarded because character-based answer span is unaligned with tokenization: ", num_tokenprob
+        print "Number of (context, question, answer) triples discarded due character span alignment problems (usually Unicode problems): ", num_spanalignprob
+        print "Processed %i examples of total %i\n" % (num_exs, num_exs + num_mappingprob + num_tokenprob + num_spanalignprob)
+
+        # shuffle examples
+        indices = range(num_exs)
+        np.random.shuffle(indices)
+
+        # write tokenized data to file
+        for (tmp_path, out_path, offsets) in zip(tmp_paths, out_paths, line_offsets):
+            with open(tmp_path) as tmp_file, open(out_path, 'w') as out_file:
+                for i in indices:
+                    tmp_file.seek(offsets[i])
+                    out_file.write(tmp_file.readline())
+    finally:
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    return num_exs
+
+
+# The manifest of a split ({tier}.manifest.json, the MANIFEST_SUFFIX of data_shards.py) records the shards
+# of its data files and, for each article, its content hash and the shard holding its examples
+MANIFEST_VERSION = 1
+
+
+def keyed_articles(articles):
+    """Yields (article_id, article_hash, article) for the given articles. The id is the title, made unique by a #<n> suffix."""
+    counts = collections.Counter()
+    for article in articles:
+        title = u" ".join(unicode(article.get('title', u'')).split())
+        counts[title] += 1
+        article_id = title if counts[title] == 1 else u"%s#%i" % (title, counts[title])
+        yield article_id, hashlib.sha1(json.dumps(article, sort_keys=True)).hexdigest(), article
+
+
+def shard_files(out_dir, prefix):
+    """Returns the paths of the files of a shard, e.g. data/train.shard1.{context,question,answer,span,articles}"""
+    return [os.path.join(out_dir, prefix + '.' + name) for name in ['context', 'question', 'answer', 'span', 'articles']]
+
+
+def remove_articles(out_dir, prefix, new_prefix, article_ids):
+    """Copies the files of shard prefix to shard new_prefix, without the examples of the given articles"""
+    in_files = [open(path) for path in shard_files(out_dir, prefix)]
+    out_files = [open(path, 'w') for path in shard_files(out_dir, new_prefix)]
+    try:
+        for lines in itertools.izip(*in_files):
+            if lines[-1].rstrip('\n').decode('utf8') not in article_ids:
+                for (out_file, line) in zip(out_files, lines):
+                    out_file.write(line)
+    finally:
+        for f in in_files + out_files:
+            f.close()
+
+
+def preprocess_incremental(articles, tier, out_dir, num_workers=None, tokenizer=tokenize, full=False):
+    """
+    Like preprocess_and_write, but only preprocesses the articles that are new or changed since the last time,
+    according to the manifest of the split. Their examples are written to a new shard {tier}.shard<N>.*,
+    which the data code reads after the existing ones (see data_shards.py). The examples of changed or removed
+    articles are dropped by copying the shards holding them (without tokenizing them again).
+    The first time, or with another tokenizer, or if full is True, all the articles are preprocessed into one shard.
+
+    The files of the existing shards are never written to: the new and copied shards get new prefixes, and
+    the shards that are no longer used are deleted after the manifest is written. So an interrupted run
+    leaves the previous shards in use. Only the very first shard, when there's no data yet, is {tier}.*
+
+    Returns:
+      the number of (context, question, answer) triples written to the new shard.
+    """
+    manifest_path = os.path.join(out_dir, tier + ".manifest.json")
+    signature = "%s %i" % (tokenizer.__name__, TOKENIZER_VERSION)
+    manifest = None
+    manifest_path_exists = os.path.exists(manifest_path)
+    if manifest_path_exists:
+        with open(manifest_path) as fh:
+            manifest = json.load(fh)
+    obsolete = [] # prefixes of the shards to delete once the new manifest is written
+    if full or manifest is None or manifest.get("version") != MANIFEST_VERSION or manifest.get("tokenizer") != signature:
+        # Preprocess everything again. The shard numbers go on from the old manifest, so that the new shard
+        # doesn't overwrite an old one, which stays in use until the new manifest is written
+        obsolete = list(manifest.get("shards", [])) if manifest else []
+        next_shard = manifest.get("next_shard", 1) if manifest else 1
+        manifest = {"version": MANIFEST_VERSION, "tokenizer": signature, "next_shard": next_shard, "shards": [], "articles": {}}
+    article_info = manifest["articles"] # article id -> [content hash, shard prefix]
+    shards = manifest["shards"]
+
+    seen, stale, new_hashes = set(), set(), {}
+    def changed_articles():
+        for (article_id, article_hash, article) in keyed_articles(articles):
+            seen.add(article_id)
+            info = article_info.get(article_id)
+            if info is not None and info[0] == article_hash:
+                continue
+            if info is not None:
+                stale.add(article_id)
+            new_hashes[article_id] = article_hash
+            yield article_id, article
+
+    def next_prefix():
+        manifest["next_shard"] += 1
+        return "%s.shard%i" % (tier, manifest["next_shard"] - 1)
+
+    if manifest_path_exists or os.path.exists(shard_files(out_dir, tier)[0]):
+        prefix = next_prefix()
+        obsolete.append(tier) # deleted unless still listed in the manifest, e.g. data preprocessed without one
+    else:
+        prefix = tier
+    num_exs = preprocess_and_write(changed_articles(), prefix, out_dir, num_workers, tokenizer, write_article_ids=True)
+    stale.update(set(article_info) - seen) # the removed articles
+    print "%s: %i new or changed articles, %i unchanged, %i changed or removed" % (tier, len(new_hashes), len(seen) - len(new_hashes), len(stale))
+
+    # Copy the shards with examples of changed or removed articles, without those
+    for old_prefix in sorted(set(article_info[article_id][1] for article_id in stale)):
+        new_prefix = next_prefix()
+        remove_articles(out_dir, old_prefix, new_prefix, stale)
+        shards[shards.index(old_prefix)] = new_prefix
+        for info in article_info.itervalues():
+            if info[1] == old_prefix:
+                info[1] = new_prefix
+        obsolete.append(old_prefix)
+    for article_id in stale:
+        del article_info[article_id]
+
+    if new_hashes:
+        shards.append(prefix)
+        for (article_id, article_hash) in new_hashes.iteritems():
+            article_info[article_id] = [article_hash, prefix]
+    else:
+        obsolete.append(prefix)
+    # Drop the shards left without articles
+    used = set(info[1] for info in article_info.itervalues())
+    obsolete.extend(p for p in shards if p not in used)
+    manifest["shards"] = [p for p in shards if p in used]
+
+    with open(manifest_path + ".tmp", 'w') as fh:
+        json.dump(manifest, fh)
+    os.rename(manifest_path + ".tmp", manifest_path)
+
+    for old_prefix in set(obsolete) - set(manifest["shards"]):
+        for path in shard_files(out_dir, old_prefix):
+            if os.path.exists(path):
+                os.remove(path)
+        # The compiled data of a split is kept next to its first shard (see compiled_data.compiled_dir)
+        old_compiled_dir = os.path.join(out_dir, old_prefix + ".compiled")
+        if os.path.isdir(old_compiled_dir):
+            shutil.rmtree(old_compiled_dir)
+
+    return num_exs
 
 
 def main():
@@ -266,25 +718,21 @@ def main():
     train_filename = "train-v1.1.json"
     dev_filename = "dev-v1.1.json"
 
-    # download train set
-    maybe_download(SQUAD_BASE_URL, train_filename, args.data_dir, 30288272L)
-
-    # read train set
-    train_data = data_from_json(os.path.join(args.data_dir, train_filename))
-    print "Train data has %i examples total" % total_exs(train_data)
+    # download train set, unless using another training file
+    if args.train_file:
+        train_path = args.train_file
+    else:
+        maybe_download(SQUAD_BASE_URL, train_filename, args.data_dir, 30288272L)
+        train_path = os.path.join(args.data_dir, train_filename)
 
-    # preprocess train set and write to file
-    preprocess_and_write(train_data, 'train', args.data_dir)
+    # preprocess the new or changed articles of the train set and write to file, reading the articles one at a time
+    preprocess_incremental(iter_articles(train_path), 'train', args.data_dir, args.num_workers, TOKENIZERS[args.tokenizer], args.full)
 
     # download dev set
     maybe_download(SQUAD_BASE_URL, dev_filename, args.data_dir, 4854279L)
 
-    # read dev set
-    dev_data = data_from_json(os.path.join(args.data_dir, dev_filename))
-    print "Dev data has %i examples total" % total_exs(dev_data)
-
     # preprocess dev set and write to file
-    preprocess_and_write(dev_data, 'dev', args.data_dir)
+    preprocess_incremental(iter_articles(os.path.join(args.data_dir, dev_filename)), 'dev', args.data_dir, args.num_workers, TOKENIZERS[args.tokenizer], args.full)
 
 
 if __name__ == '__main__':
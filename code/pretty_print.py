@@ -48,7 +48,7 @@ def print_example(word2id, context_tokens, qn_tokens, true_ans_start, true_ans_e
     Pretty-print the results for one example.
 
     Inputs:
-      word2id: dictionary mapping word (string) to word id (int)
+      word2id: Vocab mapping word (string) to word id (int)
       context_tokens, qn_tokens: lists of strings, no padding.
         Note these do *not* contain UNKs.
       true_ans_start, true_ans_end, pred_ans_start, pred_ans_end: ints
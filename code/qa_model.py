@@ -21,6 +21,8 @@ import time
 import logging
 import os
 import sys
+import json
+import glob
 
 import numpy as np
 import tensorflow as tf
@@ -28,9 +30,12 @@ from tensorflow.python.ops import variable_scope as vs
 from tensorflow.python.ops import embedding_ops
 
 from evaluate import exact_match_score, f1_score
-from data_batcher import get_batch_generator
+from data_batcher import get_batch_jobs, BatchAssembler, BatchPrefetcher
+from tfrecord_data import make_dataset, load_tfrecord, PipelineEpoch
+from compiled_data import source_fingerprint
 from pretty_print import print_example
 from modules import RNNEncoder, SimpleSoftmaxLayer
+from vocab import quantize_embeddings
 
 logging.basicConfig(level=logging.INFO)
 
@@ -38,20 +43,26 @@ logging.basicConfig(level=logging.INFO)
 class QAModel(object):
     """Top-level Question Answering module"""
 
-    def __init__(self, FLAGS, id2word, word2id, emb_matrix):
+    # Whether the model has a self-attention layer over the context (see batch_generator)
+    uses_self_attention = False
+
+    def __init__(self, FLAGS, id2word, word2id, emb_matrix, inference_only=False):
         """
         Initializes the QA model.
 
         Inputs:
           FLAGS: the flags passed in from main.py
-          id2word: dictionary mapping word idx (int) to word (string)
-          word2id: dictionary mapping word (string) to word idx (int)
+          id2word: numpy array mapping word idx (int) to word (string)
+          word2id: Vocab mapping word (string) to word idx (int)
           emb_matrix: numpy array shape (400002, embedding_size) containing pre-traing GloVe embeddings
+          inference_only: If True, build the graph for computing the answer distributions only (e.g. to export it, see frozen_model.py):
+            without dropout, loss, gradients, optimizer or global_step. Its saver restores the model weights of a training checkpoint.
         """
         print "Initializing the QAModel..."
         self.FLAGS = FLAGS
         self.id2word = id2word
         self.word2id = word2id
+        self.inference_only = inference_only
 
         self.q2c_attn_dist=None
         self.c2q_attn_dist=None
@@ -61,24 +72,29 @@ class QAModel(object):
             self.add_placeholders()
             self.add_embedding_layer(emb_matrix)
             self.build_graph()
-            self.add_loss()
-
-        # Define trainable parameters, gradient, gradient norm, and clip by gradient norm
-        params = tf.trainable_variables()
-        gradients = tf.gradients(self.loss, params)
-        self.gradient_norm = tf.global_norm(gradients)
-        clipped_gradients, _ = tf.clip_by_global_norm(gradients, FLAGS.max_gradient_norm)
-        self.param_norm = tf.global_norm(params)
-
-        # Define optimizer and updates
-        # (updates is what you need to fetch in session.run to do a gradient update)
-        self.global_step = tf.Variable(0, name="global_step", trainable=False)
-        opt = tf.train.AdamOptimizer(learning_rate=FLAGS.learning_rate) # you can try other optimizers
-        self.updates = opt.apply_gradients(zip(clipped_gradients, params), global_step=self.global_step)
+            if not inference_only:
+                self.add_loss()
+
+        if not inference_only:
+            # Define trainable parameters, gradient, gradient norm, and clip by gradient norm
+            # The loss is scaled by loss_weight (see run_train_iter), so that batches of different sizes have the right weight
+            params = tf.trainable_variables()
+            gradients = tf.gradients(self.loss * self.loss_weight, params)
+            self.gradient_norm = tf.global_norm(gradients)
+            clipped_gradients, _ = tf.clip_by_global_norm(gradients, FLAGS.max_gradient_norm)
+            self.param_norm = tf.global_norm(params)
+
+            # Define optimizer and updates
+            # (updates is what you need to fetch in session.run to do a gradient update)
+            self.global_step = tf.Variable(0, name="global_step", trainable=False)
+            opt = tf.train.AdamOptimizer(learning_rate=FLAGS.learning_rate) # you can try other optimizers
+            self.updates = opt.apply_gradients(zip(clipped_gradients, params), global_step=self.global_step)
 
         # Define savers (for checkpointing) and summaries (for tensorboard)
-        self.saver = tf.train.Saver(tf.global_variables(), max_to_keep=FLAGS.keep)
-        self.bestmodel_saver = tf.train.Saver(tf.global_variables(), max_to_keep=1)
+        # The embedding matrix is not checkpointed: it's loaded from emb_matrix by initialize_embeddings
+        saved_variables = [v for v in tf.global_variables() if v not in self.embedding_variables]
+        self.saver = tf.train.Saver(saved_variables, max_to_keep=FLAGS.keep)
+        self.bestmodel_saver = tf.train.Saver(saved_variables, max_to_keep=1)
         self.summaries = tf.summary.merge_all()
 
 
@@ -88,16 +104,56 @@ class QAModel(object):
         """
         # Add placeholders for inputs.
         # These are all batch-first: the None corresponds to batch_size and
-        # allows you to run the same model with variable batch_size
-        self.context_ids = tf.placeholder(tf.int32, shape=[None, self.FLAGS.context_len])
-        self.context_mask = tf.placeholder(tf.int32, shape=[None, self.FLAGS.context_len])
-        self.qn_ids = tf.placeholder(tf.int32, shape=[None, self.FLAGS.question_len])
-        self.qn_mask = tf.placeholder(tf.int32, shape=[None, self.FLAGS.question_len])
-        self.ans_span = tf.placeholder(tf.int32, shape=[None, 2])
+        # allows you to run the same model with variable batch_size.
+        # The context and question lengths are also variable (at most context_len and question_len),
+        # so that batches can be padded only to their longest example (see FLAGS.dynamic_padding)
+        # With --input_pipeline=tfdata, they default to the next training batch of the tf.data pipeline
+        # (see add_input_pipeline), so training steps don't feed them. Evaluation still feeds them.
+        if self.FLAGS.input_pipeline == "tfdata" and not self.inference_only:
+            context_ids, context_mask, qn_ids, qn_mask, ans_span = self.add_input_pipeline()
+            self.context_ids = tf.placeholder_with_default(context_ids, shape=[None, None])
+            self.context_mask = tf.placeholder_with_default(context_mask, shape=[None, None])
+            self.qn_ids = tf.placeholder_with_default(qn_ids, shape=[None, None])
+            self.qn_mask = tf.placeholder_with_default(qn_mask, shape=[None, None])
+            self.ans_span = tf.placeholder_with_default(ans_span, shape=[None, 2])
+        else:
+            self.context_ids = tf.placeholder(tf.int32, shape=[None, None])
+            self.context_mask = tf.placeholder(tf.int32, shape=[None, None])
+            self.qn_ids = tf.placeholder(tf.int32, shape=[None, None])
+            self.qn_mask = tf.placeholder(tf.int32, shape=[None, None])
+            self.ans_span = tf.placeholder(tf.int32, shape=[None, 2])
+        self.batch_size = tf.shape(self.context_ids)[0]
 
         # Add a placeholder to feed in the keep probability (for dropout).
         # This is necessary so that we can instruct the model to use dropout when training, but not when testing
-        self.keep_prob = tf.placeholder_with_default(1.0, shape=())
+        # In the inference-only graph, it's the python float 1.0, so that no dropout ops are added at all
+        self.keep_prob = 1.0 if self.inference_only else tf.placeholder_with_default(1.0, shape=())
+
+        # Add a placeholder to feed in the weight of the batch in the gradient update
+        self.loss_weight = tf.placeholder_with_default(1.0, shape=())
+
+
+    def add_input_pipeline(self):
+        """
+        Adds the tf.data pipeline giving the training batches (see tfrecord_data.make_dataset),
+        with the same batching options as batch_generator.
+        The pipeline is started for each epoch by feeding the path of the TFRecord file
+        into self.train_data_path and a shuffling seed into self.train_seed
+        when running self.train_iterator.initializer (see train_batches).
+
+        Returns:
+          The tensors (context_ids, context_mask, qn_ids, qn_mask, ans_span) of the next batch.
+        """
+        self.train_data_path = tf.placeholder(tf.string, shape=[])
+        self.train_seed = tf.placeholder(tf.int64, shape=[])
+        # The examples are shuffled within a buffer the size of the pools of data_batcher.refill_batches
+        dataset = make_dataset(self.train_data_path, self.FLAGS.batch_size, self.FLAGS.context_len, self.FLAGS.question_len,
+                               discard_long=True, dynamic_padding=self.FLAGS.dynamic_padding, bucket_width=self.FLAGS.bucket_width,
+                               shuffle_buffer=self.FLAGS.batch_size * 160, shuffle_seed=self.train_seed, prefetch_batches=self.FLAGS.prefetch_batches,
+                               num_parallel_calls=max(self.FLAGS.prefetch_workers, 1))
+        self.train_iterator = dataset.make_initializable_iterator()
+        self.train_next_batch = self.train_iterator.get_next()
+        return self.train_next_batch
 
 
     def add_embedding_layer(self, emb_matrix):
@@ -107,17 +163,140 @@ class QAModel(object):
         Inputs:
           emb_matrix: shape (400002, embedding_size).
             The GloVe vectors, plus vectors for PAD and UNK.
-        """
-        with vs.variable_scope("embeddings"):
-
-            # Note: the embedding matrix is a tf.constant which means it's not a trainable parameter
-            embedding_matrix = tf.constant(emb_matrix, dtype=tf.float32, name="emb_matrix") # shape (400002, embedding_size)
+            Depending on FLAGS.emb_dtype, they are stored in the graph as float32, float16,
+            or int8 with a float32 scale per row, and converted back to float32 after the lookup.
+        """
+        emb_values, emb_scales = quantize_embeddings(emb_matrix, self.FLAGS.emb_dtype)
+
+        # There is no GPU kernel to gather int8 values, so keep the int8 matrix on the CPU
+        with vs.variable_scope("embeddings"), tf.device("/cpu:0" if self.FLAGS.emb_dtype == "int8" else None):
+
+            # Note: the embedding matrix is a non-trainable variable, so it's not a trainable parameter.
+            # It's initialized by feeding emb_matrix into emb_matrix_placeholder (see initialize_embeddings),
+            # rather than being a tf.constant, so that the matrix isn't serialized into the GraphDef.
+            self.emb_matrix_placeholder = tf.placeholder(tf.as_dtype(emb_values.dtype), shape=emb_values.shape, name="emb_matrix_placeholder")
+            self.embedding_matrix = tf.Variable(self.emb_matrix_placeholder, trainable=False, name="emb_matrix") # shape (400002, embedding_size)
+            self.embedding_variables = [self.embedding_matrix]
+            self.embedding_feed = {self.emb_matrix_placeholder: emb_values}
+
+            # For int8 storage, the scale of each row
+            self.embedding_scales = None
+            if emb_scales is not None:
+                self.emb_scales_placeholder = tf.placeholder(tf.float32, shape=emb_scales.shape, name="emb_scales_placeholder")
+                self.embedding_scales = tf.Variable(self.emb_scales_placeholder, trainable=False, name="emb_scales") # shape (400002, 1)
+                self.embedding_variables.append(self.embedding_scales)
+                self.embedding_feed[self.emb_scales_placeholder] = emb_scales
 
             # Get the word embeddings for the context and question,
             # using the placeholders self.context_ids and self.qn_ids
-            self.context_embs = embedding_ops.embedding_lookup(embedding_matrix, self.context_ids) # shape (batch_size, context_len, embedding_size)
-            self.qn_embs = embedding_ops.embedding_lookup(embedding_matrix, self.qn_ids) # shape (batch_size, question_len, embedding_size)
+            self.context_embs = self.lookup_embeddings(self.context_ids) # shape (batch_size, context_len, embedding_size)
+            self.qn_embs = self.lookup_embeddings(self.qn_ids) # shape (batch_size, question_len, embedding_size)
+
+
+    def lookup_embeddings(self, ids):
+        """
+        Looks up the embeddings of ids, and converts them back to float32.
+
+        Inputs:
+          ids: int32 Tensor shape (batch_size, seq_len)
 
+        Returns:
+          embs: float32 Tensor shape (batch_size, seq_len, embedding_size)
+        """
+        embs = tf.cast(embedding_ops.embedding_lookup(self.embedding_matrix, ids), tf.float32)
+        if self.embedding_scales is not None:
+            embs = embs * embedding_ops.embedding_lookup(self.embedding_scales, ids) # scales have shape (batch_size, seq_len, 1)
+        return embs
+
+
+    def initialize_embeddings(self, session):
+        """
+        Loads the embedding matrix into the graph.
+        The embedding matrix isn't part of the checkpoints, so this needs to be called
+        after restoring a checkpoint (initializing all variables also initializes it).
+
+        Inputs:
+          session: TensorFlow session
+        """
+        session.run([v.initializer for v in self.embedding_variables], self.get_initializer_feed())
+
+    def get_initializer_feed(self):
+        """Returns the feed_dict needed to run tf.global_variables_initializer() for this model"""
+        return self.embedding_feed
+
+
+    def get_batch_cost(self):
+        """
+        Returns the budget used to fill the batches, from FLAGS.
+
+        Returns:
+          max_batch_cost, cost_exponent: see data_batcher.split_into_batches.
+            max_batch_cost is 0 if the batches have FLAGS.batch_size examples.
+        """
+        if self.uses_self_attention and self.FLAGS.max_batch_attn:
+            return self.FLAGS.max_batch_attn, 2
+        return self.FLAGS.max_batch_tokens, 1
+
+    def batch_generator(self, context_path, qn_path, ans_path, discard_long, random=True, full_padding=False, resume_state=None):
+        """
+        Returns a BatchPrefetcher iterating over the Batches of the given {train/dev} data files,
+        using the batch size (or cost budget, see get_batch_cost), lengths, data format and prefetching set in FLAGS.
+        Use it in a with statement, so that its threads are stopped if you stop iterating early.
+        The arrays of a Batch are overwritten a few batches later, so use each Batch in its iteration only.
+
+        Inputs:
+          context_path, qn_path, ans_path: paths to {train/dev}.{context/question/answer} data files
+          discard_long: If True, discard examples longer than context_len or question_len
+            (or with FLAGS.window_stride, split the long contexts into windows that contain the answer, see data_batcher.window_examples).
+            If False, truncate them instead.
+          random: is the dataset shuffled ?
+          full_padding: If True, pad all the batches to context_len and question_len, regardless of FLAGS.dynamic_padding
+          resume_state: If not None, the iter_state of a Batch from an earlier batch_generator with the same arguments,
+            to continue from (see data_batcher.get_batch_jobs)
+        """
+        max_batch_cost, cost_exponent = self.get_batch_cost()
+
+        # The batch arrays are reused once the batch has been run, so don't keep Batches across iterations.
+        # There is a slot for each prefetched batch, plus the one being run.
+        assembler = BatchAssembler(num_slots=self.FLAGS.prefetch_batches + 2)
+        batch_jobs = get_batch_jobs(self.word2id, context_path, qn_path, ans_path, self.FLAGS.batch_size,
+                                    context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len,
+                                    discard_long=discard_long, random=random, compiled=self.FLAGS.compiled_data,
+                                    dynamic_padding=self.FLAGS.dynamic_padding and not full_padding, bucket_width=self.FLAGS.bucket_width,
+                                    max_batch_cost=max_batch_cost, cost_exponent=cost_exponent, assembler=assembler,
+                                    resume_state=resume_state, global_shuffle=self.FLAGS.global_shuffle,
+                                    window_stride=self.FLAGS.window_stride if discard_long else 0)
+        return BatchPrefetcher(batch_jobs, num_workers=self.FLAGS.prefetch_workers, max_batches=self.FLAGS.prefetch_batches)
+
+    def train_batches(self, session, context_path, qn_path, ans_path, resume_state=None):
+        """
+        Returns the training batches of one epoch, as a context manager to iterate over:
+        a BatchPrefetcher over Batch objects (see batch_generator),
+        or with --input_pipeline=tfdata, a tfrecord_data.PipelineEpoch over the tf.data pipeline,
+        which it starts from the TFRecord version of the data (written first if needed).
+
+        resume_state: If not None, the state after the last batch done (batch.iter_state,
+          or PipelineEpoch.state with --input_pipeline=tfdata): the epoch continues after it.
+          It's ignored if it comes from the other input pipeline or data format,
+          or from other data files or batching flags (see data_batcher.get_batch_jobs).
+        """
+        if self.FLAGS.input_pipeline == "tfdata":
+            if resume_state is not None and "seed" not in resume_state:
+                logging.info("The saved position in the training data is for --input_pipeline=feed_dict: starting the epoch from the beginning")
+                resume_state = None
+            data_key = {"sources": source_fingerprint([context_path, qn_path, ans_path]),
+                        "batching": {"batch_size": self.FLAGS.batch_size, "context_len": self.FLAGS.context_len, "question_len": self.FLAGS.question_len,
+                                     "dynamic_padding": self.FLAGS.dynamic_padding, "bucket_width": self.FLAGS.bucket_width}}
+            if resume_state is not None and resume_state.get("data") != data_key:
+                logging.info("The saved position in the training data is for other data files or batching flags: starting the epoch from the beginning")
+                resume_state = None
+            data_path = load_tfrecord(self.word2id, context_path, qn_path, ans_path)
+            return PipelineEpoch(session, self.train_iterator, {self.train_data_path: data_path}, self.train_seed, self.train_next_batch, resume_state, data_key)
+
+        if resume_state is not None and resume_state.get("compiled") != self.FLAGS.compiled_data:
+            logging.info("The saved position in the training data is for another --input_pipeline or --compiled_data: starting the epoch from the beginning")
+            resume_state = None
+        return self.batch_generator(context_path, qn_path, ans_path, discard_long=True, resume_state=resume_state)
 
     def build_graph(self):
         """Builds the main part of the graph for the model, starting from the input embeddings to the final distributions for the answer span.
@@ -173,7 +352,7 @@ class QAModel(object):
 
         Inputs:
           session: TensorFlow session
-          batch: a Batch object
+          batch: a Batch object, or None to take the next batch of the tf.data pipeline (see add_input_pipeline)
           summary_writer: for Tensorboard
 
         Returns:
@@ -181,26 +360,37 @@ class QAModel(object):
           global_step: The current number of training iterations we've done
           param_norm: Global norm of the parameters
           gradient_norm: Global norm of the gradients
+          batch_size: The number of examples in the batch
+
+        Raises:
+          tf.errors.OutOfRangeError: if batch is None and the tf.data pipeline is at the end of the epoch
         """
         # Match up our input data with the placeholders
         input_feed = {}
-        input_feed[self.context_ids] = batch.context_ids
-        input_feed[self.context_mask] = batch.context_mask
-        input_feed[self.qn_ids] = batch.qn_ids
-        input_feed[self.qn_mask] = batch.qn_mask
-        input_feed[self.ans_span] = batch.ans_span
+        if batch is not None:
+            input_feed[self.context_ids] = batch.context_ids
+            input_feed[self.context_mask] = batch.context_mask
+            input_feed[self.qn_ids] = batch.qn_ids
+            input_feed[self.qn_mask] = batch.qn_mask
+            input_feed[self.ans_span] = batch.ans_span
         input_feed[self.keep_prob] = 1.0 - self.FLAGS.dropout # apply dropout
 
+        # With a batch cost budget, batches have different numbers of examples.
+        # The loss is averaged over the batch, so weight it by the batch size to give each example
+        # the same weight as in a batch of FLAGS.batch_size examples.
+        if self.get_batch_cost()[0]:
+            input_feed[self.loss_weight] = batch.batch_size / float(self.FLAGS.batch_size)
+
         # output_feed contains the things we want to fetch.
-        output_feed = [self.updates, self.summaries, self.loss, self.global_step, self.param_norm, self.gradient_norm]
+        output_feed = [self.updates, self.summaries, self.loss, self.global_step, self.param_norm, self.gradient_norm, self.batch_size]
 
         # Run the model
-        [_, summaries, loss, global_step, param_norm, gradient_norm] = session.run(output_feed, input_feed)
+        [_, summaries, loss, global_step, param_norm, gradient_norm, batch_size] = session.run(output_feed, input_feed)
 
         # All summaries in the graph are added to Tensorboard
         summary_writer.add_summary(summaries, global_step)
 
-        return loss, global_step, param_norm, gradient_norm
+        return loss, global_step, param_norm, gradient_norm, batch_size
 
 
     def get_loss(self, session, batch):
@@ -367,18 +557,19 @@ class QAModel(object):
         # which are longer than our context_len or question_len.
         # We need to do this because if, for example, the true answer is cut
         # off the context, then the loss function is undefined.
-        for batch in get_batch_generator(self.word2id, dev_context_path, dev_qn_path, dev_ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=True):
+        with self.batch_generator(dev_context_path, dev_qn_path, dev_ans_path, discard_long=True) as batches:
+            for batch in batches:
 
-            # Get loss for this batch
-            loss = self.get_loss(session, batch)
-            curr_batch_size = batch.batch_size
-            loss_per_batch.append(loss * curr_batch_size)
-            batch_lengths.append(curr_batch_size)
+                # Get loss for this batch
+                loss = self.get_loss(session, batch)
+                curr_batch_size = batch.batch_size
+                loss_per_batch.append(loss * curr_batch_size)
+                batch_lengths.append(curr_batch_size)
 
         # Calculate average loss
         total_num_examples = sum(batch_lengths)
         toc = time.time()
-        print "Computed dev loss over %i examples in %.2f seconds" % (total_num_examples, toc-tic)
+        print "Computed dev loss over %i examples in %.2f seconds (%.2f seconds waiting for batches)" % (total_num_examples, toc-tic, batches.wait_time)
 
         # Overall loss is total loss divided by total number of examples
         dev_loss = sum(loss_per_batch) / float(total_num_examples)
@@ -422,47 +613,48 @@ class QAModel(object):
 
         # Note here we select discard_long=False because we want to sample from the entire dataset
         # That means we're truncating, rather than discarding, examples with too-long context or questions
-        for batch in get_batch_generator(self.word2id, context_path, qn_path, ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=False):
+        with self.batch_generator(context_path, qn_path, ans_path, discard_long=False) as batches:
+            for batch in batches:
+
+                pred_start_pos, pred_end_pos = self.get_start_end_pos(session, batch)
 
-            pred_start_pos, pred_end_pos = self.get_start_end_pos(session, batch)
+                # Convert the start and end positions to lists length batch_size
+                pred_start_pos = pred_start_pos.tolist() # list length batch_size
+                pred_end_pos = pred_end_pos.tolist() # list length batch_size
 
-            # Convert the start and end positions to lists length batch_size
-            pred_start_pos = pred_start_pos.tolist() # list length batch_size
-            pred_end_pos = pred_end_pos.tolist() # list length batch_size
+                for ex_idx, (pred_ans_start, pred_ans_end, true_ans_tokens) in enumerate(zip(pred_start_pos, pred_end_pos, batch.ans_tokens)):
+                    example_num += 1
 
-            for ex_idx, (pred_ans_start, pred_ans_end, true_ans_tokens) in enumerate(zip(pred_start_pos, pred_end_pos, batch.ans_tokens)):
-                example_num += 1
+                    # Get the predicted answer
+                    # Important: batch.context_tokens contains the original words (no UNKs)
+                    # You need to use the original no-UNK version when measuring F1/EM
+                    pred_ans_tokens = batch.context_tokens[ex_idx][pred_ans_start : pred_ans_end + 1]
+                    pred_answer = " ".join(pred_ans_tokens)
 
-                # Get the predicted answer
-                # Important: batch.context_tokens contains the original words (no UNKs)
-                # You need to use the original no-UNK version when measuring F1/EM
-                pred_ans_tokens = batch.context_tokens[ex_idx][pred_ans_start : pred_ans_end + 1]
-                pred_answer = " ".join(pred_ans_tokens)
+                    # Get true answer (no UNKs)
+                    true_answer = " ".join(true_ans_tokens)
 
-                # Get true answer (no UNKs)
-                true_answer = " ".join(true_ans_tokens)
+                    # Calc F1/EM
+                    f1 = f1_score(pred_answer, true_answer)
+                    em = exact_match_score(pred_answer, true_answer)
+                    f1_total += f1
+                    em_total += em
 
-                # Calc F1/EM
-                f1 = f1_score(pred_answer, true_answer)
-                em = exact_match_score(pred_answer, true_answer)
-                f1_total += f1
-                em_total += em
+                    # Optionally pretty-print
+                    if print_to_screen:
+                        print_example(self.word2id, batch.context_tokens[ex_idx], batch.qn_tokens[ex_idx], batch.ans_span[ex_idx, 0], batch.ans_span[ex_idx, 1], pred_ans_start, pred_ans_end, true_answer, pred_answer, f1, em)
 
-                # Optionally pretty-print
-                if print_to_screen:
-                    print_example(self.word2id, batch.context_tokens[ex_idx], batch.qn_tokens[ex_idx], batch.ans_span[ex_idx, 0], batch.ans_span[ex_idx, 1], pred_ans_start, pred_ans_end, true_answer, pred_answer, f1, em)
+                    if num_samples != 0 and example_num >= num_samples:
+                        break
 
                 if num_samples != 0 and example_num >= num_samples:
                     break
 
-            if num_samples != 0 and example_num >= num_samples:
-                break
-
         f1_total /= example_num
         em_total /= example_num
 
         toc = time.time()
-        logging.info("Calculating F1/EM for %i examples in %s set took %.2f seconds" % (example_num, dataset, toc-tic))
+        logging.info("Calculating F1/EM for %i examples in %s set took %.2f seconds (%.2f seconds waiting for batches)" % (example_num, dataset, toc-tic, batches.wait_time))
 
         return f1_total, em_total
 
@@ -480,51 +672,44 @@ class QAModel(object):
         total_end_dists = []
         f1_em_scores = []
         example_num = 0
-        for batch in get_batch_generator(
-            self.word2id,
-            context_path,
-            qn_path,
-            ans_path,
-            self.FLAGS.batch_size,
-            context_len=self.FLAGS.context_len,
-            question_len=self.FLAGS.question_len,
-            discard_long=False,
-            random=False):
-
-            pred_start_dists, pred_end_dists = self.get_prob_dists(session, batch)
-            pred_start_pos, pred_end_pos = self.get_start_end_pos(session, batch)
-
-            # Convert the start and end positions to lists length batch_size
-            pred_start_pos = pred_start_pos.tolist() # list length batch_size
-            pred_end_pos = pred_end_pos.tolist() # list length batch_size
-            pred_start_dists = pred_start_dists.tolist() # list length batch_size
-            pred_end_dists = pred_end_dists.tolist() # list length batch_size
-
-            for ex_idx, (pred_ans_start, pred_ans_end, true_ans_tokens) in enumerate(zip(pred_start_pos, pred_end_pos, batch.ans_tokens)):
-                example_num += 1
-
-                # Get the predicted answer
-                # Important: batch.context_tokens contains the original words (no UNKs)
-                # You need to use the original no-UNK version when measuring F1/EM
-                pred_ans_tokens = batch.context_tokens[ex_idx][pred_ans_start : pred_ans_end + 1]
-                pred_answer = " ".join(pred_ans_tokens)
-
-                # Get true answer (no UNKs)
-                true_answer = " ".join(true_ans_tokens)
-
-                # Calc F1/EM
-                f1 = f1_score(pred_answer, true_answer)
-                em = exact_match_score(pred_answer, true_answer)
-                f1_em_scores.append((f1,em))
-                # print_example(self.word2id, batch.context_tokens[ex_idx], batch.qn_tokens[ex_idx], batch.ans_span[ex_idx, 0], batch.ans_span[ex_idx, 1], pred_ans_start, pred_ans_end, true_answer, pred_answer, f1, em)
+        # Pad all the batches to the same length, so that the distributions can be put in one array
+        with self.batch_generator(context_path, qn_path, ans_path, discard_long=False, random=False, full_padding=True) as batches:
+            for batch in batches:
+
+                pred_start_dists, pred_end_dists = self.get_prob_dists(session, batch)
+                pred_start_pos, pred_end_pos = self.get_start_end_pos(session, batch)
+
+                # Convert the start and end positions to lists length batch_size
+                pred_start_pos = pred_start_pos.tolist() # list length batch_size
+                pred_end_pos = pred_end_pos.tolist() # list length batch_size
+                pred_start_dists = pred_start_dists.tolist() # list length batch_size
+                pred_end_dists = pred_end_dists.tolist() # list length batch_size
+
+                for ex_idx, (pred_ans_start, pred_ans_end, true_ans_tokens) in enumerate(zip(pred_start_pos, pred_end_pos, batch.ans_tokens)):
+                    example_num += 1
+
+                    # Get the predicted answer
+                    # Important: batch.context_tokens contains the original words (no UNKs)
+                    # You need to use the original no-UNK version when measuring F1/EM
+                    pred_ans_tokens = batch.context_tokens[ex_idx][pred_ans_start : pred_ans_end + 1]
+                    pred_answer = " ".join(pred_ans_tokens)
+
+                    # Get true answer (no UNKs)
+                    true_answer = " ".join(true_ans_tokens)
+
+                    # Calc F1/EM
+                    f1 = f1_score(pred_answer, true_answer)
+                    em = exact_match_score(pred_answer, true_answer)
+                    f1_em_scores.append((f1,em))
+                    # print_example(self.word2id, batch.context_tokens[ex_idx], batch.qn_tokens[ex_idx], batch.ans_span[ex_idx, 0], batch.ans_span[ex_idx, 1], pred_ans_start, pred_ans_end, true_answer, pred_answer, f1, em)
+                    if num_samples != 0 and example_num >= num_samples:
+                        break
+
+                # Convert the start and end positions to lists length batch_size
+                total_end_dists += pred_end_dists
+                total_start_dists += pred_start_dists
                 if num_samples != 0 and example_num >= num_samples:
                     break
-
-            # Convert the start and end positions to lists length batch_size
-            total_end_dists += pred_end_dists
-            total_start_dists += pred_start_dists
-            if num_samples != 0 and example_num >= num_samples:
-                break
         return np.asarray(total_start_dists), np.asarray(total_end_dists), np.asarray(f1_em_scores)
 
     def get_c2q_attention(self, session, context_path, qn_path, ans_path, dataset, num_samples=0):
@@ -539,28 +724,20 @@ class QAModel(object):
         """
         total_c2q_attention = []
         example_num = 0
-        for batch in get_batch_generator(
-            self.word2id,
-            context_path,
-            qn_path,
-            ans_path,
-            self.FLAGS.batch_size,
-            context_len=self.FLAGS.context_len,
-            question_len=self.FLAGS.question_len,
-            discard_long=False,
-            random=False):
-
-            c2q_dists = self.get_c2q_attention_dist(session, batch)
-            c2q_list = c2q_dists.tolist() # list length batch_size
-
-            for _, (c2q_dist) in enumerate(c2q_list):
-                example_num += 1
-                total_c2q_attention.append(c2q_dist)
-                # print_example(self.word2id, batch.context_tokens[ex_idx], batch.qn_tokens[ex_idx], batch.ans_span[ex_idx, 0], batch.ans_span[ex_idx, 1], pred_ans_start, pred_ans_end, true_answer, pred_answer, f1, em)
+        with self.batch_generator(context_path, qn_path, ans_path, discard_long=False, random=False, full_padding=True) as batches:
+            for batch in batches:
+
+                c2q_dists = self.get_c2q_attention_dist(session, batch)
+                c2q_list = c2q_dists.tolist() # list length batch_size
+
+                for _, (c2q_dist) in enumerate(c2q_list):
+                    example_num += 1
+                    total_c2q_attention.append(c2q_dist)
+                    # print_example(self.word2id, batch.context_tokens[ex_idx], batch.qn_tokens[ex_idx], batch.ans_span[ex_idx, 0], batch.ans_span[ex_idx, 1], pred_ans_start, pred_ans_end, true_answer, pred_answer, f1, em)
+                    if num_samples != 0 and example_num >= num_samples:
+                        break
                 if num_samples != 0 and example_num >= num_samples:
                     break
-            if num_samples != 0 and example_num >= num_samples:
-                break
         return np.asarray(total_c2q_attention)
 
     def get_q2c_attention(self, session, context_path, qn_path, ans_path, dataset, num_samples=0):
@@ -575,30 +752,22 @@ class QAModel(object):
         """
         total_q2c_attention = []
         example_num = 0
-        for batch in get_batch_generator(
-            self.word2id,
-            context_path,
-            qn_path,
-            ans_path,
-            self.FLAGS.batch_size,
-            context_len=self.FLAGS.context_len,
-            question_len=self.FLAGS.question_len,
-            discard_long=False,
-            random=False):
-
-            q2c_dists = self.get_q2c_attention_dist(session, batch)
-            if q2c_dists is None:
-                break
-
-            q2c_list = q2c_dists.tolist() # list length batch_size
-            for _, (q2c_dist) in enumerate(q2c_list):
-                example_num += 1
-                total_q2c_attention.append(q2c_dist)
-                # print_example(self.word2id, batch.context_tokens[ex_idx], batch.qn_tokens[ex_idx], batch.ans_span[ex_idx, 0], batch.ans_span[ex_idx, 1], pred_ans_start, pred_ans_end, true_answer, pred_answer, f1, em)
+        with self.batch_generator(context_path, qn_path, ans_path, discard_long=False, random=False, full_padding=True) as batches:
+            for batch in batches:
+
+                q2c_dists = self.get_q2c_attention_dist(session, batch)
+                if q2c_dists is None:
+                    break
+
+                q2c_list = q2c_dists.tolist() # list length batch_size
+                for _, (q2c_dist) in enumerate(q2c_list):
+                    example_num += 1
+                    total_q2c_attention.append(q2c_dist)
+                    # print_example(self.word2id, batch.context_tokens[ex_idx], batch.qn_tokens[ex_idx], batch.ans_span[ex_idx, 0], batch.ans_span[ex_idx, 1], pred_ans_start, pred_ans_end, true_answer, pred_answer, f1, em)
+                    if num_samples != 0 and example_num >= num_samples:
+                        break
                 if num_samples != 0 and example_num >= num_samples:
                     break
-            if num_samples != 0 and example_num >= num_samples:
-                break
         return np.asarray(total_q2c_attention)
 
     def get_self_attention(self, session, context_path, qn_path, ans_path, dataset, num_samples=0):
@@ -613,32 +782,46 @@ class QAModel(object):
         """
         total_self_attention = []
         example_num = 0
-        for batch in get_batch_generator(
-            self.word2id,
-            context_path,
-            qn_path,
-            ans_path,
-            self.FLAGS.batch_size,
-            context_len=self.FLAGS.context_len,
-            question_len=self.FLAGS.question_len,
-            discard_long=False,
-            random=False):
-
-            self_dists = self.get_self_attention_dist(session, batch)
-            if self_dists is None:
-                break
-
-            self_list = self_dists.tolist() # list length batch_size
-            for _, (self_dist) in enumerate(self_list):
-                example_num += 1
-                total_self_attention.append(self_dist)
-                # print_example(self.word2id, batch.context_tokens[ex_idx], batch.qn_tokens[ex_idx], batch.ans_span[ex_idx, 0], batch.ans_span[ex_idx, 1], pred_ans_start, pred_ans_end, true_answer, pred_answer, f1, em)
+        with self.batch_generator(context_path, qn_path, ans_path, discard_long=False, random=False, full_padding=True) as batches:
+            for batch in batches:
+
+                self_dists = self.get_self_attention_dist(session, batch)
+                if self_dists is None:
+                    break
+
+                self_list = self_dists.tolist() # list length batch_size
+                for _, (self_dist) in enumerate(self_list):
+                    example_num += 1
+                    total_self_attention.append(self_dist)
+                    # print_example(self.word2id, batch.context_tokens[ex_idx], batch.qn_tokens[ex_idx], batch.ans_span[ex_idx, 0], batch.ans_span[ex_idx, 1], pred_ans_start, pred_ans_end, true_answer, pred_answer, f1, em)
+                    if num_samples != 0 and example_num >= num_samples:
+                        break
                 if num_samples != 0 and example_num >= num_samples:
                     break
-            if num_samples != 0 and example_num >= num_samples:
-                break
         return np.asarray(total_self_attention)
 
+    def save_train_state(self, checkpoint_path, global_step, train_state):
+        """
+        Saves the state of the training loop (epoch, smoothed loss, best dev F1 and position in the training data)
+        as JSON next to the checkpoint saved by self.saver for global_step, and deletes those of deleted checkpoints.
+        """
+        with open("%s-%d.state.json" % (checkpoint_path, global_step), 'w') as fh:
+            json.dump(train_state, fh)
+        for state_path in glob.glob(checkpoint_path + "-*.state.json"):
+            if not os.path.exists(state_path[:-len(".state.json")] + ".index"):
+                os.remove(state_path)
+
+    def load_train_state(self):
+        """
+        Returns the state of the training loop saved with the latest checkpoint in FLAGS.train_dir
+        (the one initialize_model restores), or None if there is none.
+        """
+        ckpt = tf.train.get_checkpoint_state(self.FLAGS.train_dir)
+        if ckpt is None or not os.path.exists(ckpt.model_checkpoint_path + ".state.json"):
+            return None
+        with open(ckpt.model_checkpoint_path + ".state.json") as fh:
+            return json.load(fh)
+
     def train(self, session, train_context_path, train_qn_path, train_ans_path, dev_qn_path, dev_context_path, dev_ans_path):
         """
         Main training loop.
@@ -670,69 +853,92 @@ class QAModel(object):
 
         epoch = 0
 
+        # When resuming from a checkpoint, continue its epoch after its last batch
+        resume_state = None
+        train_state = self.load_train_state()
+        if train_state is not None:
+            epoch = train_state["epoch"] - 1
+            exp_loss = train_state["exp_loss"]
+            best_dev_f1 = train_state["best_dev_f1"]
+            resume_state = train_state["batches"]
+            logging.info("Resuming training in epoch %d, after the last batch of the checkpoint" % train_state["epoch"])
+
         logging.info("Beginning training loop...")
         while self.FLAGS.num_epochs == 0 or epoch < self.FLAGS.num_epochs:
             epoch += 1
             epoch_tic = time.time()
+            epoch_examples, epoch_train_time = 0, 0.
 
             # Loop over batches
-            for batch in get_batch_generator(self.word2id, train_context_path, train_qn_path, train_ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=True):
-
-                # Run training iteration
-                iter_tic = time.time()
-                loss, global_step, param_norm, grad_norm = self.run_train_iter(session, batch, summary_writer)
-                iter_toc = time.time()
-                iter_time = iter_toc - iter_tic
-
-                # Update exponentially-smoothed loss
-                if not exp_loss: # first iter
-                    exp_loss = loss
-                else:
-                    exp_loss = 0.99 * exp_loss + 0.01 * loss
-
-                # Sometimes print info to screen
-                if global_step % self.FLAGS.print_every == 0:
-                    logging.info(
-                        'epoch %d, iter %d, loss %.5f, smoothed loss %.5f, grad norm %.5f, param norm %.5f, batch time %.3f' %
-                        (epoch, global_step, loss, exp_loss, grad_norm, param_norm, iter_time))
-
-                # Sometimes save model
-                if global_step % self.FLAGS.save_every == 0:
-                    logging.info("Saving to %s..." % checkpoint_path)
-                    self.saver.save(session, checkpoint_path, global_step=global_step)
-
-                # Sometimes evaluate model on dev loss, train F1/EM and dev F1/EM
-                if global_step % self.FLAGS.eval_every == 0:
-
-                    # Get loss for entire dev set and log to tensorboard
-                    dev_loss = self.get_dev_loss(session, dev_context_path, dev_qn_path, dev_ans_path)
-                    logging.info("Epoch %d, Iter %d, dev loss: %f" % (epoch, global_step, dev_loss))
-                    write_summary(dev_loss, "dev/loss", summary_writer, global_step)
-
-
-                    # Get F1/EM on train set and log to tensorboard
-                    train_f1, train_em = self.check_f1_em(session, train_context_path, train_qn_path, train_ans_path, "train", num_samples=1000)
-                    logging.info("Epoch %d, Iter %d, Train F1 score: %f, Train EM score: %f" % (epoch, global_step, train_f1, train_em))
-                    write_summary(train_f1, "train/F1", summary_writer, global_step)
-                    write_summary(train_em, "train/EM", summary_writer, global_step)
-
-
-                    # Get F1/EM on dev set and log to tensorboard
-                    dev_f1, dev_em = self.check_f1_em(session, dev_context_path, dev_qn_path, dev_ans_path, "dev", num_samples=0)
-                    logging.info("Epoch %d, Iter %d, Dev F1 score: %f, Dev EM score: %f" % (epoch, global_step, dev_f1, dev_em))
-                    write_summary(dev_f1, "dev/F1", summary_writer, global_step)
-                    write_summary(dev_em, "dev/EM", summary_writer, global_step)
-
-
-                    # Early stopping based on dev EM. You could switch this to use F1 instead.
-                    if best_dev_f1 is None or dev_f1 > best_dev_f1:
-                        best_dev_f1 = dev_f1
-                        logging.info("Saving to %s..." % bestmodel_ckpt_path)
-                        self.bestmodel_saver.save(session, bestmodel_ckpt_path, global_step=global_step)
+            with self.train_batches(session, train_context_path, train_qn_path, train_ans_path, resume_state) as batches:
+                resume_state = None
+                for batch in batches:
+
+                    # Run training iteration
+                    iter_tic = time.time()
+                    try:
+                        loss, global_step, param_norm, grad_norm, batch_size = self.run_train_iter(session, batch, summary_writer)
+                    except tf.errors.OutOfRangeError: # end of the epoch of the tf.data pipeline
+                        break
+                    iter_toc = time.time()
+                    iter_time = iter_toc - iter_tic
+                    epoch_examples += batch_size
+                    epoch_train_time += iter_time
+
+                    # Update exponentially-smoothed loss
+                    if not exp_loss: # first iter
+                        exp_loss = loss
+                    else:
+                        exp_loss = 0.99 * exp_loss + 0.01 * loss
+
+                    # Sometimes print info to screen
+                    if global_step % self.FLAGS.print_every == 0:
+                        logging.info(
+                            'epoch %d, iter %d, loss %.5f, smoothed loss %.5f, grad norm %.5f, param norm %.5f, batch time %.3f, batch size %d, examples/sec %.1f' %
+                            (epoch, global_step, loss, exp_loss, grad_norm, param_norm, iter_time, batch_size, batch_size / iter_time))
+
+                    # Sometimes evaluate model on dev loss, train F1/EM and dev F1/EM
+                    if global_step % self.FLAGS.eval_every == 0:
+
+                        # Get loss for entire dev set and log to tensorboard
+                        dev_loss = self.get_dev_loss(session, dev_context_path, dev_qn_path, dev_ans_path)
+                        logging.info("Epoch %d, Iter %d, dev loss: %f" % (epoch, global_step, dev_loss))
+                        write_summary(dev_loss, "dev/loss", summary_writer, global_step)
+
+
+                        # Get F1/EM on train set and log to tensorboard
+                        train_f1, train_em = self.check_f1_em(session, train_context_path, train_qn_path, train_ans_path, "train", num_samples=1000)
+                        logging.info("Epoch %d, Iter %d, Train F1 score: %f, Train EM score: %f" % (epoch, global_step, train_f1, train_em))
+                        write_summary(train_f1, "train/F1", summary_writer, global_step)
+                        write_summary(train_em, "train/EM", summary_writer, global_step)
+
+
+                        # Get F1/EM on dev set and log to tensorboard
+                        dev_f1, dev_em = self.check_f1_em(session, dev_context_path, dev_qn_path, dev_ans_path, "dev", num_samples=0)
+                        logging.info("Epoch %d, Iter %d, Dev F1 score: %f, Dev EM score: %f" % (epoch, global_step, dev_f1, dev_em))
+                        write_summary(dev_f1, "dev/F1", summary_writer, global_step)
+                        write_summary(dev_em, "dev/EM", summary_writer, global_step)
+
+
+                        # Early stopping based on dev EM. You could switch this to use F1 instead.
+                        if best_dev_f1 is None or dev_f1 > best_dev_f1:
+                            best_dev_f1 = dev_f1
+                            logging.info("Saving to %s..." % bestmodel_ckpt_path)
+                            self.bestmodel_saver.save(session, bestmodel_ckpt_path, global_step=global_step)
+
+                    # Sometimes save model, with the state of the training loop.
+                    # This comes after the evaluation, so that the state has the best dev F1 including this step's.
+                    if global_step % self.FLAGS.save_every == 0:
+                        logging.info("Saving to %s..." % checkpoint_path)
+                        self.saver.save(session, checkpoint_path, global_step=global_step)
+                        self.save_train_state(checkpoint_path, global_step, {
+                            "epoch": epoch, "exp_loss": float(exp_loss), "best_dev_f1": best_dev_f1,
+                            "batches": batch.iter_state if batch is not None else batches.state})
 
 
             epoch_toc = time.time()
-            logging.info("End of epoch %i. Time for epoch: %f" % (epoch, epoch_toc-epoch_tic))
+            logging.info("End of epoch %i. Time for epoch: %f. Time waiting for batches: %f. Training examples/sec: %.1f (%.1f including evaluation and waiting)" %
+                         (epoch, epoch_toc-epoch_tic, batches.wait_time, epoch_examples / max(epoch_train_time, 1e-9), epoch_examples / (epoch_toc-epoch_tic)))
 
         sys.stdout.flush()
 
@@ -39,17 +39,21 @@ logging.basicConfig(level=logging.INFO)
 class QAStackModel(QAModel):
     """Extension of the QA Model that uses Self Attention"""
 
-    def __init__(self, FLAGS, id2word, word2id, emb_matrix):
+    # The cost of a batch grows with the square of the context length (see QAModel.batch_generator)
+    uses_self_attention = True
+
+    def __init__(self, FLAGS, id2word, word2id, emb_matrix, inference_only=False):
         """
         Initializes the QA model.
 
         Inputs:
           FLAGS: the flags passed in from main.py
-          id2word: dictionary mapping word idx (int) to word (string)
-          word2id: dictionary mapping word (string) to word idx (int)
+          id2word: numpy array mapping word idx (int) to word (string)
+          word2id: Vocab mapping word (string) to word idx (int)
           emb_matrix: numpy array shape (400002, embedding_size) containing pre-traing GloVe embeddings
+          inference_only: see QAModel
         """
-        QAModel.__init__(self, FLAGS, id2word, word2id, emb_matrix)
+        QAModel.__init__(self, FLAGS, id2word, word2id, emb_matrix, inference_only)
 
     def build_graph(self):
         """Builds the main part of the graph for the model, starting from the input embeddings to the final distributions for the answer span.
@@ -0,0 +1,346 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This code is required for "serve" mode in main.py
+It answers questions over HTTP with a model loaded once, on localhost or a Unix socket.
+
+Each request is read and tokenized in its own thread, then its questions are queued to a MicroBatcher,
+whose thread runs the model on batches of the questions of concurrent requests.
+
+Endpoints (JSON in and out):
+  POST /answer: {"context": "...", "question": "..."} -> {"answer": "..."},
+    or a list of such objects -> the list of their answers
+  GET /stats: latency percentiles and throughput counters (see ServingStats.snapshot)
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import json
+import time
+import threading
+import Queue
+import SocketServer
+import BaseHTTPServer
+from collections import deque
+
+import numpy as np
+
+from official_eval_helper import generate_answers, tokenize_context
+
+
+class ServingStats(object):
+    """
+    Thread-safe counters of a server: requests, questions, model batches, errors,
+    and the latencies of the last num_latencies requests (for the percentiles).
+    """
+
+    def __init__(self, num_latencies=10000):
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._latencies = deque(maxlen=num_latencies)
+        self.num_requests = 0
+        self.num_examples = 0
+        self.num_batches = 0
+        self.num_batch_examples = 0
+        self.num_errors = 0
+        self.model_time = 0.0
+
+    def record_request(self, num_examples, seconds):
+        with self._lock:
+            self.num_requests += 1
+            self.num_examples += num_examples
+            self._latencies.append(seconds)
+
+    def record_batch(self, num_examples, seconds):
+        with self._lock:
+            self.num_batches += 1
+            self.num_batch_examples += num_examples
+            self.model_time += seconds
+
+    def record_error(self):
+        with self._lock:
+            self.num_errors += 1
+
+    def snapshot(self):
+        """Returns the counters as a dict, with the p50/p99 latencies (ms) and the throughputs (per second)"""
+        with self._lock:
+            latencies = np.array(self._latencies)
+            uptime = time.time() - self._start_time
+            stats = {
+                "requests": self.num_requests,
+                "questions": self.num_examples,
+                "batches": self.num_batches,
+                "errors": self.num_errors,
+                "mean_batch_size": self.num_batch_examples / self.num_batches if self.num_batches else 0.0,
+                "uptime_sec": uptime,
+                "requests_per_sec": self.num_requests / uptime,
+                "questions_per_sec": self.num_examples / uptime,
+                "model_questions_per_sec": self.num_batch_examples / self.model_time if self.model_time else 0.0,
+            }
+        for q in (50, 99):
+            stats["latency_p%i_ms" % q] = float(np.percentile(latencies, q)) * 1000 if len(latencies) else 0.0
+        return stats
+
+
+class _Request(object):
+    """The questions of one submit call, and their answers as they are made"""
+
+    def __init__(self, num_examples):
+        self.results = [None] * num_examples
+        self.error = None
+        self._remaining = num_examples
+        self._lock = threading.Lock()
+        self.done = threading.Event()
+        if num_examples == 0:
+            self.done.set()
+
+    def set_result(self, idx, result, error):
+        with self._lock:
+            self.results[idx] = result
+            self.error = self.error or error
+            self._remaining -= 1
+            if self._remaining == 0:
+                self.done.set()
+
+
+class MicroBatcher(object):
+    """
+    Runs predict_fn in one thread on batches of the examples submitted by concurrent threads.
+
+    A batch is closed when it has batch_limit examples or its first example has waited max_wait seconds,
+    then takes the examples already queued, up to max_batch_size. batch_limit adapts to the load:
+    it halves (down to 1) when max_wait runs out before the batch has batch_limit examples, and doubles
+    (up to max_batch_size) when more examples than batch_limit were queued. So under a light load the examples
+    don't wait for others that aren't coming, and under a heavy load the batches grow to use the model's batch size.
+    """
+
+    def __init__(self, predict_fn, max_batch_size, max_wait, stats=None):
+        """
+        Inputs:
+          predict_fn: function taking a list of examples and returning the list of their results
+          max_batch_size: int. The maximum number of examples passed to predict_fn at once
+          max_wait: float. The maximum time in seconds an example waits for others to fill its batch
+          stats: ServingStats to record the batches in (by default a new one)
+        """
+        self._predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batch_limit = 1
+        self.stats = stats or ServingStats()
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="MicroBatcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, examples):
+        """
+        Queues the examples (a list) and waits for them to be run.
+        Returns the list of their results, or raises the exception raised by predict_fn on one of them.
+        """
+        request = _Request(len(examples))
+        for (idx, example) in enumerate(examples):
+            self._queue.put((request, idx, example))
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def close(self):
+        """Stops the thread once the examples already queued are run"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        """Returns the next batch of queued items, and whether the batcher was closed"""
+        item = self._queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+
+        # Wait for up to batch_limit items, for at most max_wait
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.batch_limit:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        if len(batch) < self.batch_limit:
+            self.batch_limit = max(self.batch_limit // 2, 1)
+
+        # Take the items that are already there
+        while len(batch) < self.max_batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        if len(batch) > self.batch_limit:
+            self.batch_limit = min(self.batch_limit * 2, self.max_batch_size)
+        return batch, False
+
+    def _run(self):
+        closed = False
+        while not closed:
+            batch, closed = self._next_batch()
+            if not batch:
+                continue
+            tic = time.time()
+            try:
+                results, error = self._predict_fn([example for (_, _, example) in batch]), None
+            except Exception as e:
+                results, error = [None] * len(batch), e
+            self.stats.record_batch(len(batch), time.time() - tic)
+            for ((request, idx, _), result) in zip(batch, results):
+                request.set_result(idx, result, error)
+
+
+def make_predict_fn(session, model, word2id):
+    """
+    Returns a function taking a list of (context_tokens, qn_tokens, context_offsets) tuples (see tokenize_context)
+    and returning their answers (strings sliced from the contexts).
+    The answers are made as in official_eval mode (see official_eval_helper.generate_answers).
+    """
+    def predict(examples):
+        uuids = range(len(examples))
+        context_token_data = [context_tokens for (context_tokens, _, _) in examples]
+        qn_token_data = [qn_tokens for (_, qn_tokens, _) in examples]
+        context_offset_data = [context_offsets for (_, _, context_offsets) in examples]
+        # A micro-batch is at most a batch or two: the pipeline threads of official_eval would only add overhead
+        uuid2ans = generate_answers(session, model, word2id, uuids, context_token_data, qn_token_data, verbose=False,
+                                    context_offset_data=context_offset_data, num_workers=0)
+        return [uuid2ans[uuid] for uuid in uuids]
+    return predict
+
+
+class AnswerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles the requests to the endpoints listed in the module docstring, with the batcher and tokenizer of its server"""
+
+    protocol_version = "HTTP/1.1" # keep the connections open between requests
+
+    def log_message(self, format, *args):
+        pass # one line per request would slow the server down
+
+    def reply(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            stats = self.server.batcher.stats.snapshot()
+            stats["batch_limit"] = self.server.batcher.batch_limit
+            self.reply(200, stats)
+        else:
+            self.reply(404, {"error": "Unknown path %s: use POST /answer or GET /stats" % self.path})
+
+    def do_POST(self):
+        tic = time.time()
+        stats = self.server.batcher.stats
+        if self.path != "/answer":
+            self.reply(404, {"error": "Unknown path %s: use POST /answer or GET /stats" % self.path})
+            return
+
+        # Read and tokenize the questions
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", 0))))
+            questions = body if isinstance(body, list) else [body]
+            examples = []
+            for qn in questions:
+                context_tokens, context_offsets = tokenize_context(qn["context"], self.server.tokenizer, return_offsets=True)
+                examples.append((context_tokens, self.server.tokenizer(unicode(qn["question"])), context_offsets))
+            if not all(context_tokens and qn_tokens for (context_tokens, qn_tokens, _) in examples):
+                raise ValueError("empty context or question")
+        except (ValueError, KeyError, TypeError) as e:
+            stats.record_error()
+            self.reply(400, {"error": "Expected a JSON object with a context and a question, or a list of them (%s)" % e})
+            return
+
+        try:
+            answers = self.server.batcher.submit(examples)
+        except Exception as e:
+            stats.record_error()
+            self.reply(500, {"error": "%s: %s" % (type(e).__name__, e)})
+            return
+
+        stats.record_request(len(examples), time.time() - tic)
+        answers = [{"answer": answer} for answer in answers]
+        self.reply(200, answers if isinstance(body, list) else answers[0])
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = SocketServer.UnixStreamServer.get_request(self)
+        return request, ("local", 0)
+
+
+def make_server(batcher, tokenizer, host="127.0.0.1", port=8000, unix_socket=""):
+    """
+    Returns an HTTP server answering with the batcher (see AnswerHandler), on host:port or on unix_socket if it's set.
+    Call its serve_forever method to start answering (port 0 picks a free port, see server.server_address).
+    """
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, AnswerHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), AnswerHandler)
+    server.batcher = batcher
+    server.tokenizer = tokenizer
+    return server
+
+
+def serve(session, model, word2id, tokenizer, host, port, unix_socket, max_batch_size, max_wait):
+    """
+    Answers questions with the model until interrupted (Ctrl-C).
+
+    Inputs:
+      session: TensorFlow session, with the model loaded
+      model: QAModel
+      word2id: Vocab mapping word (string) to word id (int)
+      tokenizer: function tokenizing the contexts and questions, one of squad_preprocess.TOKENIZERS
+      host, port, unix_socket: where to listen (see make_server)
+      max_batch_size, max_wait: see MicroBatcher
+    """
+    batcher = MicroBatcher(make_predict_fn(session, model, word2id), max_batch_size, max_wait)
+    server = make_server(batcher, tokenizer, host, port, unix_socket)
+    print "Serving on %s (POST /answer, GET /stats)" % (unix_socket or "http://%s:%i" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print "Stopping the server"
+    finally:
+        server.server_close()
+        batcher.close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
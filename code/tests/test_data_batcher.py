@@ -0,0 +1,403 @@
+"""Checks that the compiled data format produces the same batches as the text files"""
+
+import os
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from vocab import Vocab, _START_VOCAB
+from data_batcher import get_batch_generator, get_batch_jobs, split_into_batches, BatchAssembler, BatchPrefetcher, context_windows
+from compiled_data import compiled_dir, load_compiled
+
+WORDS = _START_VOCAB + ["the", "cat", "sat", "on", "mat", "who", "what", "?"]
+
+
+def write_split(data_dir, num_examples, rng):
+    """Writes a random {context/question/span} split, including one ill-formed span"""
+    paths = [os.path.join(data_dir, "train." + ext) for ext in ("context", "question", "span")]
+    pool = WORDS[2:] + ["dog", "ran"]
+    with open(paths[0], 'w') as context_file, open(paths[1], 'w') as qn_file, open(paths[2], 'w') as ans_file:
+        for i in range(num_examples):
+            context = [pool[j] for j in rng.randint(len(pool), size=rng.randint(1, 15))]
+            qn = [pool[j] for j in rng.randint(len(pool), size=rng.randint(1, 6))]
+            start = rng.randint(len(context))
+            end = start - 1 if i == 3 else rng.randint(start, len(context))
+            context_file.write(" ".join(context) + "\n")
+            qn_file.write(" ".join(qn) + "\n")
+            ans_file.write("%i %i\n" % (start, end))
+    return paths
+
+
+def collect(vocab, paths, compiled, **kwargs):
+    random.seed(0)
+    return list(get_batch_generator(vocab, paths[0], paths[1], paths[2], 3, context_len=10, question_len=4, compiled=compiled, **kwargs))
+
+
+def test_compiled_matches_text():
+    data_dir = tempfile.mkdtemp()
+    try:
+        paths = write_split(data_dir, 50, np.random.RandomState(0))
+        vocab = Vocab(WORDS)
+        for (discard_long, dorandom, dynamic_padding, bucket_width) in [(True, True, False, 0), (False, False, False, 0), (False, True, True, 4)]:
+            kwargs = dict(discard_long=discard_long, random=dorandom, dynamic_padding=dynamic_padding, bucket_width=bucket_width)
+            text_batches = collect(vocab, paths, False, **kwargs)
+            compiled_batches = collect(vocab, paths, True, **kwargs)
+            assert len(text_batches) == len(compiled_batches)
+            for (b1, b2) in zip(text_batches, compiled_batches):
+                for name in ("context_ids", "context_mask", "qn_ids", "qn_mask", "ans_span"):
+                    assert np.array_equal(getattr(b1, name), getattr(b2, name))
+                for name in ("context_tokens", "qn_tokens", "ans_tokens"):
+                    assert getattr(b1, name) == getattr(b2, name)
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_dynamic_padding_and_buckets():
+    data_dir = tempfile.mkdtemp()
+    try:
+        paths = write_split(data_dir, 200, np.random.RandomState(3))
+        vocab = Vocab(WORDS)
+        for compiled in (False, True):
+            batches = collect(vocab, paths, compiled, discard_long=False, dynamic_padding=True, bucket_width=4)
+            assert sum(b.batch_size for b in batches) == 199
+            for batch in batches:
+                context_lens = [min(len(tokens), 10) for tokens in batch.context_tokens]
+                qn_lens = [min(len(tokens), 4) for tokens in batch.qn_tokens]
+                assert batch.context_ids.shape == (batch.batch_size, max(context_lens))
+                assert batch.qn_ids.shape == (batch.batch_size, max(qn_lens))
+                assert batch.context_mask.sum(axis=1).tolist() == context_lens
+                assert max(context_lens) // 4 - min(context_lens) // 4 <= 1 # at most two buckets per batch
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_split_into_batches():
+    order = np.array([0, 1, 2, 3, 4, 5])
+    lens = np.array([2, 3, 3, 10, 1, 4])
+    assert [b.tolist() for b in split_into_batches(order, lens, 4)] == [[0, 1, 2, 3], [4, 5]]
+    assert [b.tolist() for b in split_into_batches(order, lens, 4, max_batch_cost=10)] == [[0, 1, 2], [3], [4, 5]]
+    assert [b.tolist() for b in split_into_batches(order, lens, 4, max_batch_cost=20, cost_exponent=2)] == [[0, 1], [2], [3], [4], [5]]
+
+
+def test_token_budget():
+    data_dir = tempfile.mkdtemp()
+    try:
+        paths = write_split(data_dir, 200, np.random.RandomState(4))
+        vocab = Vocab(WORDS)
+        for compiled in (False, True):
+            batches = collect(vocab, paths, compiled, discard_long=False, dynamic_padding=True, bucket_width=4, max_batch_cost=40)
+            assert sum(b.batch_size for b in batches) == 199
+            assert all(b.context_ids.size <= 40 for b in batches)
+            assert max(b.batch_size for b in batches) > 3 # more than batch_size examples when the contexts are short
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_batch_assembler():
+    flat_ids = np.arange(2, 22, dtype=np.int32)
+    offsets, lens = np.array([0, 5, 12]), np.array([5, 7, 8])
+    expected_ids = [[2, 3, 4, 5, 6, 0], [7, 8, 9, 10, 11, 12], [14, 15, 16, 17, 18, 19]]
+
+    assembler = BatchAssembler(num_slots=2)
+    slots = [assembler.next_slot() for _ in range(3)]
+    assert slots == [0, 1, 0]
+
+    ids, mask = assembler.pad(0, "context", flat_ids, offsets, lens, 6)
+    assert ids.dtype == np.int32 and mask.dtype == np.int32
+    assert ids.tolist() == expected_ids
+    assert mask.tolist() == [[1] * 5 + [0], [1] * 6, [1] * 6]
+
+    # The arrays of a slot reuse its buffers, and the buffers grow when needed
+    ids2, _ = assembler.pad(0, "context", flat_ids, offsets[:2], lens[:2], 3)
+    assert ids2.tolist() == [[2, 3, 4], [7, 8, 9]]
+    assert np.may_share_memory(ids, ids2)
+    ids3, _ = assembler.pad(0, "context", flat_ids, offsets, lens, 8)
+    assert ids3[2].tolist() == list(range(14, 22))
+    assert not np.may_share_memory(ids, assembler.pad(1, "context", flat_ids, offsets, lens, 6)[0])
+
+    # Without slots, new arrays every time
+    fresh = BatchAssembler()
+    assert fresh.next_slot() is None
+    assert fresh.pad(None, "context", flat_ids, offsets, lens, 6)[0].tolist() == expected_ids
+
+
+def test_recompiles_on_vocab_change():
+    data_dir = tempfile.mkdtemp()
+    try:
+        paths = write_split(data_dir, 10, np.random.RandomState(1))
+        split = load_compiled(Vocab(WORDS), *paths)
+        assert split.num_examples == 9 # the ill-formed span is dropped
+        assert os.path.dirname(split.path) == compiled_dir(paths[0])
+
+        split = load_compiled(Vocab(WORDS + ["dog"]), *paths)
+        dog_id = len(WORDS)
+        assert (np.asarray(split.context_ids)[np.asarray(split.strings)[split.context_sids] == "dog"] == dog_id).all()
+        # Each vocabulary has its own compiled version
+        assert len(os.listdir(compiled_dir(paths[0]))) == 2
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_interrupted_recompile(monkeypatch):
+    data_dir = tempfile.mkdtemp()
+    try:
+        vocab = Vocab(WORDS)
+        paths = write_split(data_dir, 10, np.random.RandomState(1))
+        split = load_compiled(vocab, *paths)
+        old_ids = np.array(split.context_ids)
+        files = {name: open(os.path.join(split.path, name), 'rb').read() for name in os.listdir(split.path)}
+
+        # The data changes, and the recompilation fails halfway through writing the arrays
+        write_split(data_dir, 20, np.random.RandomState(2))
+        save = np.save
+        calls = []
+        def failing_save(*args):
+            calls.append(args)
+            if len(calls) == 3:
+                raise IOError("disk full")
+            save(*args)
+        monkeypatch.setattr(np, "save", failing_save)
+        with pytest.raises(IOError):
+            load_compiled(vocab, *paths)
+        monkeypatch.setattr(np, "save", save)
+
+        # The previous version is untouched, and still readable by whoever memory-mapped it
+        assert {name: open(os.path.join(split.path, name), 'rb').read() for name in os.listdir(split.path)} == files
+        assert os.listdir(compiled_dir(paths[0])) == [os.path.basename(split.path)]
+        assert np.array_equal(split.context_ids, old_ids)
+
+        # The next load recompiles it, and the arrays already memory-mapped stay valid
+        new_split = load_compiled(vocab, *paths)
+        assert new_split.num_examples == 19
+        assert os.listdir(compiled_dir(paths[0])) == [os.path.basename(split.path)]
+        assert np.array_equal(split.context_ids, old_ids)
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def slow_jobs(num_jobs, fail_at=None):
+    """Jobs returning their number, the early ones being the slowest"""
+    def job(i):
+        time.sleep(0.002 * (num_jobs - i))
+        if i == fail_at:
+            raise ValueError("job %i failed" % i)
+        return i
+    for i in range(num_jobs):
+        yield lambda i=i: job(i)
+
+
+def test_prefetcher_order():
+    for num_workers in (0, 1, 3):
+        prefetcher = BatchPrefetcher(slow_jobs(20), num_workers=num_workers, max_batches=4)
+        assert list(prefetcher) == list(range(20))
+        assert prefetcher.num_batches == 20 and prefetcher.wait_time > 0
+
+
+def test_prefetcher_matches_generator():
+    data_dir = tempfile.mkdtemp()
+    try:
+        paths = write_split(data_dir, 50, np.random.RandomState(2))
+        vocab = Vocab(WORDS)
+        random.seed(0)
+        jobs = get_batch_jobs(vocab, paths[0], paths[1], paths[2], 3, context_len=10, question_len=4, discard_long=True, compiled=True)
+        with BatchPrefetcher(jobs, num_workers=2, max_batches=3) as batches:
+            prefetched = list(batches)
+        expected = collect(vocab, paths, True, discard_long=True)
+        assert [b.qn_tokens for b in prefetched] == [b.qn_tokens for b in expected]
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_prefetcher_close_and_errors():
+    num_threads = threading.active_count()
+    with BatchPrefetcher(slow_jobs(100), num_workers=2, max_batches=4) as batches:
+        for batch in batches:
+            if batch == 2:
+                break
+    assert threading.active_count() == num_threads
+
+    batches = BatchPrefetcher(slow_jobs(10, fail_at=5), num_workers=2)
+    seen = []
+    try:
+        for batch in batches:
+            seen.append(batch)
+        assert False, "the job error was not raised"
+    except ValueError:
+        pass
+    assert seen == list(range(5))
+    assert threading.active_count() == num_threads
+
+
+def test_resume_from_iter_state():
+    data_dir = tempfile.mkdtemp()
+    try:
+        # 3 refills of 160 batches of 3 examples
+        paths = write_split(data_dir, 1200, np.random.RandomState(2))
+        vocab = Vocab(WORDS)
+        for (compiled, global_shuffle) in [(False, False), (True, False), (False, True), (True, True)]:
+            kwargs = dict(discard_long=False, random=True, dynamic_padding=True, bucket_width=4, global_shuffle=global_shuffle)
+            batches = collect(vocab, paths, compiled, **kwargs)
+            for num_done in (1, 100, 160, 161, 250, len(batches) - 1, len(batches)):
+                # The state goes through JSON, as when it's saved with a checkpoint
+                resume_state = json.loads(json.dumps(batches[num_done - 1].iter_state))
+                random.seed(1) # the resumed batches don't depend on the global random state
+                resumed = list(get_batch_generator(vocab, paths[0], paths[1], paths[2], 3, context_len=10, question_len=4,
+                                                   compiled=compiled, resume_state=resume_state, **kwargs))
+                assert len(resumed) == len(batches) - num_done
+                for (b1, b2) in zip(batches[num_done:], resumed):
+                    assert np.array_equal(b1.context_ids, b2.context_ids)
+                    assert np.array_equal(b1.ans_span, b2.ans_span)
+                    assert b1.iter_state == b2.iter_state
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_resume_state_of_other_data_or_arguments():
+    data_dir = tempfile.mkdtemp()
+    try:
+        vocab = Vocab(WORDS)
+        for compiled in (False, True):
+            paths = write_split(data_dir, 600, np.random.RandomState(2))
+            kwargs = dict(discard_long=False, random=True, dynamic_padding=True, global_shuffle=False)
+            resume_state = json.loads(json.dumps(collect(vocab, paths, compiled, **kwargs)[100].iter_state))
+
+            # With other batching arguments, the saved position is ignored
+            random.seed(0)
+            other = list(get_batch_generator(vocab, paths[0], paths[1], paths[2], 4, context_len=10, question_len=4,
+                                             compiled=compiled, resume_state=resume_state, **kwargs))
+            assert sum(len(b.ans_span) for b in other) == 599
+
+            # So it is once the data files change (the span file then grows, whatever the spans)
+            write_split(data_dir, 1000, np.random.RandomState(3))
+            batches = collect(vocab, paths, compiled, resume_state=resume_state, **kwargs)
+            assert [b.context_ids.tolist() for b in batches] == [b.context_ids.tolist() for b in collect(vocab, paths, compiled, **kwargs)]
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_global_shuffle():
+    data_dir = tempfile.mkdtemp()
+    try:
+        paths = write_split(data_dir, 1200, np.random.RandomState(3))
+        vocab = Vocab(WORDS)
+        split = load_compiled(vocab, *paths)
+        kwargs = dict(discard_long=False, random=True, dynamic_padding=True, bucket_width=4, global_shuffle=True)
+
+        # The same examples as without global shuffling, each once
+        examples = lambda batches: sorted((tuple(ids[mask == 1]), tuple(span)) for b in batches
+                                          for (ids, mask, span) in zip(b.context_ids, b.context_mask, b.ans_span))
+        shuffled = collect(vocab, paths, True, **kwargs)
+        assert examples(shuffled) == examples(collect(vocab, paths, True, discard_long=False, random=True))
+
+        # The first refill draws from the whole file, rather than from its first batch_size * 160 examples
+        first_refill = [b for b in shuffled if b.iter_state["position"] == 0]
+        rows = set((tuple(ids[mask == 1]), tuple(span)) for b in first_refill for (ids, mask, span) in zip(b.context_ids, b.context_mask, b.ans_span))
+        late_rows = set((tuple(split.context_ids[split.context_offsets[i]:split.context_offsets[i+1]][:10]), tuple(split.ans_span[i]))
+                        for i in range(800, split.num_examples))
+        assert len(rows & late_rows) > 100
+
+        # Within a refill, the batches are still grouped by context length
+        num_bucketed = sum(len(set(np.minimum(b.context_mask.sum(axis=1), 10) // 4)) == 1 for b in shuffled)
+        assert num_bucketed > 0.9 * len(shuffled)
+
+        # The text files are read through their line index, in another order than the compiled examples
+        # (the ill-formed examples are part of the permutation of the lines)
+        small_paths = write_split(data_dir, 50, np.random.RandomState(4))
+        assert examples(collect(vocab, small_paths, False, **kwargs)) == examples(collect(vocab, small_paths, True, **kwargs))
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_shards_read_as_one_file():
+    data_dir = tempfile.mkdtemp()
+    try:
+        paths = write_split(data_dir, 1200, np.random.RandomState(5))
+        vocab = Vocab(WORDS)
+
+        # The same lines in 3 shards, one of them empty
+        shard_paths = [[], [], []]
+        for (i, path) in enumerate(paths):
+            with open(path) as fh:
+                lines = fh.readlines()
+            for (shard, (start, end)) in enumerate([(0, 500), (500, 500), (500, len(lines))]):
+                shard_path = os.path.join(data_dir, "shard%i.%s" % (shard, ["context", "question", "span"][i]))
+                with open(shard_path, 'w') as fh:
+                    fh.writelines(lines[start:end])
+                shard_paths[i].append(shard_path)
+
+        for (compiled, dorandom, global_shuffle) in [(False, False, False), (False, True, False), (True, True, False), (False, True, True), (True, True, True)]:
+            kwargs = dict(discard_long=False, random=dorandom, dynamic_padding=True, bucket_width=4, global_shuffle=global_shuffle)
+            batches = collect(vocab, paths, compiled, **kwargs)
+            sharded = collect(vocab, shard_paths, compiled, **kwargs)
+            assert len(batches) == len(sharded)
+            for (b1, b2) in zip(batches, sharded):
+                assert np.array_equal(b1.context_ids, b2.context_ids)
+                assert np.array_equal(b1.ans_span, b2.ans_span)
+
+            # Resuming from a batch of the second refill, which reads across the shards
+            resume_state = json.loads(json.dumps(sharded[200].iter_state))
+            resumed = list(get_batch_generator(vocab, shard_paths[0], shard_paths[1], shard_paths[2], 3, context_len=10, question_len=4,
+                                               compiled=compiled, resume_state=resume_state, **kwargs))
+            assert [b.context_ids.tolist() for b in resumed] == [b.context_ids.tolist() for b in sharded[201:]]
+        assert os.path.isdir(compiled_dir(shard_paths[0]))
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_windows():
+    assert context_windows(10, 10, 4) == [0]
+    assert context_windows(14, 10, 4) == [0, 4]
+    assert context_windows(15, 10, 4) == [0, 4, 5]
+    assert context_windows(15, 10, 10) == [0, 5]
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        paths = write_split(data_dir, 100, np.random.RandomState(6))
+        vocab = Vocab(WORDS)
+
+        # Each window of context_len=10 tokens which contains the answer is an example
+        expected = []
+        with open(paths[0]) as context_file, open(paths[1]) as qn_file, open(paths[2]) as ans_file:
+            for (context_line, qn_line, ans_line) in zip(context_file, qn_file, ans_file):
+                context, qn = context_line.split(), qn_line.split()
+                start, end = [int(x) for x in ans_line.split()]
+                if end < start or len(qn) > 4:
+                    continue
+                for window_start in context_windows(len(context), 10, 4):
+                    if window_start <= start and end < window_start + 10:
+                        window = context[window_start : window_start + 10]
+                        expected.append((window, qn, context[start : end+1], [start - window_start, end - window_start]))
+        assert any(len(window) == 10 and window != context for (window, _, _, _) in expected)
+
+        for compiled in (False, True):
+            batches = collect(vocab, paths, compiled, discard_long=True, random=False, dynamic_padding=True, window_stride=4)
+            examples = [(b.context_tokens[i], b.qn_tokens[i], b.ans_tokens[i], b.ans_span[i].tolist()) for b in batches for i in range(b.batch_size)]
+            assert examples == expected
+            for b in batches:
+                assert b.context_mask.sum(axis=1).tolist() == [len(tokens) for tokens in b.context_tokens]
+                assert b.context_ids.tolist() == [vocab.lookup(tokens).tolist() + [0] * (b.context_ids.shape[1] - len(tokens)) for tokens in b.context_tokens]
+    finally:
+        shutil.rmtree(data_dir)
+
+
+if __name__ == "__main__":
+    test_compiled_matches_text()
+    test_dynamic_padding_and_buckets()
+    test_split_into_batches()
+    test_token_budget()
+    test_batch_assembler()
+    test_recompiles_on_vocab_change()
+    test_prefetcher_order()
+    test_prefetcher_matches_generator()
+    test_prefetcher_close_and_errors()
+    test_resume_from_iter_state()
+    test_resume_state_of_other_data_or_arguments()
+    test_global_shuffle()
+    test_shards_read_as_one_file()
+    test_windows()
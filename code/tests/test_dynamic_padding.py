@@ -0,0 +1,79 @@
+"""Checks that the models give the same distributions whether a batch is padded
+to context_len/question_len or only to its longest example,
+and that batches of different sizes are weighted by their size with a batch cost budget"""
+
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from data_batcher import Batch
+from qa_baseline_model import QABaselineModel
+from qa_bidaf_model import QABidafModel
+from qa_selfattn_model import QASelfAttnModel
+from qa_stack_model import QAStackModel
+from qa_pointer_model import QAPointerModel
+from tests.test_embedding_init import TestFlags, VOCAB_SIZE, EMBEDDING_SIZE, BS
+
+
+def make_ragged_batch(rng, context_lens, qn_lens):
+    """Returns a Batch padded to context_len/question_len, with the given lengths"""
+    context_ids = rng.randint(2, VOCAB_SIZE, size=(BS, TestFlags.context_len))
+    qn_ids = rng.randint(2, VOCAB_SIZE, size=(BS, TestFlags.question_len))
+    context_mask = (np.arange(TestFlags.context_len) < np.array(context_lens)[:, None]).astype(np.int32)
+    qn_mask = (np.arange(TestFlags.question_len) < np.array(qn_lens)[:, None]).astype(np.int32)
+    return Batch(context_ids * context_mask, context_mask, [[]] * BS, qn_ids * qn_mask, qn_mask, [[]] * BS, None, None)
+
+
+def trimmed(batch, context_width, qn_width):
+    return Batch(batch.context_ids[:, :context_width], batch.context_mask[:, :context_width], batch.context_tokens,
+                 batch.qn_ids[:, :qn_width], batch.qn_mask[:, :qn_width], batch.qn_tokens, None, None)
+
+
+def test_dynamic_padding_matches_full_padding():
+    rng = np.random.RandomState(0)
+    emb_matrix = rng.randn(VOCAB_SIZE, EMBEDDING_SIZE).astype(np.float32)
+    batch = make_ragged_batch(rng, context_lens=[3, 7, 5, 7], qn_lens=[2, 3, 1, 3])
+
+    for model_class in (QABaselineModel, QABidafModel, QASelfAttnModel, QAStackModel, QAPointerModel):
+        tf.reset_default_graph()
+        tf.set_random_seed(0)
+        model = model_class(TestFlags(), {}, {}, emb_matrix)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer(), model.get_initializer_feed())
+            full_start, full_end = model.get_prob_dists(sess, batch)
+            start, end = model.get_prob_dists(sess, trimmed(batch, 7, 3))
+
+        assert start.shape == (BS, 7)
+        assert np.allclose(start, full_start[:, :7], atol=1e-5), model_class.__name__
+        assert np.allclose(end, full_end[:, :7], atol=1e-5), model_class.__name__
+        assert np.all(full_start[:, 7:] < 1e-10)
+
+
+def test_loss_weight():
+    rng = np.random.RandomState(1)
+    emb_matrix = rng.randn(VOCAB_SIZE, EMBEDDING_SIZE).astype(np.float32)
+    batch = make_ragged_batch(rng, context_lens=[3, 7, 5, 7], qn_lens=[2, 3, 1, 3])
+    batch.ans_span = np.array([[0, 1], [2, 4], [1, 1], [3, 6]])
+    small_batch = Batch(batch.context_ids[:2], batch.context_mask[:2], [[]] * 2, batch.qn_ids[:2], batch.qn_mask[:2], [[]] * 2, batch.ans_span[:2], None)
+
+    flags = TestFlags()
+    flags.max_batch_tokens = 100
+    flags.dropout = 0.
+    tf.reset_default_graph()
+    model = QABaselineModel(flags, {}, {}, emb_matrix)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer(), model.get_initializer_feed())
+        feed = {model.context_ids: small_batch.context_ids, model.context_mask: small_batch.context_mask,
+                model.qn_ids: small_batch.qn_ids, model.qn_mask: small_batch.qn_mask, model.ans_span: small_batch.ans_span}
+        grad_norm = sess.run(model.gradient_norm, feed)
+
+        # A batch of 2 examples with batch_size 4 counts for half a full batch
+        _, _, _, weighted_grad_norm, batch_size = model.run_train_iter(sess, small_batch, tf.summary.FileWriter(tempfile.mkdtemp()))
+        assert np.isclose(weighted_grad_norm, grad_norm * 0.5, rtol=1e-4)
+        assert batch_size == 2
+
+
+if __name__ == "__main__":
+    test_dynamic_padding_matches_full_padding()
+    test_loss_weight()
@@ -0,0 +1,152 @@
+"""Checks that feeding the embedding matrix through an initializer gives the same outputs as a tf.constant,
+that the embedding matrix is kept out of the GraphDef and the checkpoints,
+and that the float16/int8 embedding stores give outputs close to the float32 one."""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from data_batcher import Batch
+from qa_baseline_model import QABaselineModel
+from vocab import quantize_embeddings
+
+VOCAB_SIZE = 50
+EMBEDDING_SIZE = 8
+BS = 4
+
+
+class TestFlags(object):
+    """The subset of the flags in main.py needed to build a small model"""
+    hidden_size = 6
+    context_len = 12
+    question_len = 5
+    embedding_size = EMBEDDING_SIZE
+    max_gradient_norm = 5.0
+    learning_rate = 0.001
+    dropout = 0.15
+    keep = 1
+    num_layers = 1
+    rnn_cell = "GRU"
+    selfattn_size = 6
+    select_mode = "default"
+    batch_size = BS
+    emb_dtype = "float32"
+    max_batch_tokens = 0
+    max_batch_attn = 0
+    input_pipeline = "feed_dict"
+    global_shuffle = True
+    window_stride = 0
+
+
+def make_batch(rng):
+    context_ids = rng.randint(2, VOCAB_SIZE, size=(BS, TestFlags.context_len))
+    qn_ids = rng.randint(2, VOCAB_SIZE, size=(BS, TestFlags.question_len))
+    context_mask = np.ones_like(context_ids)
+    context_mask[:, 9:] = 0
+    qn_mask = np.ones_like(qn_ids)
+    context_ids[context_mask == 0] = 0
+    return Batch(context_ids, context_mask, [[]] * BS, qn_ids, qn_mask, [[]] * BS, None, None)
+
+
+def build_model(emb_matrix, emb_dtype="float32"):
+    tf.reset_default_graph()
+    tf.set_random_seed(0)
+    flags = TestFlags()
+    flags.emb_dtype = emb_dtype
+    return QABaselineModel(flags, {}, {}, emb_matrix)
+
+
+def test_embedding_initializer():
+    rng = np.random.RandomState(0)
+    emb_matrix = rng.randn(VOCAB_SIZE, EMBEDDING_SIZE).astype(np.float32)
+    batch = make_batch(rng)
+    ckpt_dir = tempfile.mkdtemp()
+
+    try:
+        model = build_model(emb_matrix)
+
+        # The embedding matrix isn't serialized into the GraphDef, and isn't trainable
+        constant_bytes = sum(len(node.attr["value"].tensor.tensor_content) for node in tf.get_default_graph().as_graph_def().node)
+        assert constant_bytes < emb_matrix.nbytes
+        assert model.embedding_matrix not in tf.trainable_variables()
+
+        constant_embs = tf.nn.embedding_lookup(tf.constant(emb_matrix), model.context_ids)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer(), model.get_initializer_feed())
+            feed = {model.context_ids: batch.context_ids}
+            var_result, constant_result = sess.run([model.context_embs, constant_embs], feed)
+            assert np.array_equal(var_result, constant_result)
+            assert np.array_equal(var_result, emb_matrix[batch.context_ids])
+
+            start_dist, end_dist = model.get_prob_dists(sess, batch)
+            ckpt_path = model.saver.save(sess, os.path.join(ckpt_dir, "qa.ckpt"))
+
+        saved = [name for (name, _) in tf.contrib.framework.list_variables(ckpt_path)]
+        assert not [name for name in saved if "emb_matrix" in name]
+
+        # Restoring the checkpoint and feeding the embedding matrix again gives the same outputs
+        model = build_model(emb_matrix)
+        with tf.Session() as sess:
+            model.saver.restore(sess, ckpt_path)
+            model.initialize_embeddings(sess)
+            restored_start_dist, restored_end_dist = model.get_prob_dists(sess, batch)
+
+        assert np.allclose(start_dist, restored_start_dist)
+        assert np.allclose(end_dist, restored_end_dist)
+    finally:
+        shutil.rmtree(ckpt_dir)
+
+
+def test_quantize_embeddings():
+    emb_matrix = np.random.RandomState(0).randn(VOCAB_SIZE, EMBEDDING_SIZE).astype(np.float32)
+    emb_matrix[0] = 0.
+
+    values, scales = quantize_embeddings(emb_matrix, "float16", chunk_size=7)
+    assert values.dtype == np.float16 and scales is None
+    assert np.allclose(values, emb_matrix, atol=1e-2)
+
+    values, scales = quantize_embeddings(emb_matrix, "int8", chunk_size=7)
+    assert values.dtype == np.int8 and scales.shape == (VOCAB_SIZE, 1)
+    assert np.all(np.abs(values * scales - emb_matrix) <= scales / 2 + 1e-6)
+    assert np.all(values[0] == 0)
+
+
+def test_quantized_embedding_outputs():
+    rng = np.random.RandomState(0)
+    emb_matrix = rng.randn(VOCAB_SIZE, EMBEDDING_SIZE).astype(np.float32)
+    batch = make_batch(rng)
+
+    ckpt_dir = tempfile.mkdtemp()
+
+    try:
+        # Use the same (checkpointed) weights for every embedding store
+        model = build_model(emb_matrix)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer(), model.get_initializer_feed())
+            full_outputs = model.get_prob_dists(sess, batch)
+            ckpt_path = model.saver.save(sess, os.path.join(ckpt_dir, "qa.ckpt"))
+
+        for emb_dtype in ("float16", "int8"):
+            model = build_model(emb_matrix, emb_dtype)
+            with tf.Session() as sess:
+                model.saver.restore(sess, ckpt_path)
+                model.initialize_embeddings(sess)
+                assert sess.run(model.embedding_matrix).dtype == np.dtype(emb_dtype)
+                outputs = model.get_prob_dists(sess, batch)
+
+            for (quantized, full) in zip(outputs, full_outputs):
+                assert np.allclose(quantized, full, atol=1e-2)
+    finally:
+        shutil.rmtree(ckpt_dir)
+
+
+if __name__ == "__main__":
+    test_embedding_initializer()
+    print ("Embedding initializer gives the same outputs as tf.constant!")
+    test_quantize_embeddings()
+    test_quantized_embedding_outputs()
+    print ("Quantized embeddings give outputs close to float32 embeddings!")
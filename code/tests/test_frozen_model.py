@@ -0,0 +1,74 @@
+"""Checks that the exported inference-only bundle of each model gives the same distributions as its checkpoint,
+without the training ops"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from qa_baseline_model import QABaselineModel
+from qa_bidaf_model import QABidafModel
+from qa_selfattn_model import QASelfAttnModel
+from qa_stack_model import QAStackModel
+from qa_pointer_model import QAPointerModel
+from frozen_model import export_bundle, read_bundle, FrozenQAModel
+from vocab import Vocab, _START_VOCAB
+from tests.test_embedding_init import TestFlags, make_batch, VOCAB_SIZE
+
+MODEL_CLASSES = {"baseline": QABaselineModel, "bidaf": QABidafModel, "selfattn": QASelfAttnModel, "stack": QAStackModel, "pointer": QAPointerModel}
+WORDS = _START_VOCAB + ["w%i" % i for i in range(VOCAB_SIZE - len(_START_VOCAB))]
+
+
+def test_export_bundle():
+    rng = np.random.RandomState(0)
+    emb_matrix = rng.randn(VOCAB_SIZE, TestFlags.embedding_size).astype(np.float32)
+    batch = make_batch(rng)
+    word2id = Vocab(WORDS)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for (model_name, model_class) in sorted(MODEL_CLASSES.items()):
+            flags = TestFlags()
+            flags.model_name = model_name
+
+            # A training checkpoint
+            with tf.Graph().as_default():
+                tf.set_random_seed(0)
+                model = model_class(flags, word2id.id2word, word2id, emb_matrix)
+                with tf.Session() as sess:
+                    sess.run(tf.global_variables_initializer(), model.get_initializer_feed())
+                    expected = model.get_prob_dists(sess, batch)
+                    ckpt_path = model.saver.save(sess, os.path.join(tmp_dir, model_name + ".ckpt"))
+
+            # Exported from the inference-only graph
+            bundle_path = os.path.join(tmp_dir, model_name + ".pb")
+            with tf.Graph().as_default():
+                model = model_class(flags, word2id.id2word, word2id, emb_matrix, inference_only=True)
+                assert not [v for v in tf.global_variables() if "Adam" in v.name or "global_step" in v.name]
+                with tf.Session() as sess:
+                    model.saver.restore(sess, ckpt_path)
+                    model.initialize_embeddings(sess)
+                    assert np.allclose(model.get_prob_dists(sess, batch), expected, atol=1e-6)
+                    export_bundle(sess, model, bundle_path)
+
+            graph_def, info, words = read_bundle(bundle_path)
+            op_types = set(node.op for node in graph_def.node)
+            assert not op_types & set(["VariableV2", "Assert", "RandomUniform", "ApplyAdam", "ScalarSummary"])
+            assert not [node.name for node in graph_def.node if "loss" in node.name or "global_step" in node.name]
+            assert info["flags"]["model_name"] == model_name and words == WORDS
+
+            # Loaded from the bundle alone
+            with tf.Graph().as_default():
+                frozen = FrozenQAModel(flags, bundle_path)
+                assert frozen.word2id.lookup(WORDS).tolist() == range(len(WORDS))
+                with tf.Session() as sess:
+                    start_dist, end_dist = frozen.get_prob_dists(sess, batch)
+                    assert np.allclose(start_dist, expected[0], atol=1e-6) and np.allclose(end_dist, expected[1], atol=1e-6)
+                    assert [pos.tolist() for pos in frozen.get_start_end_pos(sess, batch)] == [np.argmax(dist, axis=1).tolist() for dist in expected]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    test_export_bundle()
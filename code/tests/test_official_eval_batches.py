@@ -0,0 +1,93 @@
+"""Checks the batches of official_eval mode: every example once, without changing the input lists,
+and the pipeline building, running and decoding them"""
+
+import time
+import threading
+
+import pytest
+
+from official_eval_helper import get_batch_generator, run_pipelined
+from vocab import Vocab, _START_VOCAB
+
+WORDS = _START_VOCAB + ["the", "cat", "sat", "on", "mat", "?"]
+
+
+def make_data(num_examples):
+    uuids = ["q%i" % i for i in range(num_examples)]
+    contexts = [WORDS[2:2 + 1 + i % 5] for i in range(num_examples)]
+    questions = [["?"] * (1 + i % 3) for i in range(num_examples)]
+    return uuids, contexts, questions
+
+
+def examples(batches):
+    """
+    Returns the sorted (uuid, context tokens, question length) of the examples of the batches
+    (read from each batch in turn, as its arrays are reused for later batches)
+    """
+    return sorted((uuid, list(context), qn_len) for b in batches for (uuid, context, qn_len) in zip(b.uuids, b.context_tokens, b.qn_mask.sum(axis=1)))
+
+
+def test_batches_replay():
+    vocab = Vocab(WORDS)
+    uuids, contexts, questions = make_data(1000)
+    expected = sorted(zip(uuids, contexts, [len(qn) for qn in questions]))
+    for bucket in (False, True):
+        for _ in range(2): # the lists can be read again
+            assert examples(get_batch_generator(vocab, uuids, contexts, questions, 7, 4, 3, dynamic_padding=True, bucket=bucket)) == expected
+            assert len(uuids) == len(contexts) == len(questions) == 1000
+        batch_sizes = [b.batch_size for b in get_batch_generator(vocab, uuids, contexts, questions, 7, 4, 3, bucket=bucket)]
+        assert batch_sizes == [7] * (1000 // 7) + [1000 % 7]
+
+    # Any iterables can be read as the batches are made
+    batches = list(get_batch_generator(vocab, iter(uuids), iter(contexts), (qn for qn in questions), 7, 4, 2))
+    assert [b.uuids for b in batches] == [tuple(uuids[i:i + 7]) for i in range(0, 1000, 7)]
+
+
+def test_batches_linear():
+    # 200k examples: popping the input lists one by one would take minutes
+    vocab = Vocab(WORDS)
+    uuids, contexts, questions = make_data(200000)
+    tic = time.time()
+    num_examples = sum(b.batch_size for b in get_batch_generator(vocab, uuids, contexts, questions, 100, 4, 2, dynamic_padding=True, bucket=True))
+    assert num_examples == 200000
+    assert time.time() - tic < 60
+
+
+def test_run_pipelined():
+    vocab = Vocab(WORDS)
+    uuids, contexts, questions = make_data(1000)
+    expected = {uuid: (min(len(context), 4), min(len(qn), 3)) for (uuid, context, qn) in zip(uuids, contexts, questions)}
+    max_batches = 3
+
+    for num_workers in (0, 1, 4):
+        results, threads = {}, set()
+        def run_batch(batch):
+            # Read from the id and mask arrays, which must not be overwritten while the batch is in use
+            time.sleep(0.001)
+            return batch.context_mask.sum(axis=1).tolist(), batch.qn_mask.sum(axis=1).tolist()
+        def decode_batch(batch, outputs):
+            threads.add(threading.current_thread().name)
+            for (uuid, context_len, qn_len) in zip(batch.uuids, *outputs):
+                results[uuid] = (context_len, qn_len)
+        batches = get_batch_generator(vocab, uuids, contexts, questions, 7, 4, 3, dynamic_padding=True, bucket=True, num_slots=max_batches + 2)
+        progress = []
+        run_pipelined(batches, run_batch, decode_batch, num_workers, max_batches, progress.append)
+        assert results == expected
+        assert progress == range(1, 1000 // 7 + 2)
+        assert (threading.current_thread().name in threads) == (num_workers == 0)
+        assert len(threads) <= max(num_workers, 1)
+
+    # An exception in a decoding thread is raised in the calling thread, once the threads have stopped
+    def fail(batch, outputs):
+        raise ValueError("decoding failed")
+    num_threads = threading.active_count()
+    batches = get_batch_generator(vocab, uuids, contexts, questions, 7, 4, 3, num_slots=max_batches + 2)
+    with pytest.raises(ValueError):
+        run_pipelined(batches, lambda batch: None, fail, 2, max_batches)
+    assert threading.active_count() == num_threads
+
+
+if __name__ == "__main__":
+    test_batches_replay()
+    test_batches_linear()
+    test_run_pipelined()
@@ -0,0 +1,310 @@
+"""Checks that preprocessing the SQuAD articles in parallel gives the same files as preprocessing them serially,
+and the incremental reader of the SQuAD JSON files"""
+
+import os
+import json
+import time
+import shutil
+import multiprocessing
+import tempfile
+
+import nltk
+import numpy as np
+import pytest
+
+from preprocessing.squad_preprocess import preprocess_and_write, get_char_word_loc_mapping, get_char_word_offsets, char_to_token, \
+    iter_articles, iter_paragraphs, imap_bounded, preprocess_incremental, regex_tokenize, tokenize, token_offsets
+from data_shards import shard_paths, open_data
+from compiled_data import compiled_dir
+
+DATASET = {"data": [
+    {"title": "a", "paragraphs": [
+        {"context": u"The cat sat on the mat. It was a fifth-generation cat.",
+         "qas": [{"id": "1", "question": u"Where did the cat sit?", "answers": [{"text": u"on the mat", "answer_start": 12}]},
+                 {"id": "2", "question": u"Which generation?", "answers": [{"text": u"generation", "answer_start": 39}]},
+                 {"id": "3", "question": u"Who sat?", "answers": [{"text": u"cat", "answer_start": 4}]}]}]},
+    {"title": "b", "paragraphs": [
+        {"context": u"Dogs bark at night, said ``Smith''.",
+         "qas": [{"id": "4", "question": u"When do dogs bark?", "answers": [{"text": u"at night", "answer_start": 10}]},
+                 {"id": "5", "question": u"Who said it?", "answers": [{"text": u"Smith", "answer_start": 27}]}]},
+        {"context": u"Paris is the capital of France.",
+         "qas": [{"id": "6", "question": u"What is the capital of France?", "answers": [{"text": u"Paris", "answer_start": 0}]}]}]},
+] * 5}
+
+
+def punkt_available():
+    try:
+        nltk.word_tokenize(u"Hello world.")
+        return True
+    except LookupError:
+        return False
+
+
+@pytest.mark.skipif(not punkt_available(), reason="needs the nltk punkt tokenizer data")
+def test_parallel_matches_serial():
+    outputs, num_exs = [], []
+    try:
+        for num_workers in (1, 3):
+            out_dir = tempfile.mkdtemp()
+            outputs.append(out_dir)
+            np.random.seed(42)
+            num_exs.append(preprocess_and_write(iter(DATASET["data"]), "train", out_dir, num_workers))
+            assert sorted(os.listdir(out_dir)) == ["train.answer", "train.context", "train.question", "train.span"]
+
+        # At least the "generation" answer is discarded: it's inside the "fifth-generation" token
+        assert num_exs[0] == num_exs[1] and 0 < num_exs[0] <= 25
+        for name in os.listdir(outputs[0]):
+            with open(os.path.join(outputs[0], name)) as f1, open(os.path.join(outputs[1], name)) as f2:
+                assert f1.read() == f2.read()
+    finally:
+        for out_dir in outputs:
+            shutil.rmtree(out_dir)
+
+
+def test_iter_articles_matches_json_load():
+    data_dir = tempfile.mkdtemp()
+    try:
+        json_path = os.path.join(data_dir, "data.json")
+        datasets = [DATASET, {"version": "1.1", "data": DATASET["data"], "count": 12.5}, {"data": []}, {"version": [1, {"a": "}"}]}]
+        for dataset in datasets:
+            for indent in (None, 2):
+                with open(json_path, 'w') as fh:
+                    json.dump(dataset, fh, indent=indent)
+                # Small chunks cut the values, the unicode escapes and the numbers
+                for chunk_size in (1, 7, 1 << 20):
+                    assert list(iter_articles(json_path, chunk_size)) == dataset.get("data", [])
+
+        records = list(iter_paragraphs(iter_articles(json_path)))
+        assert records == []
+        records = list(iter_paragraphs(DATASET["data"][:2]))
+        assert [(article["title"], len(qas)) for (article, paragraph, qas) in records] == [("a", 3), ("b", 2), ("b", 1)]
+        assert records[2][1]["context"] == u"Paris is the capital of France."
+
+        with open(json_path, 'w') as fh:
+            fh.write(json.dumps(DATASET)[:-50])
+        with pytest.raises(ValueError):
+            list(iter_articles(json_path, 7))
+    finally:
+        shutil.rmtree(data_dir)
+
+
+# The number of texts slow_tokenize tokenized, across the worker processes
+NUM_TOKENIZED = multiprocessing.Value('i', 0)
+
+
+def slow_tokenize(sequence):
+    """Fails on "fail", and takes 0.1s per text otherwise"""
+    if u"fail" in sequence:
+        raise ValueError("tokenizer failed")
+    time.sleep(0.1)
+    with NUM_TOKENIZED.get_lock():
+        NUM_TOKENIZED.value += 1
+    return regex_tokenize(sequence)
+
+
+def test_parallel_error_stops_workers():
+    out_dir = tempfile.mkdtemp()
+    try:
+        articles = [{"title": u"f", "paragraphs": [{"context": u"fail", "qas": []}]}] + DATASET["data"] * 8
+        NUM_TOKENIZED.value = 0
+        with pytest.raises(ValueError):
+            preprocess_and_write(iter(articles), "train", out_dir, 2, slow_tokenize)
+        # The workers are stopped, rather than left to tokenize the ~130 texts of the 31 other articles
+        # of the window queued with the failing one
+        num_tokenized = NUM_TOKENIZED.value
+        time.sleep(0.5)
+        assert NUM_TOKENIZED.value == num_tokenized < 40
+        assert os.listdir(out_dir) == []
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def test_imap_bounded():
+    pool = multiprocessing.Pool(2)
+    try:
+        taken = []
+        def items():
+            for i in range(20):
+                taken.append(i)
+                yield -i
+        results = imap_bounded(pool, abs, items(), 3)
+        assert next(results) == 0 and len(taken) == 3
+        # Each result taken lets one more item in
+        assert next(results) == 1 and len(taken) == 4
+        assert [next(results) for _ in range(2)] == [2, 3]
+        assert len(taken) == 6
+        assert list(results) == range(4, 20)
+    finally:
+        pool.close()
+        pool.join()
+
+
+TOKENIZED = []
+
+def counting_tokenize(sequence):
+    TOKENIZED.append(sequence)
+    return regex_tokenize(sequence)
+
+
+def failing_tokenize(sequence):
+    """counting_tokenize, failing after 5 texts"""
+    if len(TOKENIZED) == 5:
+        raise ValueError("tokenizer failed")
+    return counting_tokenize(sequence)
+
+
+def failing_regex_tokenize(sequence):
+    """Like failing_tokenize, but the same tokenizer (name) as regex_tokenize"""
+    return failing_tokenize(sequence)
+failing_regex_tokenize.__name__ = "regex_tokenize"
+
+
+def read_examples(data_dir, tier):
+    """Returns the sorted (context, question, answer, span) lines of all the shards of a split"""
+    files = [open_data(shard_paths(data_dir, tier, name)) for name in ("context", "question", "answer", "span")]
+    try:
+        return sorted(zip(*files))
+    finally:
+        for f in files:
+            f.close()
+
+
+def test_incremental():
+    data_dir, full_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    try:
+        articles = [dict(article, title=u"%s%i" % (article["title"], i)) for (i, article) in enumerate(DATASET["data"])]
+        preprocess_incremental(iter(articles), "train", data_dir, 1, counting_tokenize)
+        assert sorted(os.listdir(data_dir)) == ["train." + name for name in ("answer", "articles", "context", "manifest.json", "question", "span")]
+        assert shard_paths(data_dir, "train", "context") == os.path.join(data_dir, "train.context")
+
+        # Only the new and changed articles are tokenized again
+        new_article = {"title": u"new", "paragraphs": [{"context": u"Rome is in Italy.", "qas": [
+            {"id": "7", "question": u"Where is Rome?", "answers": [{"text": u"Italy", "answer_start": 11}]}]}]}
+        paragraphs = articles[3]["paragraphs"]
+        changed_article = dict(articles[3], paragraphs=[paragraphs[0], dict(paragraphs[1], context=u"Paris is the capital of France!")])
+        articles = articles[:2] + [changed_article] + articles[4:] + [new_article] # articles[2] is removed, articles[3] changed
+        del TOKENIZED[:]
+        preprocess_incremental(iter(articles), "train", data_dir, 1, counting_tokenize)
+        assert len(TOKENIZED) == 7 # 3 contexts and 4 questions
+        assert u"Rome is in Italy." in TOKENIZED and u"Paris is the capital of France!" in TOKENIZED
+        assert len(shard_paths(data_dir, "train", "context")) == 2
+
+        # The shards hold the same examples as preprocessing everything
+        preprocess_and_write(iter(articles), "train", full_dir, 1, regex_tokenize)
+        assert read_examples(data_dir, "train") == read_examples(full_dir, "train")
+
+        # Nothing to do the next time
+        del TOKENIZED[:]
+        shards = shard_paths(data_dir, "train", "context")
+        preprocess_incremental(iter(articles), "train", data_dir, 1, counting_tokenize)
+        assert TOKENIZED == [] and shard_paths(data_dir, "train", "context") == shards
+        assert read_examples(data_dir, "train") == read_examples(full_dir, "train")
+        assert len(os.listdir(data_dir)) == 5 * len(shards) + 1
+
+        # A rebuild interrupted halfway leaves the previous shards in use, untouched
+        files = {name: open(os.path.join(data_dir, name)).read() for name in os.listdir(data_dir)}
+        for (tokenizer, full) in ((failing_tokenize, False), (failing_regex_tokenize, True)):
+            del TOKENIZED[:]
+            with pytest.raises(ValueError):
+                preprocess_incremental(iter(articles), "train", data_dir, 1, tokenizer, full)
+            assert {name: open(os.path.join(data_dir, name)).read() for name in files} == files
+            assert read_examples(data_dir, "train") == read_examples(full_dir, "train")
+
+        # Another tokenizer preprocesses everything again, into a single new shard, and the old ones are deleted,
+        # with their compiled data
+        os.mkdir(compiled_dir(shards))
+        preprocess_incremental(iter(articles), "train", data_dir, 1, regex_tokenize)
+        new_shard = shard_paths(data_dir, "train", "context")
+        assert isinstance(new_shard, basestring) and new_shard not in shards
+        assert len(os.listdir(data_dir)) == 6
+        assert read_examples(data_dir, "train") == read_examples(full_dir, "train")
+
+        # So does full, from data preprocessed without a manifest too
+        os.remove(os.path.join(data_dir, "train.manifest.json"))
+        for name in ("context", "question", "answer", "span", "articles"):
+            os.rename(new_shard[:-len("context")] + name, os.path.join(data_dir, "train." + name))
+        preprocess_incremental(iter(articles), "train", data_dir, 1, regex_tokenize, full=True)
+        assert shard_paths(data_dir, "train", "context") != os.path.join(data_dir, "train.context")
+        assert len(os.listdir(data_dir)) == 6
+        assert read_examples(data_dir, "train") == read_examples(full_dir, "train")
+    finally:
+        shutil.rmtree(data_dir)
+        shutil.rmtree(full_dir)
+
+
+def random_alignment_case(rng):
+    """Returns a context and tokens, which sometimes don't align with it"""
+    words = [u"".join(rng.choice(list(u"ab\xe9\"-.")) for _ in range(rng.randint(1, 5))) for _ in range(rng.randint(0, 8))]
+    context = u""
+    for word in words:
+        context += u"".join(rng.choice([u" ", u"\n", u"\t", u""], size=rng.randint(0, 3))) + word
+    tokens = [w for word in context.replace(u"\n", u" ").split(u" ") for w in ([word[:1], word[1:]] if len(word) > 1 and rng.rand() < 0.2 else [word])]
+    tokens = [t for t in tokens if t or rng.rand() < 0.05]
+    if tokens and rng.rand() < 0.2: # merge two tokens, as for "fifth-generation"
+        i = rng.randint(len(tokens))
+        tokens[i:i+2] = [u"".join(tokens[i:i+2])]
+    if tokens and rng.rand() < 0.1: # a token that's not in the context
+        tokens[rng.randint(len(tokens))] = u"zz"
+    if tokens and rng.rand() < 0.05: # missing the last tokens
+        tokens = tokens[:rng.randint(len(tokens))]
+    return context, tokens
+
+
+def test_char_word_offsets_match_mapping():
+    rng = np.random.RandomState(0)
+    for _ in range(3000):
+        context, tokens = random_alignment_case(rng)
+        try:
+            mapping = get_char_word_loc_mapping(context, tokens)
+        except IndexError: # characters left after the last token
+            mapping = None
+        offsets = get_char_word_offsets(context, tokens)
+        assert (offsets is None) == (mapping is None), (context, tokens)
+        if mapping is None:
+            continue
+        for char_loc in range(len(context) + 1):
+            if char_loc in mapping:
+                assert char_to_token(offsets, char_loc) == mapping[char_loc][1]
+            else:
+                with pytest.raises(KeyError):
+                    char_to_token(offsets, char_loc)
+
+
+def check_offsets(text, tokens, offsets):
+    assert len(offsets) == len(tokens)
+    for (token, span) in zip(tokens, offsets):
+        if span is not None:
+            assert text[span[0]:span[1]].lower() in ([token, u"''", u"``"] if token == u'"' else [token])
+
+
+def test_token_offsets():
+    texts = [DATASET["data"][0]["paragraphs"][0]["context"], DATASET["data"][1]["paragraphs"][0]["context"],
+             u"He said \"I cannot go\" -- twice.\tThe caf\xe9\xa0is  OPEN...", u"", u"  ", u"(U.S.) 1,000 people; it's 5%."]
+    tokenizers = [regex_tokenize] + ([tokenize] if punkt_available() else [])
+    for tokenizer in tokenizers:
+        for text in texts:
+            tokens, offsets = tokenizer(text, return_offsets=True)
+            assert tokens == tokenizer(text)
+            check_offsets(text, tokens, offsets)
+            assert None not in offsets, (text, tokens, offsets)
+
+    # The answers are sliced with the original case and spacing
+    text = u"Dogs  bark at NIGHT."
+    tokens, offsets = regex_tokenize(text, return_offsets=True)
+    assert text[offsets[1][0]:offsets[3][1]] == u"bark at NIGHT"
+
+    # A token changed by the tokenizer has no offsets, but the next ones are found
+    offsets = token_offsets(u"it's a cat", [u"it", u"is", u"a", u"cat"])
+    assert offsets == [(0, 2), None, (5, 6), (7, 10)]
+    offsets = token_offsets(u"a b", [u"a", u"zzz"])
+    assert offsets == [(0, 1), None]
+
+
+if __name__ == "__main__":
+    test_parallel_matches_serial()
+    test_iter_articles_matches_json_load()
+    test_parallel_error_stops_workers()
+    test_imap_bounded()
+    test_incremental()
+    test_char_word_offsets_match_mapping()
+    test_token_offsets()
@@ -0,0 +1,64 @@
+"""Checks that the regex tokenizer gives the same tokens as nltk.word_tokenize"""
+
+import os
+import random
+
+import pytest
+from nltk.tokenize.treebank import TreebankWordTokenizer
+
+from preprocessing.regex_tokenizer import word_tokenize, split_sentences, treebank_tokenize
+from preprocessing.squad_preprocess import iter_articles, iter_paragraphs, tokenize, regex_tokenize
+from tests.test_preprocess import punkt_available
+
+DEV_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "data", "dev-v1.1.json")
+
+# Outputs of nltk.word_tokenize
+EXAMPLES = [
+    (u"Good muffins cost $3.88\nin New York.  Please buy me\ntwo of them.\nThanks.",
+     [u"Good", u"muffins", u"cost", u"$", u"3.88", u"in", u"New", u"York", u".", u"Please", u"buy", u"me", u"two", u"of", u"them", u".", u"Thanks", u"."]),
+    (u"They'll save and invest more.", [u"They", u"'ll", u"save", u"and", u"invest", u"more", u"."]),
+    (u"hi, my name can't hello,", [u"hi", u",", u"my", u"name", u"ca", u"n't", u"hello", u","]),
+    (u"Mr. Smith went to the U.S. in 1990. He said \"hello.\" Then he left.",
+     [u"Mr.", u"Smith", u"went", u"to", u"the", u"U.S.", u"in", u"1990", u".", u"He", u"said", u"``", u"hello", u".", u"''", u"Then", u"he", u"left", u"."]),
+]
+
+PIECES = [u"York", u"U.S.", u"Mr.", u"the", u"The", u"it's", u"dogs'", u"1990.", u"A.", u"end.", u'end."', u"end.)", u"why?", u"wow!'",
+          u"...", u"'", u'"', u",", u":", u"cannot", u"wanna", u"(", u"a,b", u"1,000", u"can't", u"$5.", u"etc.", u"``", u"caf\xe9.", u"--", u";",
+          u"`", u"company\u2019s", u"\u201cquoted\u201d", u"\u2018single\u2019", u"\xabangle\xbb", u"\u201elow", u"end.\u201d"]
+
+
+def test_examples():
+    for (text, expected) in EXAMPLES:
+        assert word_tokenize(text) == expected
+
+
+def test_single_treebank_pass():
+    # Tokenizing the whole text gives the same tokens as tokenizing each sentence
+    tb = TreebankWordTokenizer()
+    rng = random.Random(0)
+    for _ in range(5000):
+        text = u"".join(rng.choice(PIECES) + rng.choice([u" ", u"  ", u"\n", u" \t"]) for _ in range(rng.randint(1, 12)))
+        assert treebank_tokenize(text) == tb.tokenize(text)
+        assert word_tokenize(text) == [token for sentence in split_sentences(text) for token in tb.tokenize(sentence)], text
+
+
+@pytest.mark.skipif(not os.path.exists(DEV_PATH) or not punkt_available(), reason="needs data/dev-v1.1.json and the nltk punkt tokenizer data")
+def test_dev_set_parity():
+    texts = []
+    for (article, paragraph, qas) in iter_paragraphs(iter_articles(DEV_PATH)):
+        texts.append(unicode(paragraph['context']).replace("''", '" ').replace("``", '" '))
+        texts.extend(unicode(qn['question']) for qn in qas)
+
+    mismatches = [(text, tokenize(text), regex_tokenize(text)) for text in texts]
+    mismatches = [(text, expected, actual) for (text, expected, actual) in mismatches if expected != actual]
+    for (text, expected, actual) in mismatches[:20]:
+        print "nltk:  %s\nregex: %s\n" % (" ".join(expected), " ".join(actual))
+    print "%i of %i texts tokenized differently" % (len(mismatches), len(texts))
+    # The differences come from Punkt's sentence ends (see regex_tokenizer.py)
+    assert len(mismatches) <= 0.02 * len(texts)
+
+
+if __name__ == "__main__":
+    test_examples()
+    test_single_treebank_pass()
+    test_dev_set_parity()
@@ -0,0 +1,155 @@
+"""Checks the micro-batching of serve mode, and the HTTP server answering with a small checkpoint, over TCP and a Unix socket"""
+
+import os
+import json
+import time
+import shutil
+import socket
+import httplib
+import tempfile
+import threading
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from serving import MicroBatcher, make_predict_fn, make_server
+from official_eval_helper import tokenize_context
+from preprocessing.squad_preprocess import regex_tokenize
+from qa_baseline_model import QABaselineModel
+from vocab import Vocab, _START_VOCAB
+from tests.test_embedding_init import TestFlags
+
+WORDS = _START_VOCAB + ["the", "cat", "sat", "on", "mat", "where", "did", "sit", ".", "?"]
+CONTEXT = u"The cat  sat on the Mat."
+
+
+class ServeFlags(TestFlags):
+    context_len = 20
+    window_stride = 0
+    max_answer_len = 30
+    dynamic_padding = True
+    bucket_width = 20
+    prefetch_batches = 2
+
+
+def run_threads(target, num_threads):
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_micro_batcher():
+    batch_sizes = []
+    def predict(examples):
+        batch_sizes.append(len(examples))
+        if "fail" in examples:
+            raise ValueError("failed")
+        time.sleep(0.01)
+        return [2 * x for x in examples]
+
+    batcher = MicroBatcher(predict, max_batch_size=8, max_wait=0.05)
+    try:
+        # Concurrent requests are answered in batches of at most max_batch_size
+        results = {}
+        def request(i):
+            results[i] = batcher.submit([i, i + 100])
+        run_threads(request, 40)
+        assert results == {i: [2 * i, 2 * (i + 100)] for i in range(40)}
+        assert sum(batch_sizes) == 80 and max(batch_sizes) == 8 and len(batch_sizes) < 40
+        assert batcher.batch_limit > 1
+
+        # One request at a time doesn't wait for others
+        for i in range(10):
+            tic = time.time()
+            assert batcher.submit([i]) == [2 * i]
+        assert batcher.batch_limit == 1 and time.time() - tic < 0.05
+        assert batcher.submit([]) == []
+
+        with pytest.raises(ValueError):
+            batcher.submit([1, "fail"])
+        stats = batcher.stats.snapshot()
+        assert stats["batches"] == len(batch_sizes)
+    finally:
+        batcher.close()
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, "localhost")
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self._path)
+
+
+def call(connection, method, path, body=None):
+    connection.request(method, path, body=None if body is None else json.dumps(body), headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def test_server():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # A small checkpoint, restored as in serve mode
+        word2id = Vocab(WORDS)
+        emb_matrix = np.random.RandomState(0).randn(len(WORDS), TestFlags.embedding_size).astype(np.float32)
+        tf.reset_default_graph()
+        model = QABaselineModel(ServeFlags(), WORDS, word2id, emb_matrix)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer(), model.get_initializer_feed())
+            ckpt_path = model.saver.save(sess, os.path.join(tmp_dir, "qa.ckpt"))
+        sess = tf.Session()
+        model.saver.restore(sess, ckpt_path)
+        model.initialize_embeddings(sess)
+
+        predict = make_predict_fn(sess, model, word2id)
+        context_tokens, context_offsets = tokenize_context(CONTEXT, regex_tokenize, return_offsets=True)
+        expected = predict([(context_tokens, regex_tokenize(u"Where did the cat sit?"), context_offsets)])[0]
+        assert expected in CONTEXT # sliced from the context
+
+        for unix_socket in ("", os.path.join(tmp_dir, "qa.sock")):
+            batcher = MicroBatcher(predict, max_batch_size=ServeFlags.batch_size, max_wait=0.01)
+            server = make_server(batcher, regex_tokenize, port=0, unix_socket=unix_socket)
+            server_thread = threading.Thread(target=server.serve_forever)
+            server_thread.start()
+            connect = (lambda: UnixHTTPConnection(unix_socket)) if unix_socket else (lambda: httplib.HTTPConnection(*server.server_address))
+            try:
+                answers = {}
+                def request(i):
+                    connection = connect()
+                    for j in range(3): # on the same connection
+                        qn = {"context": CONTEXT, "question": u"Where did the cat sit?"}
+                        answers[i, j] = call(connection, "POST", "/answer", qn if j else [qn, qn])
+                    connection.close()
+                run_threads(request, 10)
+                for (i, j), (status, answer) in answers.items():
+                    assert status == 200
+                    assert answer == ({"answer": expected} if j else [{"answer": expected}] * 2)
+
+                connection = connect()
+                assert call(connection, "POST", "/answer", {"context": CONTEXT})[0] == 400
+                assert call(connection, "GET", "/nothing")[0] == 404
+                status, stats = call(connection, "GET", "/stats")
+                assert status == 200
+                assert stats["requests"] == 30 and stats["questions"] == 40 and stats["errors"] == 1
+                assert 0 < stats["latency_p50_ms"] <= stats["latency_p99_ms"]
+                assert stats["questions_per_sec"] > 0 and stats["mean_batch_size"] >= 1
+                connection.close()
+            finally:
+                server.shutdown()
+                server.server_close()
+                server_thread.join()
+                batcher.close()
+        sess.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    test_micro_batcher()
+    test_server()
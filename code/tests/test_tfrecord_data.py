@@ -0,0 +1,116 @@
+"""Checks that the tf.data pipeline over the TFRecord data gives the same batches as data_batcher,
+and that the models train from it"""
+
+import json
+import shutil
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from vocab import Vocab
+from qa_baseline_model import QABaselineModel
+from compiled_data import load_compiled
+from tfrecord_data import load_tfrecord, make_dataset
+from tests.test_data_batcher import WORDS, write_split, collect
+from tests.test_embedding_init import TestFlags, VOCAB_SIZE, EMBEDDING_SIZE, BS
+
+FIELDS = ("context_ids", "context_mask", "qn_ids", "qn_mask", "ans_span")
+
+
+def pipeline_batches(path, **kwargs):
+    tf.reset_default_graph()
+    next_batch = make_dataset(path, 3, context_len=10, question_len=4, **kwargs).make_one_shot_iterator().get_next()
+    batches = []
+    with tf.Session() as sess:
+        while True:
+            try:
+                batches.append(sess.run(next_batch))
+            except tf.errors.OutOfRangeError:
+                return batches
+
+
+def test_pipeline_matches_batcher():
+    data_dir = tempfile.mkdtemp()
+    try:
+        paths = write_split(data_dir, 50, np.random.RandomState(0))
+        vocab = Vocab(WORDS)
+        path = load_tfrecord(vocab, *paths)
+        assert load_tfrecord(vocab, *paths) == path
+
+        for (discard_long, dynamic_padding) in [(True, False), (False, True), (True, True)]:
+            expected = collect(vocab, paths, True, discard_long=discard_long, random=False, dynamic_padding=dynamic_padding)
+            batches = pipeline_batches(path, discard_long=discard_long, dynamic_padding=dynamic_padding)
+            assert len(batches) == len(expected)
+            for (batch, expected_batch) in zip(batches, expected):
+                for (name, value) in zip(FIELDS, batch):
+                    assert np.array_equal(value, getattr(expected_batch, name)), name
+
+        # With buckets and shuffling, the batches hold the same examples, grouped by context length
+        batches = pipeline_batches(path, discard_long=False, dynamic_padding=True, bucket_width=4, shuffle_buffer=20)
+        assert sum(len(batch[0]) for batch in batches) == 49
+        for batch in batches:
+            lens = batch[1].sum(axis=1)
+            assert len(set(lens // 4)) == 1
+            assert batch[0].shape[1] == lens.max()
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_train_from_pipeline():
+    data_dir = tempfile.mkdtemp()
+    try:
+        paths = write_split(data_dir, 30, np.random.RandomState(1))
+        emb_matrix = np.random.RandomState(0).randn(VOCAB_SIZE, EMBEDDING_SIZE).astype(np.float32)
+        flags = TestFlags()
+        flags.input_pipeline = "tfdata"
+        flags.dynamic_padding = True
+        flags.bucket_width = 0
+        flags.prefetch_batches = 2
+        flags.prefetch_workers = 1
+
+        split = load_compiled(Vocab(WORDS), *paths)
+        num_kept = np.sum((split.context_lens <= flags.context_len) & (split.qn_lens <= flags.question_len))
+
+        tf.reset_default_graph()
+        model = QABaselineModel(flags, {}, Vocab(WORDS), emb_matrix)
+        summary_writer = tf.summary.FileWriter(tempfile.mkdtemp())
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer(), model.get_initializer_feed())
+            for epoch in range(2):
+                num_examples = 0
+                with model.train_batches(sess, *paths) as batches:
+                    for batch in batches:
+                        try:
+                            num_examples += model.run_train_iter(sess, batch, summary_writer)[4]
+                        except tf.errors.OutOfRangeError:
+                            break
+                assert num_examples == num_kept
+            assert sess.run(model.global_step) == 2 * -(-num_kept // BS)
+
+            # Resuming an epoch from its state gives the rest of its batches
+            with model.train_batches(sess, *paths) as batches:
+                epoch_batches = []
+                for _ in batches:
+                    try:
+                        epoch_batches.append(sess.run(model.train_next_batch))
+                    except tf.errors.OutOfRangeError:
+                        break
+                    if len(epoch_batches) == 2:
+                        resume_state = json.loads(json.dumps(batches.state))
+            with model.train_batches(sess, *paths, resume_state=resume_state) as batches:
+                for (expected, _) in zip(epoch_batches[2:], batches):
+                    for (value, expected_value) in zip(sess.run(model.train_next_batch), expected):
+                        assert np.array_equal(value, expected_value)
+
+            # The inputs can still be fed, e.g. for evaluation
+            batch = collect(Vocab(WORDS), paths, True, discard_long=True, random=False)[0]
+            start_dist, _ = model.get_prob_dists(sess, batch)
+            assert start_dist.shape == batch.context_ids.shape
+    finally:
+        shutil.rmtree(data_dir)
+
+
+if __name__ == "__main__":
+    test_pipeline_matches_batcher()
+    test_train_from_pipeline()
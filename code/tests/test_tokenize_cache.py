@@ -0,0 +1,77 @@
+"""Checks the on-disk cache of the tokenized official_eval JSON inputs"""
+
+import os
+import json
+import shutil
+import tempfile
+
+import official_eval_helper
+from official_eval_helper import tokenize_cache_path, write_tokenize_cache, read_tokenize_cache, get_json_data
+from preprocessing.squad_preprocess import regex_tokenize
+
+UUIDS = [u"q1", u"q2", u"q3"]
+CONTEXT_A = [u"the", u"caf\xe9", u"is", u"open", u"."]
+CONTEXT_B = [u"paris", u"."]
+CONTEXTS = [CONTEXT_A, CONTEXT_A, CONTEXT_B]
+QUESTIONS = [[u"is", u"it", u"open", u"?"], [u"what", u"?"], [u"where", u"?"]]
+OFFSETS_A = (u"The caf\xe9 is  open.", [(0, 3), (4, 8), (9, 11), (13, 17), (17, 18)])
+OFFSETS_B = (u"Paris!", [(0, 5), None])
+OFFSETS = [OFFSETS_A, OFFSETS_A, OFFSETS_B]
+
+
+def test_cache_roundtrip(monkeypatch):
+    cache_dir = tempfile.mkdtemp()
+    try:
+        json_path = cache_dir + "/input.json"
+        json_bytes = json.dumps({"data": [], "version": "1.1"})
+        with open(json_path, 'w') as fh:
+            fh.write(json_bytes)
+        cache_path = tokenize_cache_path(cache_dir, json_path)
+        write_tokenize_cache(cache_path, UUIDS, CONTEXTS, QUESTIONS, OFFSETS)
+        assert read_tokenize_cache(cache_path) == (UUIDS, CONTEXTS, QUESTIONS, OFFSETS)
+        assert tokenize_cache_path(cache_dir, json_path, chunk_size=3) == cache_path
+
+        # Keyed by the contents of the file and the tokenizer version
+        with open(json_path, 'w') as fh:
+            fh.write(json_bytes + " ")
+        assert tokenize_cache_path(cache_dir, json_path) != cache_path
+        with open(json_path, 'w') as fh:
+            fh.write(json_bytes)
+        monkeypatch.setattr(official_eval_helper, "TOKENIZER_VERSION", official_eval_helper.TOKENIZER_VERSION + 1)
+        assert tokenize_cache_path(cache_dir, json_path) != cache_path
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_get_json_data_uses_cache(monkeypatch):
+    cache_dir = tempfile.mkdtemp()
+    try:
+        json_path = cache_dir + "/input.json"
+        with open(json_path, 'w') as fh:
+            fh.write(json.dumps({"data": [], "version": "1.1"}))
+
+        # The first read tokenizes the file and caches the result
+        monkeypatch.setattr(official_eval_helper, "preprocess_dataset", lambda paragraphs, tokenizer: (UUIDS, CONTEXTS, QUESTIONS, OFFSETS))
+        assert get_json_data(json_path, cache_dir) == (UUIDS, CONTEXTS, QUESTIONS, OFFSETS)
+
+        # The next reads don't tokenize it again
+        def fail(paragraphs, tokenizer):
+            raise AssertionError("the file was tokenized again")
+        monkeypatch.setattr(official_eval_helper, "preprocess_dataset", fail)
+        assert get_json_data(json_path, cache_dir) == (UUIDS, CONTEXTS, QUESTIONS, OFFSETS)
+
+        # Nor with the other tokenizer, which has its own cache
+        monkeypatch.setattr(official_eval_helper, "preprocess_dataset", lambda paragraphs, tokenizer: ([], [], [], []))
+        assert get_json_data(json_path, cache_dir, regex_tokenize) == ([], [], [], [])
+        assert get_json_data(json_path, cache_dir) == (UUIDS, CONTEXTS, QUESTIONS, OFFSETS)
+
+        # A corrupt cache is tokenized again, and rewritten
+        cache_path = tokenize_cache_path(cache_dir, json_path)
+        with open(cache_path, 'r+') as fh:
+            fh.truncate(20)
+        monkeypatch.setattr(official_eval_helper, "preprocess_dataset", lambda paragraphs, tokenizer: (UUIDS, CONTEXTS, QUESTIONS, OFFSETS))
+        assert get_json_data(json_path, cache_dir) == (UUIDS, CONTEXTS, QUESTIONS, OFFSETS)
+        assert read_tokenize_cache(cache_path) == (UUIDS, CONTEXTS, QUESTIONS, OFFSETS)
+        assert len(os.listdir(cache_dir)) == 3 # the input and the two caches, without temporary files
+    finally:
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,66 @@
+"""Checks that the state of the training loop saved with a checkpoint is the one after that step's evaluation"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from vocab import Vocab
+from qa_baseline_model import QABaselineModel
+from tests.test_data_batcher import WORDS, write_split
+from tests.test_embedding_init import TestFlags, VOCAB_SIZE, EMBEDDING_SIZE
+
+
+def test_state_saved_after_eval():
+    data_dir, train_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    try:
+        paths = write_split(data_dir, 40, np.random.RandomState(1))
+        emb_matrix = np.random.RandomState(0).randn(VOCAB_SIZE, EMBEDDING_SIZE).astype(np.float32)
+        flags = TestFlags()
+        flags.train_dir = train_dir
+        flags.num_epochs = 1
+        flags.print_every = 100
+        flags.save_every = flags.eval_every = 2
+        flags.keep = 5
+        flags.compiled_data = True
+        flags.dynamic_padding = False
+        flags.bucket_width = 0
+        flags.prefetch_batches = 1
+        flags.prefetch_workers = 0
+
+        tf.reset_default_graph()
+        model = QABaselineModel(flags, {}, Vocab(WORDS), emb_matrix)
+        dev_f1s = []
+        def check_f1_em(session, context_path, qn_path, ans_path, dataset, num_samples=100, print_to_screen=False):
+            if dataset == "train":
+                return 0., 0.
+            return dev_f1s.pop(0), 0.
+        model.check_f1_em = check_f1_em
+        model.get_dev_loss = lambda *args: 0.
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer(), model.get_initializer_feed())
+
+            # Each evaluation of the first epoch improves the dev F1
+            dev_f1s[:] = [0.1 * (i + 1) for i in range(20)]
+            model.train(sess, paths[0], paths[1], paths[2], paths[1], paths[0], paths[2])
+            latest_f1 = 0.1 * (20 - len(dev_f1s))
+            assert len(dev_f1s) <= 18
+            assert model.load_train_state()["best_dev_f1"] == latest_f1
+            best_checkpoint = tf.train.latest_checkpoint(os.path.join(train_dir, "best_checkpoint"))
+
+            # When resuming, an F1 between the last two doesn't replace the best checkpoint
+            flags.num_epochs = 2
+            dev_f1s[:] = [latest_f1 - 0.05] * 20
+            model.train(sess, paths[0], paths[1], paths[2], paths[1], paths[0], paths[2])
+            assert len(dev_f1s) < 20
+            assert tf.train.latest_checkpoint(os.path.join(train_dir, "best_checkpoint")) == best_checkpoint
+    finally:
+        shutil.rmtree(data_dir)
+        shutil.rmtree(train_dir)
+
+
+if __name__ == "__main__":
+    test_state_saved_after_eval()
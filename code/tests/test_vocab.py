@@ -0,0 +1,81 @@
+"""Checks the array-backed Vocab against the dictionary lookups it replaces, and the binary GloVe cache"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from vocab import Vocab, PAD_ID, UNK_ID, _START_VOCAB, get_glove, glove_cache_paths
+
+WORDS = _START_VOCAB + ["the", "cat", "sat", "caf\xc3\xa9", "a" * 10]
+
+
+def test_lookup_matches_dict():
+    vocab = Vocab(WORDS)
+    word2id = dict((w, idx) for (idx, w) in enumerate(WORDS))
+    tokens = ["the", "dog", "sat", "a" * 10, "a" * 11, "", "<pad>", "<unk>", "cat"]
+    assert vocab.lookup(tokens).tolist() == [word2id.get(w, UNK_ID) for w in tokens]
+    assert vocab.lookup([u"caf\xe9", u"cat"]).tolist() == [5, 3]
+    assert vocab.lookup([]).shape == (0,)
+
+
+def test_mapping_interface():
+    vocab = Vocab(WORDS)
+    assert len(vocab) == len(WORDS)
+    assert "sat" in vocab and "dog" not in vocab and "<unk>" in vocab
+    assert vocab["sat"] == 4 and vocab.get("dog", -1) == -1
+    assert vocab.id2word[3] == "cat"
+
+
+def test_encode():
+    vocab = Vocab(WORDS)
+    ids, lengths = vocab.encode([["the", "cat", "dog"], [], ["sat"] * 5], max_len=4)
+    assert ids.dtype == np.int32 and ids.shape == (3, 4)
+    assert ids.tolist() == [[2, 3, UNK_ID, PAD_ID], [PAD_ID] * 4, [4] * 4]
+    assert lengths.tolist() == [3, 0, 4]
+
+    ids, lengths = vocab.encode([["the"], ["cat", "sat"]])
+    assert ids.tolist() == [[2, PAD_ID], [3, 4]]
+    assert lengths.tolist() == [1, 2]
+
+
+def write_glove(path, rng, num_words=20, dim=3):
+    with open(path, 'w') as fh:
+        for i in range(num_words):
+            fh.write("w%i %s\n" % (i, " ".join("%.4f" % x for x in rng.randn(dim))))
+
+
+def test_glove_cache_rewrite():
+    data_dir = tempfile.mkdtemp()
+    try:
+        glove_path = os.path.join(data_dir, "g.txt")
+        write_glove(glove_path, np.random.RandomState(0))
+        emb_matrix, word2id, _ = get_glove(glove_path, 3, num_workers=1)
+        matrix_path = glove_cache_paths(glove_path)[0]
+
+        # A truncated cache is parsed again
+        with open(matrix_path, 'r+b') as fh:
+            fh.truncate(100)
+        emb_matrix2, word2id2, _ = get_glove(glove_path, 3, num_workers=1)
+        assert np.array_equal(emb_matrix2[2:], emb_matrix[2:]) and len(word2id2) == len(word2id)
+        cached, _, _ = get_glove(glove_path, 3, num_workers=1)
+        assert isinstance(cached, np.memmap)
+
+        # Rewriting a stale cache leaves the arrays already memory-mapped from it intact
+        old_rows = np.array(cached)
+        write_glove(glove_path, np.random.RandomState(1), num_words=30)
+        new_matrix, _, _ = get_glove(glove_path, 3, num_workers=1)
+        assert new_matrix.shape == (32, 3)
+        assert np.array_equal(cached, old_rows)
+        assert sorted(os.listdir(data_dir)) == ["g.cache.json", "g.npy", "g.txt", "g.vocab"]
+    finally:
+        shutil.rmtree(data_dir)
+
+
+if __name__ == "__main__":
+    test_lookup_matches_dict()
+    test_mapping_interface()
+    test_encode()
+    test_glove_cache_rewrite()
+    print ("Vocab lookups match the dictionary lookups!")
@@ -0,0 +1,127 @@
+"""Checks the sliding-window answers of official_eval mode on long contexts, and the answers sliced from the original contexts"""
+
+import numpy as np
+import pytest
+
+from official_eval_helper import split_windows, best_span, generate_answers, tokenize_context, get_answer
+from preprocessing.squad_preprocess import token_offsets, regex_tokenize
+from vocab import Vocab, _START_VOCAB
+
+
+def detokenizer_available():
+    try:
+        from nltk.tokenize.moses import MosesDetokenizer
+        return True
+    except LookupError:
+        return False
+
+
+# Without context offsets, the answers are detokenized
+needs_detokenizer = pytest.mark.skipif(not detokenizer_available(), reason="needs the nltk perluniprops data")
+
+
+class WindowFlags(object):
+    context_len = 4
+    question_len = 3
+    window_stride = 2
+    max_answer_len = 3
+    batch_size = 3
+    dynamic_padding = True
+    bucket_width = 20
+    prefetch_workers = 0
+    prefetch_batches = 2
+
+
+class FakeModel(object):
+    """Gives the start and end probabilities of the tokens "start" and "end", and 1/8 to the others"""
+    FLAGS = WindowFlags
+
+    def get_prob_dists(self, session, batch):
+        shape = batch.context_ids.shape
+        start_dists, end_dists = np.full(shape, 0.125), np.full(shape, 0.125)
+        for (i, tokens) in enumerate(batch.context_tokens):
+            for (j, token) in enumerate(tokens[:shape[1]]): # without windows, the long contexts are truncated
+                if token.startswith("start"):
+                    start_dists[i, j] = float(token[5:])
+                if token.startswith("end"):
+                    end_dists[i, j] = float(token[3:])
+        return start_dists * batch.context_mask, end_dists * batch.context_mask
+
+    def get_start_end_pos(self, session, batch):
+        start_dists, end_dists = self.get_prob_dists(session, batch)
+        return np.argmax(start_dists, axis=1), np.argmax(end_dists, axis=1)
+
+
+def test_split_windows():
+    keys, windows, qns = split_windows(["a", "b"], [list("abcdefg"), list("ab")], [["q1"], ["q2"]], 4, 2)
+    assert keys == [("a", 0), ("a", 2), ("a", 3), ("b", 0)]
+    assert windows == [list("abcd"), list("cdef"), list("defg"), list("ab")]
+    assert qns == [["q1"], ["q1"], ["q1"], ["q2"]]
+
+
+def test_best_span():
+    start_dist = np.array([0.1, 0.6, 0.1, 0.2])
+    end_dist = np.array([0.5, 0.05, 0.05, 0.4])
+    # The end can't be before the start
+    assert best_span(start_dist, end_dist, 4)[:2] == (1, 3)
+    assert np.isclose(best_span(start_dist, end_dist, 4)[2], 0.24)
+    # Nor too far after it
+    assert best_span(start_dist, end_dist, 2)[:2] == (3, 3)
+
+
+@needs_detokenizer
+def test_windowed_answers():
+    contexts = [
+        "a b c start0.9 d end0.9 e".split(), # the answer is only in the second window
+        "start0.5 end0.5 a b c d start0.6 end0.9".split(), # the best of two spans in different windows
+        "a start0.9 end0.9".split(), # shorter than context_len
+        "start0.9 a b c d end0.9".split(), # too long an answer: a span of max_answer_len tokens
+    ]
+    uuids = ["u%i" % i for i in range(len(contexts))]
+    word2id = Vocab(_START_VOCAB + sorted(set(token for tokens in contexts for token in tokens)) + ["q"])
+    answers = generate_answers(None, FakeModel(), word2id, uuids, contexts, [["q"]] * len(contexts))
+    assert answers == {"u0": "start0.9 d end0.9", "u1": "start0.6 end0.9", "u2": "start0.9 end0.9", "u3": "start0.9"}
+
+    # With the offsets of the original contexts, the answers are sliced from them
+    texts = [u"A b c  Start0.9 d\tEnd0.9 e", u"start0.5 end0.5 a b c d START0.6  end0.9", u"a start0.9 end0.9", u"start0.9 a b c d end0.9"]
+    context_offset_data = [(text, token_offsets(text, tokens)) for (text, tokens) in zip(texts, contexts)]
+    answers = generate_answers(None, FakeModel(), word2id, uuids, contexts, [["q"]] * len(contexts), context_offset_data=context_offset_data)
+    assert answers == {"u0": u"Start0.9 d\tEnd0.9", "u1": u"START0.6  end0.9", "u2": u"start0.9 end0.9", "u3": u"start0.9"}
+
+
+@needs_detokenizer
+def test_pipelined_answers():
+    # The same answers with the decoding in other threads, with and without windows
+    rng = np.random.RandomState(0)
+    contexts = [[rng.choice(["a", "b", "start0.%i" % rng.randint(2, 10), "end0.%i" % rng.randint(2, 10)]) for _ in range(rng.randint(1, 12))]
+                for _ in range(500)]
+    uuids = ["u%i" % i for i in range(len(contexts))]
+    word2id = Vocab(_START_VOCAB + sorted(set(token for tokens in contexts for token in tokens)) + ["q"])
+    for window_stride in (0, 2):
+        WindowFlags.window_stride = window_stride
+        try:
+            answers = [generate_answers(None, FakeModel(), word2id, uuids, contexts, [["q"]] * len(contexts), verbose=False, num_workers=num_workers)
+                       for num_workers in (0, 1, 3)]
+        finally:
+            WindowFlags.window_stride = 2
+        assert len(answers[0]) == len(contexts)
+        assert answers[0] == answers[1] == answers[2]
+
+
+
+def test_tokenize_context_offsets():
+    context = u"Dogs  bark, said ``Smith''. ''Cats`` Don't."
+    tokens, (original, offsets) = tokenize_context(context, regex_tokenize, return_offsets=True)
+    assert tokens == tokenize_context(context, regex_tokenize) and original == context
+    answers = [get_answer(tokens, (original, offsets), i, i) for i in range(len(tokens))]
+    assert answers == [u"Dogs", u"bark", u",", u"said", u"``", u"Smith", u"''", u".", u"''", u"Cats", u"``", u"Do", u"n't", u"."]
+    assert get_answer(tokens, (original, offsets), 0, 3) == u"Dogs  bark, said"
+    assert get_answer(tokens, (original, offsets), 4, 6) == u"``Smith''"
+
+
+if __name__ == "__main__":
+    test_split_windows()
+    test_best_span()
+    test_windowed_answers()
+    test_pipelined_answers()
+    test_tokenize_context_offsets()
@@ -0,0 +1,219 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains code to write the word ids of a compiled split to a TFRecord file,
+and to read them back with a tf.data pipeline that shuffles, buckets, pads and prefetches
+the training batches inside the graph, instead of feeding them through feed_dict
+(see --input_pipeline in main.py)"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import json
+import time
+import random
+
+import tensorflow as tf
+from six.moves import xrange
+
+from compiled_data import load_compiled
+
+
+def tfrecord_path(split):
+    """Returns the path of the TFRecord version of a CompiledSplit, e.g. data/train.compiled/<vocab fingerprint>/examples.tfrecord"""
+    return os.path.join(split.path, "examples.tfrecord")
+
+
+def int64_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+
+def write_tfrecord(split, out_path):
+    """
+    Writes the examples of a CompiledSplit to out_path, one tf.train.Example per example,
+    with int64 features context_ids, qn_ids and ans_span.
+    """
+    print "Writing %i examples to %s..." % (split.num_examples, out_path)
+    tic = time.time()
+    with tf.python_io.TFRecordWriter(out_path) as writer:
+        for idx in xrange(split.num_examples):
+            example = tf.train.Example(features=tf.train.Features(feature={
+                "context_ids": int64_feature(split.context_ids[split.context_offsets[idx]:split.context_offsets[idx+1]]),
+                "qn_ids": int64_feature(split.qn_ids[split.qn_offsets[idx]:split.qn_offsets[idx+1]]),
+                "ans_span": int64_feature(split.ans_span[idx])}))
+            writer.write(example.SerializeToString())
+    toc = time.time()
+    print "Wrote %i examples in %.2f seconds" % (split.num_examples, toc-tic)
+
+
+def load_tfrecord(word2id, context_path, qn_path, ans_path):
+    """
+    Returns the path of the TFRecord file for the given data files,
+    writing it first if it's missing or older than the compiled split it's made from
+    (see compiled_data.load_compiled, which recompiles when the data or vocabulary change).
+    """
+    split = load_compiled(word2id, context_path, qn_path, ans_path)
+    out_path = tfrecord_path(split)
+    compiled_meta_path = os.path.join(split.path, "meta.json")
+    meta_path = out_path + ".meta.json"
+
+    # The TFRecord file records the metadata of the compiled split it was written from
+    with open(compiled_meta_path) as fh:
+        compiled_meta = json.load(fh)
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path) as fh:
+            meta = json.load(fh)
+
+    if meta != compiled_meta:
+        # The file is written under a temporary name and then renamed, so that a reader of the previous file
+        # never sees it rewritten in place, and the old metadata is removed first, so that an interrupted write
+        # never looks complete
+        if meta is not None:
+            os.remove(meta_path)
+        tmp_path = "%s.tmp-%i" % (out_path, os.getpid())
+        try:
+            write_tfrecord(split, tmp_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.rename(tmp_path, out_path)
+        with open(meta_path, 'w') as fh:
+            json.dump(compiled_meta, fh)
+
+    return out_path
+
+
+def parse_example(serialized):
+    """Parses a serialized tf.train.Example into (context_ids, qn_ids, ans_span), as int32 tensors"""
+    features = tf.parse_single_example(serialized, {
+        "context_ids": tf.FixedLenSequenceFeature([], tf.int64, allow_missing=True),
+        "qn_ids": tf.FixedLenSequenceFeature([], tf.int64, allow_missing=True),
+        "ans_span": tf.FixedLenFeature([2], tf.int64)})
+    return tf.to_int32(features["context_ids"]), tf.to_int32(features["qn_ids"]), tf.to_int32(features["ans_span"])
+
+
+def make_dataset(filenames, batch_size, context_len, question_len, discard_long,
+                 dynamic_padding=False, bucket_width=0, shuffle_buffer=0, shuffle_seed=None, prefetch_batches=1, num_parallel_calls=2):
+    """
+    Builds a tf.data pipeline giving the batches of one epoch over the given TFRecord files.
+
+    Inputs:
+      filenames: string tensor (or list of strings), paths to files written by write_tfrecord
+      batch_size, context_len, question_len, discard_long: as in data_batcher.get_batch_generator
+      dynamic_padding: If True, pad each batch only to its longest context and question,
+        otherwise pad every batch to context_len and question_len
+      bucket_width: If nonzero, batch together contexts of lengths within bucket_width tokens of each other
+      shuffle_buffer: If nonzero, shuffle the examples with a buffer of that many examples
+      shuffle_seed: int64 scalar tensor (or int). The seed of the shuffling, which then gives the same batches each time.
+      prefetch_batches: Number of batches to build ahead of the training steps
+      num_parallel_calls: Number of threads parsing examples
+
+    Returns:
+      A tf.data.Dataset of tuples (context_ids, context_mask, qn_ids, qn_mask, ans_span),
+      with the same shapes and dtypes as the corresponding fields of a data_batcher.Batch
+    """
+    dataset = tf.data.TFRecordDataset(filenames)
+    dataset = dataset.map(parse_example, num_parallel_calls=num_parallel_calls)
+
+    if discard_long:
+        dataset = dataset.filter(lambda context_ids, qn_ids, ans_span:
+                                 tf.logical_and(tf.size(context_ids) <= context_len, tf.size(qn_ids) <= question_len))
+    else:
+        dataset = dataset.map(lambda context_ids, qn_ids, ans_span: (context_ids[:context_len], qn_ids[:question_len], ans_span))
+
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer, seed=shuffle_seed)
+
+    # The lengths are kept next to the ids, to build the masks once the batch is padded
+    dataset = dataset.map(lambda context_ids, qn_ids, ans_span: (context_ids, tf.size(context_ids), qn_ids, tf.size(qn_ids), ans_span))
+    padded_shapes = ([None] if dynamic_padding else [context_len], [], [None] if dynamic_padding else [question_len], [], [2])
+
+    def batch_window(key, window):
+        return window.padded_batch(batch_size, padded_shapes)
+
+    if bucket_width:
+        dataset = dataset.apply(tf.contrib.data.group_by_window(
+            key_func=lambda context_ids, context_lens, qn_ids, qn_lens, ans_span: tf.to_int64(context_lens // bucket_width),
+            reduce_func=batch_window, window_size=batch_size))
+    else:
+        dataset = batch_window(None, dataset)
+
+    def add_masks(context_ids, context_lens, qn_ids, qn_lens, ans_span):
+        context_mask = tf.sequence_mask(context_lens, tf.shape(context_ids)[1], dtype=tf.int32)
+        qn_mask = tf.sequence_mask(qn_lens, tf.shape(qn_ids)[1], dtype=tf.int32)
+        return context_ids, context_mask, qn_ids, qn_mask, ans_span
+
+    dataset = dataset.map(add_masks)
+    return dataset.prefetch(prefetch_batches)
+
+
+class PipelineEpoch(object):
+    """
+    Stands in for the batches of one epoch in QAModel.train when the training batches come from the tf.data pipeline.
+
+    The model reads each batch from the pipeline's iterator rather than from a Batch object,
+    so iterating yields None for every training step. The epoch ends when the iterator runs out,
+    which the training step reports by raising tf.errors.OutOfRangeError.
+
+    state is the state of the epoch after the last batch yielded: the shuffling seed of the epoch
+    and the number of batches so far, along with the data_key of the pipeline. Passing it as resume_state
+    starts the epoch again with the same seed and skips those batches.
+    """
+
+    # The prefetching happens inside the graph, so the time waiting for it is counted as training time
+    wait_time = 0.
+
+    def __init__(self, session, iterator, initializer_feed, seed_placeholder, next_batch, resume_state=None, data_key=None):
+        """
+        Inputs:
+          session: TensorFlow session
+          iterator: initializable iterator over a make_dataset pipeline
+          initializer_feed: feed dict for iterator.initializer, e.g. the path of the TFRecord file
+          seed_placeholder: the shuffle_seed of make_dataset
+          next_batch: iterator.get_next(), run to skip batches when resuming
+          resume_state: the state of an earlier PipelineEpoch to resume from, or None
+          data_key: JSON-serializable description of the data and batching arguments, recorded in state
+        """
+        self.data_key = data_key
+        self.seed = resume_state["seed"] if resume_state else random.randint(0, 2**31 - 1)
+        self.num_batches = 0
+        initializer_feed = dict(initializer_feed)
+        initializer_feed[seed_placeholder] = self.seed
+        session.run(iterator.initializer, initializer_feed)
+
+        if resume_state:
+            for _ in xrange(resume_state["num_batches"]):
+                session.run(next_batch)
+            self.num_batches = resume_state["num_batches"]
+
+    @property
+    def state(self):
+        return {"seed": self.seed, "num_batches": self.num_batches, "data": self.data_key}
+
+    def __iter__(self):
+        while True:
+            self.num_batches += 1
+            yield None
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
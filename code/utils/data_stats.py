@@ -1,13 +1,20 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import time
+import os
+import sys
+
+# The data of a split can be in several shards (see data_shards.py, in the parent directory)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_shards import shard_paths, open_data
 
 '''
 Utility functions to collect data on training set
 '''
 
 def load_file(path):
-    return open(path, "r").read().split("\n")
+    with open_data(path) as f:
+        return "".join(f).split("\n")
 
 '''
 Split sentences contained in data by token ' '
@@ -21,11 +28,11 @@ def split_token(data, toint=False):
 Load data in numpy array and splits them by token
 '''
 def load_data(mode = 'train'):
-    path = '../data/' + mode
-    answers = split_token(load_file(path + '.answer'))
-    contexts = split_token(load_file(path + '.context'))
-    questions = split_token(load_file(path + '.question'))
-    spans = split_token(load_file(path + '.span'), toint=True)
+    data_dir = '../data'
+    answers = split_token(load_file(shard_paths(data_dir, mode, 'answer')))
+    contexts = split_token(load_file(shard_paths(data_dir, mode, 'context')))
+    questions = split_token(load_file(shard_paths(data_dir, mode, 'question')))
+    spans = split_token(load_file(shard_paths(data_dir, mode, 'span')), toint=True)
     return answers, contexts, questions, spans
 
 
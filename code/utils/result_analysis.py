@@ -3,13 +3,20 @@ import matplotlib.pyplot as plt
 import seaborn as sn
 import pandas as pd
 from numpy.core.defchararray import find
+import os
+import sys
+
+# The data of a split can be in several shards (see data_shards.py, in the parent directory)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_shards import shard_paths, open_data
 
 '''
 Utility functions to collect data on training set
 '''
 
 def load_file(path):
-    return open(path, "r").read().split("\n")
+    with open_data(path) as f:
+        return "".join(f).split("\n")
 
 '''
 Split sentences contained in data by token ' '
@@ -22,11 +29,11 @@ def split_token(data, toint=False):
 Load data in numpy array and splits them by token
 '''
 def load_data(mode = 'dev'):
-    path = 'data/' + mode
-    answers = (load_file(path + '.answer'))
-    contexts = (load_file(path + '.context'))
-    questions = (load_file(path + '.question'))
-    spans = load_file(path + '.span')
+    data_dir = 'data'
+    answers = (load_file(shard_paths(data_dir, mode, 'answer')))
+    contexts = (load_file(shard_paths(data_dir, mode, 'context')))
+    questions = (load_file(shard_paths(data_dir, mode, 'question')))
+    spans = load_file(shard_paths(data_dir, mode, 'span'))
     return answers, contexts, questions, spans
 
 
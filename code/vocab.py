@@ -18,8 +18,15 @@ and return them as an embedding matrix"""
 from __future__ import absolute_import
 from __future__ import division
 
+import os
+import json
+import hashlib
+import tempfile
+import multiprocessing
+
 from tqdm import tqdm
 import numpy as np
+from six.moves import xrange
 
 _PAD = b"<pad>"
 _UNK = b"<unk>"
@@ -27,58 +34,439 @@ _START_VOCAB = [_PAD, _UNK]
 PAD_ID = 0
 UNK_ID = 1
 
+# Bump this whenever the layout of the binary GloVe cache changes
+GLOVE_CACHE_VERSION = 1
+
+
+class Vocab(object):
+    """
+    An array-backed vocabulary, mapping words (strings) to word ids (ints) and back.
+
+    The words are stored in a single fixed-width numpy byte string array (indexed by id),
+    and looked up through a sorted int32 index of that array, so that a vocabulary of
+    400k words needs a few tens of MB rather than two dicts of Python strings.
+
+    A Vocab can be used like the word2id dictionary it replaces (get, [], in, len),
+    but converting many tokens at once with lookup or encode is much faster.
+    """
+
+    def __init__(self, words):
+        """
+        Inputs:
+          words: list of strings, in id order (words[0] has id 0)
+        """
+        self.id2word = np.array(words, dtype=np.string_) # shape (vocab_size)
+        self.max_word_len = self.id2word.dtype.itemsize
+        self.sorted_ids = np.argsort(self.id2word, kind='mergesort').astype(np.int32) # shape (vocab_size). ids in alphabetical order of their words
+        self._fingerprint = None
+
+    def __len__(self):
+        return len(self.id2word)
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def __getitem__(self, word):
+        idx = self.get(word)
+        if idx is None:
+            raise KeyError(word)
+        return idx
+
+    def get(self, word, default=None):
+        """Returns the id of word, or default if it's not in the vocabulary"""
+        idx = int(self.lookup([word])[0])
+        if idx == UNK_ID and word != _UNK:
+            return default
+        return idx
+
+    def fingerprint(self):
+        """Returns the vocab_fingerprint of this vocabulary (computed once)"""
+        if self._fingerprint is None:
+            self._fingerprint = vocab_fingerprint(self.id2word)
+        return self._fingerprint
+
+    def lookup(self, tokens):
+        """
+        Converts a list of tokens to word ids.
+        Unicode tokens are looked up by their utf8 encoding.
+        Any token that isn't in the vocabulary gets mapped to UNK_ID.
+
+        Inputs:
+          tokens: list of strings
+
+        Returns:
+          ids: int32 numpy array shape (len(tokens))
+        """
+        if len(tokens) == 0:
+            return np.zeros(0, dtype=np.int32)
+
+        tokens = np.array(tokens)
+        if tokens.dtype.kind == 'U':
+            tokens = np.char.encode(tokens, 'utf8')
+
+        # Tokens longer than the longest word can't be in the vocabulary,
+        # and would otherwise be truncated when compared to the words
+        too_long = np.char.str_len(tokens) > self.max_word_len if tokens.dtype.itemsize > self.max_word_len else None
+        tokens = tokens.astype(self.id2word.dtype)
+
+        # Binary search for each token in the sorted words
+        positions = np.searchsorted(self.id2word, tokens, sorter=self.sorted_ids)
+        positions = np.minimum(positions, len(self.sorted_ids) - 1)
+        ids = self.sorted_ids[positions]
+        found = self.id2word[ids] == tokens
+        if too_long is not None:
+            found &= ~too_long
+        return np.where(found, ids, UNK_ID).astype(np.int32)
+
+    def encode(self, token_lists, max_len=0):
+        """
+        Converts a batch of token lists to a padded array of word ids.
+
+        Inputs:
+          token_lists: list of lists of strings
+          max_len: int. Length to pad (and truncate) to.
+            If 0, pad to the longest list in token_lists.
+
+        Returns:
+          ids: int32 numpy array shape (len(token_lists), max_len).
+            Contains PAD_ID after the end of each token list.
+          lengths: int32 numpy array shape (len(token_lists)).
+            The (truncated) length of each token list.
+        """
+        lengths = np.array([len(tokens) for tokens in token_lists], dtype=np.int32)
+        if max_len == 0:
+            max_len = int(lengths.max()) if len(lengths) else 0
+
+        flat_ids = self.lookup([w for tokens in token_lists for w in tokens])
+
+        # Position of each token within its list
+        rows = np.repeat(np.arange(len(token_lists)), lengths)
+        starts = np.cumsum(lengths) - lengths
+        cols = np.arange(len(flat_ids)) - np.repeat(starts, lengths)
+        keep = cols < max_len
+
+        ids = np.full((len(token_lists), max_len), PAD_ID, dtype=np.int32)
+        ids[rows[keep], cols[keep]] = flat_ids[keep]
+        return ids, np.minimum(lengths, max_len)
+
+
+def glove_fingerprint(glove_path):
+    """
+    Returns a fingerprint (hex string) of the GloVe .txt file.
+    Hashing the whole file takes as long as parsing it, so we hash its size,
+    its modification time and its first and last megabyte instead.
+    """
+    sha = hashlib.sha1()
+    stat = os.stat(glove_path)
+    sha.update("%i %i %i" % (GLOVE_CACHE_VERSION, stat.st_size, int(stat.st_mtime)))
+    with open(glove_path, 'rb') as fh:
+        sha.update(fh.read(1 << 20))
+        fh.seek(max(0, stat.st_size - (1 << 20)))
+        sha.update(fh.read(1 << 20))
+    return sha.hexdigest()
+
+
+def glove_cache_paths(glove_path):
+    """Returns the paths of the (matrix, vocab, meta) files of the binary cache for glove_path"""
+    prefix = os.path.splitext(glove_path)[0]
+    return prefix + ".npy", prefix + ".vocab", prefix + ".cache.json"
+
+
+def _line_aligned_chunks(glove_path, num_chunks):
+    """Splits glove_path into at most num_chunks (start, end) byte ranges, each starting at the beginning of a line"""
+    file_size = os.path.getsize(glove_path)
+    boundaries = [0]
+    with open(glove_path, 'rb') as fh:
+        for i in range(1, num_chunks):
+            fh.seek(file_size * i // num_chunks)
+            fh.readline() # move to the start of the next line
+            pos = min(fh.tell(), file_size)
+            if pos > boundaries[-1]:
+                boundaries.append(pos)
+    if boundaries[-1] < file_size:
+        boundaries.append(file_size)
+    return zip(boundaries[:-1], boundaries[1:])
+
+
+def _parse_glove_chunk(args):
+    """
+    Parses the lines in byte range [start, end) of the GloVe file.
+    This runs in a worker process, so it must be a top-level function.
+
+    Returns:
+      words: list of strings
+      vectors: float32 numpy array shape (len(words), glove_dim)
+    """
+    glove_path, glove_dim, start, end = args
+    with open(glove_path, 'rb') as fh:
+        fh.seek(start)
+        data = fh.read(end - start)
+
+    words, rests = [], []
+    for line in data.split("\n"):
+        line = line.lstrip().rstrip()
+        if not line:
+            continue
+        word, _, rest = line.partition(" ")
+        words.append(word)
+        rests.append(rest)
+
+    vectors = np.fromstring(" ".join(rests), dtype=np.float32, sep=" ")
+    if vectors.size != len(words) * glove_dim:
+        raise Exception("You set --glove_path=%s but --embedding_size=%i. If you set --glove_path yourself then make sure that --embedding_size matches!" % (glove_path, glove_dim))
+    return words, vectors.reshape((len(words), glove_dim))
+
+
+def parse_glove(glove_path, glove_dim, num_workers=None):
+    """
+    Parses the original GloVe .txt file, in parallel chunks.
+
+    Returns:
+      emb_matrix: float32 numpy array shape (vocab_size + 2, glove_dim).
+        The first two rows are randomly initialized PAD and UNK embeddings.
+      words: list of strings, the words for rows 2 onwards of emb_matrix
+    """
+    num_workers = num_workers or multiprocessing.cpu_count()
+    chunks = [(glove_path, glove_dim, start, end) for (start, end) in _line_aligned_chunks(glove_path, num_workers * 4)]
+
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        results = list(tqdm(pool.imap(_parse_glove_chunk, chunks), total=len(chunks)))
+    finally:
+        pool.close()
+        pool.join()
+
+    words = [w for (chunk_words, _) in results for w in chunk_words]
+    emb_matrix = np.empty((len(words) + len(_START_VOCAB), glove_dim), dtype=np.float32)
+
+    # randomly initialize the special tokens
+    emb_matrix[:len(_START_VOCAB), :] = np.random.randn(len(_START_VOCAB), glove_dim)
+
+    idx = len(_START_VOCAB)
+    for (_, vectors) in results:
+        emb_matrix[idx:idx + len(vectors), :] = vectors
+        idx += len(vectors)
+
+    return emb_matrix, words
+
 
-def get_glove(glove_path, glove_dim):
+def write_glove_cache(glove_path, glove_dim, emb_matrix, words):
+    """
+    Writes the binary cache for glove_path: the embedding matrix as a float32 .npy file,
+    the words one per line, and a small json file recording the fingerprint of the source file.
+
+    Each file is written under a temporary name and then renamed, so that the files of an older cache
+    that other processes have memory-mapped are replaced rather than overwritten, and concurrent writers
+    don't mix their output. The json file comes last, so an interrupted write never looks like a valid cache.
+    """
+    matrix_path, vocab_path, meta_path = glove_cache_paths(glove_path)
+
+    def write_file(path, write):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + ".tmp-")
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                write(fh)
+            os.rename(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    write_file(matrix_path, lambda fh: np.save(fh, emb_matrix))
+    write_file(vocab_path, lambda fh: fh.write("\n".join(words)))
+    write_file(meta_path, lambda fh: json.dump({"fingerprint": glove_fingerprint(glove_path), "glove_dim": glove_dim, "vocab_size": len(words)}, fh))
+
+
+def read_glove_cache(glove_path, glove_dim):
+    """
+    Reads the binary cache for glove_path.
+    Returns (emb_matrix, words), or None if the cache is missing, stale or unreadable.
+    emb_matrix is a read-only memory-mapped float32 array.
+    """
+    matrix_path, vocab_path, meta_path = glove_cache_paths(glove_path)
+    if not (os.path.exists(matrix_path) and os.path.exists(vocab_path) and os.path.exists(meta_path)):
+        return None
+
+    try:
+        with open(meta_path) as fh:
+            meta = json.load(fh)
+        if meta.get("fingerprint") != glove_fingerprint(glove_path) or meta.get("glove_dim") != glove_dim:
+            return None
+
+        emb_matrix = np.load(matrix_path, mmap_mode='r')
+        with open(vocab_path, 'rb') as fh:
+            words = fh.read().split("\n")
+    except (ValueError, IOError):
+        # e.g. a truncated file
+        return None
+    if len(words) != meta["vocab_size"] or emb_matrix.shape != (len(words) + len(_START_VOCAB), glove_dim):
+        return None
+
+    return emb_matrix, words
+
+
+def get_glove(glove_path, glove_dim, use_cache=True, num_workers=None):
     """Reads from original GloVe .txt file and returns embedding matrix and
     mappings from words to word ids.
 
+    The first call parses the .txt file and writes a binary cache next to it
+    (glove.6B.{glove_dim}d.{npy,vocab,cache.json}). Later calls memory-map the
+    cached matrix instead, as long as the .txt file is unchanged.
+
     Input:
       glove_path: path to glove.6B.{glove_dim}d.txt
       glove_dim: integer; needs to match the dimension in glove_path
+      use_cache: if False, always parse the .txt file and don't write the cache
+      num_workers: number of processes used to parse the .txt file. Defaults to the number of CPUs.
 
     Returns:
-      emb_matrix: Numpy array shape (400002, glove_dim) containing glove embeddings
+      emb_matrix: float32 numpy array shape (400002, glove_dim) containing glove embeddings
         (plus PAD and UNK embeddings in first two rows).
         The rows of emb_matrix correspond to the word ids given in word2id and id2word
-      word2id: dictionary mapping word (string) to word id (int)
-      id2word: dictionary mapping word id (int) to word (string)
+      word2id: Vocab mapping word (string) to word id (int)
+      id2word: numpy array mapping word id (int) to word (string). This is word2id.id2word.
     """
+    cached = read_glove_cache(glove_path, glove_dim) if use_cache else None
 
-    print "Loading GLoVE vectors from file: %s" % glove_path
-    vocab_size = int(4e5) # this is the vocab size of the corpus we've downloaded
+    if cached is not None:
+        print "Loading GLoVE vectors from cache: %s" % glove_cache_paths(glove_path)[0]
+        emb_matrix, words = cached
+    else:
+        print "Loading GLoVE vectors from file: %s" % glove_path
+        emb_matrix, words = parse_glove(glove_path, glove_dim, num_workers)
+        if use_cache:
+            try:
+                write_glove_cache(glove_path, glove_dim, emb_matrix, words)
+            except (IOError, OSError) as e:
+                print "Unable to write the GLoVE cache for %s: %s" % (glove_path, e)
 
-    emb_matrix = np.zeros((vocab_size + len(_START_VOCAB), glove_dim))
-    word2id = {}
-    id2word = {}
+    # put start tokens in the vocabulary, then the glove words
+    word2id = Vocab(_START_VOCAB + words)
+    id2word = word2id.id2word
 
-    random_init = True
-    # randomly initialize the special tokens
-    if random_init:
-        emb_matrix[:len(_START_VOCAB), :] = np.random.randn(len(_START_VOCAB), glove_dim)
-
-    # put start tokens in the dictionaries
-    idx = 0
-    for word in _START_VOCAB:
-        word2id[word] = idx
-        id2word[idx] = word
-        idx += 1
-
-    # go through glove vecs
-    with open(glove_path, 'r') as fh:
-        for line in tqdm(fh, total=vocab_size):
-            line = line.lstrip().rstrip().split(" ")
-            word = line[0]
-            vector = list(map(float, line[1:]))
-            if glove_dim != len(vector):
-                raise Exception("You set --glove_path=%s but --embedding_size=%i. If you set --glove_path yourself then make sure that --embedding_size matches!" % (glove_path, glove_dim))
-            emb_matrix[idx, :] = vector
-            word2id[word] = idx
-            id2word[idx] = word
-            idx += 1
-
-    final_vocab_size = vocab_size + len(_START_VOCAB)
+    final_vocab_size = len(words) + len(_START_VOCAB)
     assert len(word2id) == final_vocab_size
     assert len(id2word) == final_vocab_size
-    assert idx == final_vocab_size
+    assert emb_matrix.shape[0] == final_vocab_size
 
     return emb_matrix, word2id, id2word
+
+
+# The ways the embedding matrix can be stored in the graph (see quantize_embeddings)
+EMB_DTYPES = ("float32", "float16", "int8")
+
+
+def quantize_embeddings(emb_matrix, emb_dtype, chunk_size=50000):
+    """
+    Converts the embedding matrix to a more compact storage type.
+
+    Inputs:
+      emb_matrix: float32 numpy array shape (vocab_size, embedding_size)
+      emb_dtype: one of EMB_DTYPES.
+        "float16" halves the size of the matrix.
+        "int8" quarters it, by scaling each row so that its largest absolute value maps to 127.
+      chunk_size: int. The matrix is converted this many rows at a time, to bound memory use.
+
+    Returns:
+      values: numpy array shape (vocab_size, embedding_size) of dtype emb_dtype
+      scales: for "int8", float32 numpy array shape (vocab_size, 1) such that
+        values * scales approximates emb_matrix. None otherwise.
+    """
+    if emb_dtype not in EMB_DTYPES:
+        raise Exception("Unexpected embedding dtype: %s. Available: %s" % (emb_dtype, "/".join(EMB_DTYPES)))
+
+    if emb_dtype == "float32":
+        return np.asarray(emb_matrix, dtype=np.float32), None
+
+    values = np.empty(emb_matrix.shape, dtype=np.dtype(emb_dtype))
+    scales = np.ones((emb_matrix.shape[0], 1), dtype=np.float32) if emb_dtype == "int8" else None
+
+    for start in xrange(0, emb_matrix.shape[0], chunk_size):
+        chunk = np.asarray(emb_matrix[start:start + chunk_size], dtype=np.float32)
+        if emb_dtype == "float16":
+            values[start:start + chunk_size] = chunk
+        else:
+            chunk_scales = np.abs(chunk).max(axis=1, keepdims=True) / 127.
+            chunk_scales[chunk_scales == 0] = 1.
+            values[start:start + chunk_size] = np.round(chunk / chunk_scales)
+            scales[start:start + chunk_size] = chunk_scales
+
+    return values, scales
+
+
+# Name of the file, written next to the checkpoints, recording the vocabulary a model was trained with
+VOCAB_FILENAME = "vocab.txt"
+
+
+def vocab_fingerprint(id2word):
+    """Returns a fingerprint (hex string) identifying the vocabulary given by id2word"""
+    sha = hashlib.sha1()
+    for idx in xrange(len(id2word)):
+        sha.update(id2word[idx])
+        sha.update("\n")
+    return sha.hexdigest()
+
+
+def select_vocab(emb_matrix, word2id, words):
+    """
+    Restricts the embedding matrix and mappings to the given words.
+
+    Inputs:
+      emb_matrix, word2id: as returned by get_glove
+      words: list of strings. The new vocabulary in id order, starting with _START_VOCAB.
+
+    Returns:
+      emb_matrix, word2id, id2word for the new vocabulary.
+        emb_matrix is an in-memory copy of the selected rows.
+    """
+    if list(words[:len(_START_VOCAB)]) != _START_VOCAB:
+        raise Exception("A vocabulary must start with the special tokens %s" % _START_VOCAB)
+    missing = [w for (w, idx) in zip(words, word2id.lookup(words)) if idx == UNK_ID and w != _UNK]
+    if missing:
+        raise Exception("%i words of the vocabulary are not in the GloVe vocabulary (e.g. %r). Was the vocabulary built from a different GloVe file?" % (len(missing), missing[0]))
+
+    old_ids = word2id.lookup(words)
+    new_emb_matrix = np.asarray(emb_matrix[old_ids], dtype=np.float32)
+    word2id = Vocab(words)
+    return new_emb_matrix, word2id, word2id.id2word
+
+
+def prune_vocab(emb_matrix, word2id, id2word, corpus_paths, keep_top_n):
+    """
+    Prunes the GloVe vocabulary to the words that appear in the given
+    (preprocessed, whitespace-tokenized) files, plus the keep_top_n most frequent GloVe words.
+    The GloVe files list words by decreasing frequency, so these are the first keep_top_n words.
+
+    Inputs:
+      emb_matrix, word2id, id2word: as returned by get_glove
+      corpus_paths: list of paths to {train/dev}.{context/question} files
+      keep_top_n: int. Number of frequent GloVe words to keep even if they don't appear in corpus_paths.
+
+    Returns:
+      emb_matrix, word2id, id2word for the pruned vocabulary.
+        Words keep their relative order, so the special tokens keep their ids.
+    """
+    keep = np.zeros(len(id2word), dtype=bool)
+    keep[:len(_START_VOCAB) + keep_top_n] = True
+
+    corpus_words = set()
+    for path in corpus_paths:
+        with open(path) as fh:
+            for line in fh:
+                corpus_words.update(line.split())
+    keep[word2id.lookup(list(corpus_words))] = True
+
+    words = [id2word[idx] for idx in np.nonzero(keep)[0]]
+    print "Pruned vocabulary from %i to %i words" % (len(id2word), len(words))
+    return select_vocab(emb_matrix, word2id, words)
+
+
+def write_vocab(vocab_path, id2word):
+    """Writes the words of id2word to vocab_path, one per line, in id order"""
+    with open(vocab_path, 'wb') as fh:
+        fh.write("\n".join(id2word[idx] for idx in xrange(len(id2word))))
+
+
+def read_vocab(vocab_path):
+    """Reads a list of words written by write_vocab"""
+    with open(vocab_path, 'rb') as fh:
+        return fh.read().split("\n")